@@ -0,0 +1,231 @@
+"""
+Local stand-in of the Graph's query endpoint serving synthetic subgraphs (see synthetic.py).
+
+Only the subset of GraphQL sent by the ingestion is supported: named or anonymous queries with variables,
+aliases, arguments (literals, variables, lists and objects) and nested selection sets. Automatic persisted
+queries are supported as well.
+
+    python -m benchmarks.graphql_server --snaps 1000000 --pools 5000 --port 8000
+    SUBGRAPH_PROVIDER=http://127.0.0.1:8000/subgraphs/name/ python ...
+"""
+import argparse
+import json
+import re
+import threading
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from benchmarks.synthetic import SyntheticConfig, SyntheticSubgraph
+
+_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|[_A-Za-z][_0-9A-Za-z]*|\.\.\.|[^\s,]')
+
+# (response key, field name, arguments, selection set)
+Field = Tuple[str, str, Dict[str, Any], Optional[List['Field']]]
+
+
+class _Variable:
+    def __init__(self, name: str):
+        self.name = name
+
+
+class _Parser:
+    def __init__(self, document: str):
+        self.tokens = _TOKEN.findall(document)
+        self.position = 0
+
+    def _peek(self) -> Optional[str]:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _next(self) -> str:
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def _expect(self, expected: str):
+        token = self._next()
+        assert token == expected, f'Expected {expected}, got {token}'
+
+    def document(self) -> List[Field]:
+        if self._peek() == 'query':
+            self._next()
+            if self._peek() not in ('{', '('):
+                self._next()
+            if self._peek() == '(':
+                # Variable types are not checked
+                while self._next() != ')':
+                    pass
+        return self.selection_set()
+
+    def selection_set(self) -> List[Field]:
+        self._expect('{')
+        fields = []
+        while self._peek() != '}':
+            key = name = self._next()
+            if self._peek() == ':':
+                self._next()
+                name = self._next()
+            arguments = {}
+            if self._peek() == '(':
+                self._next()
+                while self._peek() != ')':
+                    argument = self._next()
+                    self._expect(':')
+                    arguments[argument] = self.value()
+                self._next()
+            selection = self.selection_set() if self._peek() == '{' else None
+            fields.append((key, name, arguments, selection))
+        self._next()
+        return fields
+
+    def value(self) -> Any:
+        token = self._next()
+        if token == '$':
+            return _Variable(self._next())
+        if token == '[':
+            values = []
+            while self._peek() != ']':
+                values.append(self.value())
+            self._next()
+            return values
+        if token == '{':
+            values = {}
+            while self._peek() != '}':
+                key = self._next()
+                self._expect(':')
+                values[key] = self.value()
+            self._next()
+            return values
+        if token.startswith('"'):
+            return json.loads(token)
+        if token in ('true', 'false', 'null'):
+            return {'true': True, 'false': False, 'null': None}[token]
+        if re.fullmatch(r'-?\d+', token):
+            return int(token)
+        if re.fullmatch(r'-?\d.*', token):
+            return float(token)
+        # Enum value
+        return token
+
+
+@lru_cache(maxsize=1024)
+def parse(document: str) -> List[Field]:
+    return _Parser(document).document()
+
+
+def _substitute(value: Any, variables: Dict) -> Any:
+    if isinstance(value, _Variable):
+        return variables.get(value.name)
+    if isinstance(value, list):
+        return [_substitute(item, variables) for item in value]
+    if isinstance(value, dict):
+        return {key: _substitute(item, variables) for key, item in value.items()}
+    return value
+
+
+def _project(value: Any, selection: Optional[List[Field]]) -> Any:
+    if selection is None or value is None:
+        return value
+    if isinstance(value, list):
+        return [_project(item, selection) for item in value]
+    return {key: _project(value.get(name), sub_selection) for key, name, _, sub_selection in selection}
+
+
+def execute(subgraph: SyntheticSubgraph, document: str, variables: Dict) -> Dict:
+    data = {}
+    for key, name, arguments, selection in parse(document):
+        if name not in subgraph.resolvers:
+            return {'errors': [{'message': f'Type `Query` has no field `{name}`'}]}
+        data[key] = _project(subgraph.resolvers[name](_substitute(arguments, variables)), selection)
+    return {'data': data}
+
+
+class SyntheticGraphServer:
+    """
+    Serves the subgraphs under /subgraphs/name/{name}, names without a subgraph of their own
+    (e.g. subgraphs of the yield pools) are served by the default one.
+    """
+
+    def __init__(self, subgraphs: Dict[str, SyntheticSubgraph], default: SyntheticSubgraph, port=0):
+        self.subgraphs = subgraphs
+        self.default = default
+        self.requests = 0
+        # Documents registered by the automatic persisted queries protocol, by hash
+        self._persisted: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def provider(self) -> str:
+        """
+        Value of SUBGRAPH_PROVIDER pointing the readers to this server.
+        """
+        return f'http://127.0.0.1:{self._server.server_address[1]}/subgraphs/name/'
+
+    def start(self) -> 'SyntheticGraphServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, name='graphql-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def respond(self, subgraph_name: str, payload: Dict) -> Dict:
+        with self._lock:
+            self.requests += 1
+        document = payload.get('query')
+        persisted = (payload.get('extensions') or {}).get('persistedQuery')
+        if persisted:
+            with self._lock:
+                if document is None:
+                    document = self._persisted.get(persisted['sha256Hash'])
+                else:
+                    self._persisted[persisted['sha256Hash']] = document
+            if document is None:
+                return {'errors': [{'message': 'PersistedQueryNotFound'}]}
+        subgraph = self.subgraphs.get(subgraph_name, self.default)
+        return execute(subgraph, document, payload.get('variables') or {})
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                name = self.path.split('/subgraphs/name/', 1)[-1].strip('/')
+                body = json.dumps(server.respond(name, payload)).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def synthetic_server(snap_count: int, pool_count: int, seed=0, port=0) -> SyntheticGraphServer:
+    """
+    Server of the subgraphs read by the Uniswap and Balancer ingestion, Balancer pools have up to 8 tokens.
+    """
+    uniswap = SyntheticSubgraph(SyntheticConfig(seed=seed, snap_count=snap_count, pool_count=pool_count))
+    balancer = SyntheticSubgraph(SyntheticConfig(seed=seed, snap_count=snap_count, pool_count=pool_count,
+                                                 max_pool_tokens=8))
+    return SyntheticGraphServer({'benesjan/balancer-with-snapshots': balancer}, uniswap, port)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--snaps', type=int, default=1000000)
+    parser.add_argument('--pools', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    graph_server = synthetic_server(args.snaps, args.pools, args.seed, args.port)
+    print(f'Serving at {graph_server.provider}')
+    graph_server.start()._thread.join()
@@ -0,0 +1,201 @@
+"""
+Scaling load tests of the ingestion paths (Controller + Uniswap/Balancer) against synthetic subgraphs
+served by a local GraphQL stand-in (see graphql_server.py), data are written to local SQLite storages.
+
+Every combination of entity count (snaps, staked snaps and yields, or pools), page size and concurrency
+(number of jobs of the path running at once in one process) runs in a fresh process, so that its peak RSS
+is measured on its own. Results are written as CSV and, when matplotlib is installed, plotted as throughput
+and memory curves per ingestion path.
+
+    python -m benchmarks.load_test --paths UNI_V2/snaps,BALANCER/snaps,UNI_V2/pools \\
+        --sizes 10000,100000,1000000 --page-sizes 100,500,1000 --concurrency 1,2,4
+"""
+import argparse
+import csv
+import itertools
+import logging
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+from typing import Dict, List
+
+from benchmarks.graphql_server import synthetic_server
+
+ENTITY_TYPES = ('snaps', 'staked_snaps', 'staked_snaps_by_service', 'yields', 'pools')
+
+# Pool count of the subgraphs when the size sweeps the snaps
+DEFAULT_POOL_COUNT = 2000
+# Snap count of the subgraphs when the size sweeps the pools
+DEFAULT_SNAP_COUNT = 1000
+
+FIELDS = ['exchange', 'entityType', 'size', 'pageSize', 'concurrency', 'seconds', 'objects', 'objectsPerSecond',
+          'pages', 'requests', 'peakRssMb']
+
+
+def _isolate_caches(directory: str):
+    """
+    The process-wide caches are persisted to /tmp, runs use their own so that they start cold
+    and the synthetic data don't leak into the real caches.
+    """
+    from src.shared import eth_price_oracle, token_registry
+    from src.uniswap_v2 import pair_state_cache
+    token_registry._shared_registry = token_registry.TokenRegistry(os.path.join(directory, 'tokens.sqlite3'))
+    eth_price_oracle._shared_oracle = eth_price_oracle.EthPriceOracle(os.path.join(directory, 'eth-prices.sqlite3'))
+    pair_state_cache._shared_cache = pair_state_cache.PairStateCache(os.path.join(directory, 'pair-states.sqlite3'))
+
+
+def run_case(provider: str, exchange: str, entity_type: str, page_size: int, concurrency: int) -> Dict:
+    """
+    Runs in a fresh process, imports of the ingestion happen after the subgraph provider is set.
+    """
+    os.environ['SUBGRAPH_PROVIDER'] = provider
+    from src.controller import Controller
+    from src.jobs import JobProgress
+    from src.shared.type_definitions import Exchange
+    from src.storage import SQLiteStorage
+    from src.balancer.balancer import Balancer
+    from src.uniswap_v2.uniswap import Uniswap
+
+    directory = tempfile.mkdtemp(prefix='load-test-')
+    _isolate_caches(directory)
+
+    def run_job(job: int) -> JobProgress:
+        dex = Balancer() if exchange == 'BALANCER' else Uniswap(f'synthetic/{exchange.lower()}', Exchange[exchange])
+        progress = JobProgress()
+        # Every job has its own storage, jobs of one exchange would share the checkpoints otherwise
+        controller = Controller(dex, logging.getLogger(f'{exchange}-{job}'), aggregate=True, progress=progress,
+                                storage=SQLiteStorage(os.path.join(directory, f'storage-{job}.sqlite3')))
+        try:
+            if entity_type == 'snaps':
+                controller.update_snaps(max_objects_in_batch=page_size)
+            elif entity_type == 'staked_snaps':
+                controller.update_staked_snaps(max_objects_in_batch=page_size)
+            elif entity_type == 'staked_snaps_by_service':
+                controller.update_staked_snaps_by_service(max_objects_in_batch=page_size)
+            elif entity_type == 'yields':
+                controller.update_yields(max_objects_in_batch=page_size)
+            else:
+                controller.update_pools(max_objects_in_batch=page_size, min_liquidity=0)
+        finally:
+            controller.close()
+        progress.stop()
+        return progress
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        progresses = list(executor.map(run_job, range(concurrency)))
+    seconds = time.monotonic() - started
+    objects = sum(progress.objects for progress in progresses)
+    return {
+        'seconds': round(seconds, 3),
+        'objects': objects,
+        'objectsPerSecond': round(objects / seconds, 1),
+        'pages': sum(progress.pages for progress in progresses),
+        # ru_maxrss is in kB on Linux
+        'peakRssMb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def sweep(paths: List[str], sizes: List[int], page_sizes: List[int], concurrencies: List[int], seed=0) -> List[Dict]:
+    rows = []
+    for size in sizes:
+        pools = [path for path in paths if path.endswith('/pools')]
+        for sized_paths, snap_count, pool_count in ((set(paths) - set(pools), size, DEFAULT_POOL_COUNT),
+                                                    (pools, DEFAULT_SNAP_COUNT, size)):
+            if not sized_paths:
+                continue
+            server = synthetic_server(snap_count, pool_count, seed).start()
+            try:
+                for path, page_size, concurrency in itertools.product(sorted(sized_paths), page_sizes,
+                                                                      concurrencies):
+                    exchange, entity_type = path.split('/')
+                    requests_before = server.requests
+                    # A fresh process per case, the peak RSS of the previous cases would hide the smaller ones
+                    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                        result = executor.submit(run_case, server.provider, exchange, entity_type, page_size,
+                                                 concurrency).result()
+                    row = {'exchange': exchange, 'entityType': entity_type, 'size': size, 'pageSize': page_size,
+                           'concurrency': concurrency, 'requests': server.requests - requests_before, **result}
+                    logging.info(f'Load test: {row}')
+                    rows.append(row)
+            finally:
+                server.stop()
+    return rows
+
+
+def write_csv(rows: List[Dict], path: str):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def plot(rows: List[Dict], directory: str) -> List[str]:
+    """
+    Plots throughput and peak RSS against the size, one figure per ingestion path and one line
+    per page size and concurrency.
+    """
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        logging.warning('matplotlib is not installed, skipping the plots')
+        return []
+    paths = []
+    for (exchange, entity_type), path_rows in itertools.groupby(
+            sorted(rows, key=lambda row: (row['exchange'], row['entityType'])),
+            key=lambda row: (row['exchange'], row['entityType'])):
+        path_rows = list(path_rows)
+        figure, (throughput, memory) = plt.subplots(1, 2, figsize=(12, 5))
+        for (page_size, concurrency), line in itertools.groupby(
+                sorted(path_rows, key=lambda row: (row['pageSize'], row['concurrency'], row['size'])),
+                key=lambda row: (row['pageSize'], row['concurrency'])):
+            line = list(line)
+            label = f'page {page_size}, {concurrency} jobs'
+            throughput.plot([row['size'] for row in line], [row['objectsPerSecond'] for row in line], 'o-',
+                            label=label)
+            memory.plot([row['size'] for row in line], [row['peakRssMb'] for row in line], 'o-', label=label)
+        for axes, title in ((throughput, 'objects / s'), (memory, 'peak RSS (MB)')):
+            axes.set_xscale('log')
+            axes.set_xlabel('pools' if entity_type == 'pools' else entity_type)
+            axes.set_title(f'{exchange} {entity_type}: {title}')
+            axes.legend()
+        path = os.path.join(directory, f'{exchange}-{entity_type}.png')
+        figure.savefig(path)
+        plt.close(figure)
+        paths.append(path)
+    return paths
+
+
+def _ints(value: str) -> List[int]:
+    return [int(item) for item in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--paths', default='UNI_V2/snaps,BALANCER/snaps,UNI_V2/staked_snaps,UNI_V2/yields,'
+                                           'UNI_V2/pools,BALANCER/pools',
+                        help='Ingestion paths as {exchange}/{entity type}')
+    parser.add_argument('--sizes', type=_ints, default=[10000, 100000],
+                        help='Snap counts (pool counts of the pool paths)')
+    parser.add_argument('--page-sizes', type=_ints, default=[100, 500])
+    parser.add_argument('--concurrency', type=_ints, default=[1, 2, 4])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='/tmp/load-test')
+    args = parser.parse_args()
+    # Cases run in spawned processes which log only warnings
+    logging.basicConfig(level=logging.INFO)
+
+    paths = args.paths.split(',')
+    for path in paths:
+        assert path.split('/')[-1] in ENTITY_TYPES, f'Unknown entity type of {path}'
+    os.makedirs(args.output, exist_ok=True)
+    results = sweep(paths, args.sizes, args.page_sizes, args.concurrency, args.seed)
+    write_csv(results, os.path.join(args.output, 'results.csv'))
+    for plot_path in plot(results, args.output):
+        print(f'Plot written to {plot_path}')
+    print(f'Results written to {os.path.join(args.output, "results.csv")}')
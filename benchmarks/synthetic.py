@@ -0,0 +1,332 @@
+import itertools
+import math
+import random
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import attr
+
+BASE_TIMESTAMP = 1600000000
+SECONDS_PER_BLOCK = 13
+
+# Staking services of the positions and rewards of each exchange
+STAKING_SERVICES = {
+    'UNI_V2': ('UNI_V2', 'INDEX'),
+    'SUSHI': ('SUSHI',),
+    'BALANCER': ('BALANCER',),
+    'MATERIA': ('UNI_V2',),
+}
+
+
+def _rng(*key) -> random.Random:
+    # Seeding by a string is deterministic across processes (unlike hash())
+    return random.Random(':'.join(str(part) for part in key))
+
+
+def _address(kind: int, index: int) -> str:
+    """
+    Fixed width hex ids, so the string order equals the index order (subgraphs order ids as strings).
+    """
+    return f'0x{kind:x}{index:039x}'
+
+
+def _amount(value: float) -> str:
+    return f'{value:.8f}'
+
+
+@attr.s(auto_attribs=True, slots=True)
+class SyntheticConfig(object):
+    """
+    Size and shape of a synthetic subgraph. Entities are generated from their index on request,
+    so even millions of snapshots don't occupy any memory.
+    """
+    seed: int = 0
+    snap_count: int = 100000
+    pool_count: int = 1000
+    token_count: int = 500
+    user_count: int = 10000
+    max_pool_tokens: int = 2  # Balancer pools have up to 8 tokens
+    first_block: int = 11000000
+    snaps_per_block: int = 5
+
+
+class SyntheticSubgraph:
+    """
+    Deterministic stand-in of the data of the Uniswap v2, Balancer and rewards subgraphs. Every root field
+    used by the ingestion (snapshots, pools at a block, aliased price queries, tokens, _meta, ...) is answered
+    from the same synthetic world, so one instance can serve any of the subgraphs.
+    """
+
+    def __init__(self, config: SyntheticConfig):
+        self.config = config
+        self.highest_block = config.first_block + config.snap_count // config.snaps_per_block
+        self.resolvers: Dict[str, Callable[[Dict], Any]] = {
+            '_meta': lambda args: {'block': {'number': self.highest_block}},
+            'blocks': self._blocks,
+            'bundle': lambda args: {'ethPrice': _amount(self.eth_price(_block(args)))},
+            'tokenPrice': lambda args: {'price': _amount(self._token_price(args['id'], _block(args)))},
+            'liquidityPositionSnapshots': lambda args: self._sequence(args, self.uniswap_snap),
+            'poolShareSnapshots': lambda args: self._sequence(args, self.balancer_snap),
+            'stakePositionSnapshots': self._stake_positions,
+            'rewards': lambda args: self._sequence(args, self.reward),
+            'pairs': lambda args: self._pools(args, self.uniswap_pair, 'reserveUSD'),
+            'pools': lambda args: self._pools(args, self.balancer_pool, 'liquidity'),
+            'pair': lambda args: self.uniswap_pair(self._pool_state(args['id'], _block(args))),
+            'pool': lambda args: self.balancer_pool(self._pool_state(args['id'], _block(args))),
+            'tokens': lambda args: _filter(self._tokens(), args),
+            'poolTokens': lambda args: _filter(self._tokens(), args),
+        }
+
+    # Prices and pool states
+
+    def eth_price(self, block: int) -> float:
+        return 400 + 100 * math.sin(block / 5000)
+
+    def _token_price(self, token_id: str, block: int) -> float:
+        return _rng(self.config.seed, 'price', token_id).uniform(0.1, 100) * (1 + 0.1 * math.sin(block / 3000))
+
+    def _tokens(self) -> List[Dict]:
+        return _tokens(self.config.seed, self.config.token_count)
+
+    def _base_pools(self) -> List[Dict]:
+        return _base_pools(self.config.seed, self.config.pool_count, self.config.token_count,
+                           self.config.max_pool_tokens)
+
+    def _pool_state(self, pool_id: str, block: Optional[int]) -> Dict:
+        """
+        State of the pool at the block. Unknown ids (e.g. yield pools) get a state of their own.
+        """
+        try:
+            index = int(pool_id, 16) - (1 << 156)
+        except ValueError:
+            index = -1
+        pools = self._base_pools()
+        if 0 <= index < len(pools):
+            pool = pools[index]
+        else:
+            pool = _base_pool(self.config.seed, pool_id, _rng(self.config.seed, 'pool', pool_id), 2,
+                              self.config.token_count)
+        factor = 1 + 0.05 * math.sin((block or self.highest_block) / 2000 + len(pool_id))
+        return {**pool, 'liquidity': pool['liquidity'] * factor,
+                'tokens': [{**token, 'balance': token['balance'] * factor} for token in pool['tokens']]}
+
+    @staticmethod
+    def uniswap_pair(pool: Dict) -> Dict:
+        token0, token1 = pool['tokens'][:2]
+        return {
+            'id': pool['id'],
+            'reserveUSD': _amount(pool['liquidity']),
+            'reserve0': _amount(token0['balance']),
+            'reserve1': _amount(token1['balance']),
+            'volumeUSD': _amount(pool['liquidity'] * 3),
+            'totalSupply': _amount(pool['shares']),
+            'token0': {'id': token0['address']},
+            'token1': {'id': token1['address']},
+        }
+
+    @staticmethod
+    def balancer_pool(pool: Dict) -> Dict:
+        return {
+            'id': pool['id'],
+            'totalWeight': str(sum(token['denormWeight'] for token in pool['tokens'])),
+            'totalShares': _amount(pool['shares']),
+            'liquidity': _amount(pool['liquidity']),
+            'swapFee': '0.003',
+            'totalSwapVolume': _amount(pool['liquidity'] * 3),
+            'tokens': [{'address': token['address'], 'denormWeight': str(token['denormWeight']),
+                        'balance': _amount(token['balance'])} for token in pool['tokens']],
+        }
+
+    def _pools(self, args: Dict, view: Callable[[Dict], Dict], liquidity_field: str) -> List[Dict]:
+        block, where = _block(args), args.get('where') or {}
+        first, skip = args.get('first', 100), args.get('skip') or 0
+        pools = self._base_pools()
+        if where.get('id_gt'):
+            # Pages ordered by id start right after the cursor
+            pools = pools[int(where['id_gt'], 16) - (1 << 156) + 1:]
+        matching = (pool for pool in (view(self._pool_state(pool['id'], block)) for pool in pools)
+                    if _matches(pool, where))
+        if args.get('orderBy') == liquidity_field:
+            ordered = sorted(matching, key=lambda pool: float(pool[liquidity_field]),
+                             reverse=args.get('orderDirection') == 'desc')
+            return ordered[skip:skip + first]
+        return list(itertools.islice(matching, skip, skip + first))
+
+    # Snapshot sequences, ordered by block
+
+    def _sequence(self, args: Dict, entity: Callable[[int, Dict], Dict], offset=0, stride=1) -> List[Dict]:
+        """
+        Entities of the indices offset + k * stride, i.e. all of them by default.
+        """
+        where = args.get('where') or {}
+        block = int(where.get('block_gte', where.get('blockNumber_gte', self.config.first_block)))
+        first_index = max(0, (block - self.config.first_block) * self.config.snaps_per_block)
+        start = max(0, -(-(first_index - offset) // stride)) + (args.get('skip') or 0)
+        indices = range(offset + start * stride, offset + (start + args.get('first', 100)) * stride, stride)
+        return [entity(index, where) for index in indices if index < self.config.snap_count]
+
+    def _stake_positions(self, args: Dict) -> List[Dict]:
+        """
+        Staking services take turns by the index, so the positions filtered by a staking service are a stride.
+        """
+        where = args.get('where') or {}
+        if 'stakingService' not in where:
+            return self._sequence(args, self.stake_position)
+        services = self._staking_services(where)
+        if where['stakingService'] not in services:
+            return []
+        return self._sequence(args, self.stake_position, services.index(where['stakingService']), len(services))
+
+    def _snap_base(self, index: int, *key) -> Dict:
+        rng = _rng(self.config.seed, *key, index)
+        block = self.config.first_block + index // self.config.snaps_per_block
+        return {
+            'rng': rng,
+            'block': block,
+            'timestamp': BASE_TIMESTAMP + (block - self.config.first_block) * SECONDS_PER_BLOCK,
+            'user': _address(3, rng.randrange(self.config.user_count)),
+            'pool': self._pool_state(_address(1, rng.randrange(self.config.pool_count)), block),
+            'tx': _address(4, index),
+        }
+
+    def uniswap_snap(self, index: int, where: Dict) -> Dict:
+        base = self._snap_base(index, 'snap')
+        pair = self.uniswap_pair(base['pool'])
+        return {
+            'id': f'{pair["id"]}-{base["user"]}{index}',
+            'timestamp': base['timestamp'],
+            'block': base['block'],
+            'user': {'id': base['user']},
+            'pair': {'id': pair['id'], 'token0': pair['token0'], 'token1': pair['token1']},
+            'reserve0': pair['reserve0'],
+            'reserve1': pair['reserve1'],
+            'reserveUSD': pair['reserveUSD'],
+            'liquidityTokenTotalSupply': pair['totalSupply'],
+            'liquidityTokenBalance': _amount(base['rng'].uniform(0, float(pair['totalSupply']) / 100)),
+            'transaction': {'id': base['tx'], 'gasUsed': str(base['rng'].randrange(50000, 300000)),
+                            'gasPrice': str(base['rng'].randrange(10, 200) * 10 ** 9)},
+        }
+
+    def balancer_snap(self, index: int, where: Dict) -> Dict:
+        base = self._snap_base(index, 'snap')
+        pool = self.balancer_pool(base['pool'])
+        return {
+            'id': f'{pool["id"]}-{base["user"]}-{index}',
+            'pool': {'id': pool['id'], 'totalWeight': pool['totalWeight']},
+            'user': {'id': base['user']},
+            'balance': _amount(base['rng'].uniform(0, float(pool['totalShares']) / 100)),
+            'tokenSnapshots': [{'balance': token['balance'], 'token': token} for token in pool['tokens']],
+            'liquidity': pool['liquidity'],
+            'totalShares': pool['totalShares'],
+            'txHash': base['tx'],
+            'block': base['block'],
+            'timestamp': base['timestamp'],
+            'gasUsed': str(base['rng'].randrange(50000, 300000)),
+            'gasPrice': str(base['rng'].randrange(10, 200) * 10 ** 9),
+        }
+
+    @staticmethod
+    def _staking_services(where: Dict) -> Tuple[str, ...]:
+        return STAKING_SERVICES.get(where.get('exchange'), ('UNI_V2',))
+
+    def _staking_service(self, index: int, where: Dict) -> str:
+        services = self._staking_services(where)
+        return services[index % len(services)]
+
+    def stake_position(self, index: int, where: Dict) -> Dict:
+        base = self._snap_base(index, 'stake', where.get('exchange'))
+        staking_service = self._staking_service(index, where)
+        # Ids of MasterChef positions start with the id of the pool within the staking contract
+        id_prefix = f'{index % 100}-' if staking_service == 'SUSHI' else ''
+        return {
+            'id': f'{id_prefix}{base["tx"]}-{index}',
+            'stakingService': staking_service,
+            'user': base['user'],
+            'pool': base['pool']['id'],
+            'liquidityTokenBalance': _amount(base['rng'].uniform(0, base['pool']['shares'] / 100)),
+            'blockNumber': str(base['block']),
+            'blockTimestamp': str(base['timestamp']),
+            'txHash': base['tx'],
+            'txGasUsed': str(base['rng'].randrange(50000, 300000)),
+            'txGasPrice': str(base['rng'].randrange(10, 200) * 10 ** 9),
+        }
+
+    def reward(self, index: int, where: Dict) -> Dict:
+        base = self._snap_base(index, 'reward', where.get('exchange'))
+        return {
+            'id': f'{base["tx"]}-{index}',
+            'stakingService': self._staking_service(index, where),
+            'exchange': where.get('exchange', 'UNI_V2'),
+            'pool': base['pool']['id'],
+            'amount': _amount(base['rng'].uniform(0, 100)),
+            'user': base['user'],
+            'transaction': base['tx'],
+            'blockNumber': str(base['block']),
+            'blockTimestamp': str(base['timestamp']),
+        }
+
+    def _blocks(self, args: Dict) -> List[Dict]:
+        timestamp = int((args.get('where') or {}).get('timestamp_gt', BASE_TIMESTAMP))
+        block = self.config.first_block + (timestamp - BASE_TIMESTAMP) // SECONDS_PER_BLOCK + 1
+        return [{'number': str(block), 'timestamp': str(timestamp + 1)}]
+
+
+def _block(args: Dict) -> Optional[int]:
+    block = args.get('block')
+    return int(block['number']) if block else None
+
+
+@lru_cache(maxsize=8)
+def _tokens(seed: int, token_count: int) -> List[Dict]:
+    return [{'id': _address(2, index), 'address': _address(2, index), 'symbol': f'TKN{index}',
+             'name': f'Synthetic token {index} ({seed})'} for index in range(token_count)]
+
+
+def _base_pool(seed: int, pool_id: str, rng: random.Random, token_count: int, all_tokens: int) -> Dict:
+    # Log-uniform liquidity, most of the pools are small as in the real subgraphs
+    liquidity = 10 ** rng.uniform(1, 8)
+    weights = [rng.randint(1, 40) for _ in range(token_count)]
+    tokens = []
+    for token_index, weight in zip(rng.sample(range(all_tokens), token_count), weights):
+        price = _rng(seed, 'price', _address(2, token_index)).uniform(0.1, 100)
+        tokens.append({'address': _address(2, token_index), 'denormWeight': weight,
+                       'balance': liquidity * weight / sum(weights) / price})
+    return {'id': pool_id, 'liquidity': liquidity, 'shares': liquidity / 10, 'tokens': tokens}
+
+
+@lru_cache(maxsize=8)
+def _base_pools(seed: int, pool_count: int, token_count: int, max_pool_tokens: int) -> List[Dict]:
+    pools = []
+    for index in range(pool_count):
+        rng = _rng(seed, 'pool', index)
+        pools.append(_base_pool(seed, _address(1, index), rng, rng.randint(2, max_pool_tokens), token_count))
+    return pools
+
+
+def _matches(entity: Dict, where: Dict) -> bool:
+    """
+    Equality and the _gt, _gte, _lt and _in filters, values other than ids are compared as numbers.
+    """
+    for key, expected in where.items():
+        field, _, operator = key.partition('_')
+        if operator and field not in entity:
+            field, operator = key, ''
+        value = entity.get(field)
+        if operator == 'in':
+            if value not in expected:
+                return False
+        elif operator in ('gt', 'gte', 'lt'):
+            if field != 'id':
+                value, expected = float(value), float(expected)
+            if (operator == 'gt' and not value > expected) or (operator == 'gte' and not value >= expected) \
+                    or (operator == 'lt' and not value < expected):
+                return False
+        elif value != expected:
+            return False
+    return True
+
+
+def _filter(entities: List[Dict], args: Dict) -> List[Dict]:
+    where = args.get('where') or {}
+    skip, first = args.get('skip') or 0, args.get('first', 100)
+    return list(itertools.islice((entity for entity in entities if _matches(entity, where)), skip, skip + first))
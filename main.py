@@ -1,46 +1,234 @@
 # [START gae_python38_app]
+import json
 import logging
+import os
+import time
+from contextlib import nullcontext
+from typing import Dict, Optional, Tuple
 
-from flask import Flask
+from flask import Flask, request
 
 from src.balancer.balancer import Balancer
 from src.controller import Controller
-from src.shared.type_definitions import Exchange
-from src.uniswap_v2.uniswap import Uniswap
+from src.forks import DEFAULT_GROUP, forks
+from src.jobs import Job, JobProgress, JobRunner
+from src.profiling import SamplingProfiler
+from src.retention import RETENTION_DAYS, PoolSnapRetention
+from src.scheduler import LagScheduler
+from src.shared.Dex import Dex
+from src.storage import shared_storage
 
 app = Flask(__name__)
 
+# F1 instances have 256 MB of memory
+MEMORY_BUDGET_MB = 200
 
-@app.route('/update/<string:exchange>/<string:entity_type>/')
-@app.route('/update/<string:exchange>/<string:entity_type>/<int:min_liquidity>/')
-def update(exchange, entity_type, min_liquidity=None):
-    logger = logging.getLogger(exchange)
-    if exchange == 'UNI_V2':
-        controller = Controller(Uniswap(dex_graph_name='benesjan/uniswap-v2', exchange=Exchange.UNI_V2), logger)
-    elif exchange == 'BALANCER':
-        controller = Controller(Balancer(), logger)
-    elif exchange == 'SUSHI':
-        controller = Controller(Uniswap(dex_graph_name='benesjan/sushi-swap', exchange=Exchange.SUSHI), logger)
-    elif exchange == 'MATERIA':
-        controller = Controller(Uniswap(dex_graph_name='materia-dex/materia', exchange=Exchange.MATERIA), logger)
-    else:
-        return '{"success": false, "exception": "Unknown exhchange type."}'
+# Background jobs running at once, each of them gets an equal share of the memory budget
+JOB_WORKERS = 4
+JOB_MEMORY_BUDGET_MB = MEMORY_BUDGET_MB / JOB_WORKERS
+
+ENTITY_TYPES = ('snaps', 'staked_snaps', 'yields', 'pools')
+
+# Background jobs stop at the last page boundary before the budget runs out, the next cron run resumes them
+JOB_TIME_BUDGET = 600
+
+# Time a scheduled job gets on top of its slice to drain its uploads
+SCHEDULED_JOB_DRAIN_SECONDS = 30
+
+# Storage layouts of the user snaps ('full' or 'compact') and of the pool snaps ('nodes', 'columnar'
+# or 'compressed'), see Controller, set in app.yaml
+SNAP_LAYOUT = os.environ.get('SNAP_LAYOUT', 'full')
+POOL_LAYOUT = os.environ.get('POOL_LAYOUT', 'nodes')
+
+job_runner = JobRunner(max_workers=JOB_WORKERS)
+
+
+def _create_dex(exchange: str) -> Optional[Dex]:
+    if exchange == 'BALANCER':
+        return Balancer()
+    fork = forks().get(exchange)
+    return fork.create_dex() if fork else None
+
+
+def _error(message: str) -> str:
+    return json.dumps({'success': False, 'exception': message})
+
+
+def _run_update(dex: Dex, entity_type: str, min_liquidity: Optional[int] = None,
+                time_budget: Optional[float] = None, progress: Optional[JobProgress] = None) -> Dict:
+    """
+    Returns the report of the update: whether it finished within the time budget, pages, predicted page cost
+    and how many blocks it is still behind when it didn't finish.
+    """
+    exchange = dex.exchange.name
+    # Spool is per job so that concurrent jobs of the same exchange don't interleave their checkpoints
+    controller = Controller(dex, logging.getLogger(exchange),
+                            spool_path=f'/tmp/upload-spool-{exchange}-{entity_type}.sqlite3',
+                            snap_layout=SNAP_LAYOUT, pool_layout=POOL_LAYOUT, memory_budget_mb=JOB_MEMORY_BUDGET_MB,
+                            aggregate=True, time_budget=time_budget, progress=progress)
     try:
         if entity_type == 'snaps':
             controller.update_snaps(max_objects_in_batch=100)
         elif entity_type == 'staked_snaps':
-            controller.update_staked_snaps(max_objects_in_batch=100)
+            # A stream per staking service, a lagging yield subgraph doesn't hold back the other services
+            controller.update_staked_snaps_by_service(max_objects_in_batch=100)
         elif entity_type == 'yields':
             controller.update_yields(max_objects_in_batch=100)
-        elif entity_type == 'pools':
-            if min_liquidity is None:
-                return '{"success": false, "exception": "None min_liquidity URL parameter in update of pools."}'
-            controller.update_pools(max_objects_in_batch=20, min_liquidity=min_liquidity)
         else:
-            return '{"success": false, "exception": "Unknown entity type."}'
+            controller.update_pools(max_objects_in_batch=20, min_liquidity=min_liquidity)
+    finally:
+        controller.close()
+    return controller.report
+
+
+def _submit_job(exchange: str, entity_type: str, min_liquidity: Optional[int] = None, profile=False,
+                time_budget: float = JOB_TIME_BUDGET) -> Tuple[Job, bool]:
+    """
+    Enqueues the update as a background job, an update already queued or running is not submitted again
+    (they would share the spool). Returns the job and whether it was created.
+    """
+    def run(progress: JobProgress) -> Dict:
+        profiler = SamplingProfiler(f'{exchange}-{entity_type}') if profile else None
+        with profiler or nullcontext():
+            report = _run_update(_create_dex(exchange), entity_type, min_liquidity, time_budget, progress)
+        if not profiler:
+            return report
+        artifact = profiler.write_folded()
+        logging.getLogger(exchange).info(f'Profile written to {artifact}')
+        return {**report, 'profile': {**profiler.report(), 'artifact': artifact}}
+
+    key = f'{exchange}/{entity_type}' if min_liquidity is None else f'{exchange}/{entity_type}/{min_liquidity}'
+    return job_runner.submit(key, run)
+
+
+def _submit_update(exchange: str, entity_type: str, min_liquidity: Optional[int] = None, profile=False) -> Dict:
+    job, created = _submit_job(exchange, entity_type, min_liquidity, profile)
+    return {'jobId': job.id, 'deduplicated': not created}
+
+
+@app.route('/update/<string:exchange>/<string:entity_type>/')
+@app.route('/update/<string:exchange>/<string:entity_type>/<int:min_liquidity>/')
+def update(exchange, entity_type, min_liquidity=None):
+    """
+    Returns the id of the background job running the update, its progress is reported by /jobs/<job_id>/.
+    With ?profile=1 (or X-Profile: 1 header) the job runs under a sampling profiler, the folded stacks
+    are written to /tmp/profiles and the job result contains a time breakdown by stage.
+    """
+    if exchange != 'BALANCER' and exchange not in forks():
+        return _error('Unknown exchange type.')
+    if entity_type not in ENTITY_TYPES:
+        return _error('Unknown entity type.')
+    if entity_type == 'pools' and min_liquidity is None:
+        return _error('None min_liquidity URL parameter in update of pools.')
+    profile = request.args.get('profile') == '1' or request.headers.get('X-Profile') == '1'
+    return json.dumps({'success': True, **_submit_update(exchange, entity_type, min_liquidity, profile)})
+
+
+@app.route('/jobs/<string:job_id>/')
+def job_status(job_id):
+    """
+    Status, progress (pages, objects, highest uploaded block, throughput) and result of a background job.
+    Jobs are kept in the memory of the instance which ran them.
+    """
+    job = job_runner.get(job_id)
+    if job is None:
+        return _error('Unknown job.'), 404
+    return json.dumps({'success': True, 'job': job.to_serializable()})
+
+
+def _run_scheduled_job(exchange: str, entity_type: str, time_budget: float) -> bool:
+    """
+    Runs through the job runner, a slice of a job which is already running (e.g. from cron) waits for it
+    instead of running next to it. A job which didn't end within the slice is reported as unfinished.
+    """
+    job, _ = _submit_job(exchange, entity_type, time_budget=time_budget)
+    if not job.wait(time_budget + SCHEDULED_JOB_DRAIN_SECONDS):
+        return False
+    if job.error is not None:
+        raise RuntimeError(job.error)
+    return job.result['finished']
+
+
+@app.route('/schedule/')
+def schedule():
+    """
+    Alternative to the fixed cron schedules of snap, staked snap and yield updates, runs the jobs
+    with the largest lag first (see src/scheduler.py).
+    """
+    scheduler = LagScheduler(shared_storage(), logging.getLogger('SCHEDULER'), _create_dex, _run_scheduled_job)
+    try:
+        report = scheduler.run(time_budget=480)
+    except Exception as e:
+        return _error(str(e))
+    return json.dumps({'success': True, 'jobs': report})
+
+
+@app.route('/forks/<string:entity_type>/')
+@app.route('/forks/<string:entity_type>/<int:min_liquidity>/')
+def update_forks(entity_type, min_liquidity=None):
+    """
+    Submits the job of every fork in the registry (forks.json) which has the entity type, the jobs run
+    concurrently and share the HTTP connections, token registry and price caches of the process.
+    Only the forks of the cron group given by ?group= (default group by default) are updated, so that
+    every group keeps its own schedule.
+    Pools are updated above the min liquidity of each fork, min_liquidity raises it.
+    """
+    if entity_type not in ENTITY_TYPES:
+        return _error('Unknown entity type.')
+    group = request.args.get('group', DEFAULT_GROUP)
+    jobs = {}
+    for exchange, fork in forks().items():
+        if entity_type in fork.jobs and fork.group == group:
+            fork_min_liquidity = max(fork.min_liquidity, min_liquidity or 0) if entity_type == 'pools' else None
+            jobs[exchange] = _submit_update(exchange, entity_type, fork_min_liquidity)
+    return json.dumps({'success': True, 'jobs': jobs})
+
+
+@app.route('/backfill/<string:exchange>/pools/<int:first_day_id>/<int:last_day_id>/<int:min_liquidity>/')
+def backfill_pools(exchange, first_day_id, last_day_id, min_liquidity):
+    """
+    Returns the id of the background job running the backfill, a backfill interrupted by the time budget
+    resumes from its day checkpoint when the same range is submitted again. Days older than the retention
+    window would be deleted by the next retention sweep and are rejected. One backfill of an exchange runs
+    at a time, a range other than the one of the running backfill is rejected.
+    """
+    if exchange != 'BALANCER' and exchange not in forks():
+        return _error('Unknown exchange type.')
+    today = int(time.time() / 86400)
+    if not first_day_id <= last_day_id <= today:
+        return _error('Invalid day range, last_day_id must be between first_day_id and today.')
+    if first_day_id < today - RETENTION_DAYS:
+        return _error(f'Invalid day range, days before {today - RETENTION_DAYS} are deleted by the retention '
+                      f'sweep ({RETENTION_DAYS} days).')
+
+    def run(progress: JobProgress) -> Dict:
+        controller = Controller(_create_dex(exchange), logging.getLogger(exchange),
+                                spool_path=f'/tmp/upload-spool-{exchange}-pool-backfill.sqlite3',
+                                pool_layout=POOL_LAYOUT, memory_budget_mb=JOB_MEMORY_BUDGET_MB,
+                                time_budget=JOB_TIME_BUDGET, progress=progress)
+        try:
+            controller.backfill_pools(first_day_id, last_day_id, max_objects_in_batch=1000,
+                                      min_liquidity=min_liquidity)
+        finally:
+            controller.close()
+        return controller.report
+
+    params = {'firstDayId': first_day_id, 'lastDayId': last_day_id, 'minLiquidity': min_liquidity}
+    # The backfills of an exchange share the spool and the day checkpoint
+    job, created = job_runner.submit(f'{exchange}/pool-backfill', run, params)
+    if job.params != params:
+        return _error(f'Backfill {job.id} of days {job.params["firstDayId"]}-{job.params["lastDayId"]} '
+                      f'is running.')
+    return json.dumps({'success': True, 'jobId': job.id, 'deduplicated': not created})
+
+
+@app.route('/retention/poolSnaps/')
+def pool_snap_retention():
+    try:
+        finished = PoolSnapRetention(shared_storage(), logging.getLogger('RETENTION')).sweep(time_budget=480)
     except Exception as e:
-        return f'{"success": false, "exception": {e}}'
-    return '{"success": true}'
+        return _error(str(e))
+    return json.dumps({'success': True, 'finished': finished})
 
 
 if __name__ == '__main__':
@@ -0,0 +1,36 @@
+"""
+Catches up the Balancer snaps of a sink far behind the subgraph (e.g. a new SQLite sink) on a multi-core
+machine. Pages of page_size snaps are parsed in a process pool of parse_workers processes, the cron updates
+run with 100 snap pages on a single core and parse them in-process.
+The sink is selected by STORAGE_BACKEND (src/storage.py), the update resumes from lastUpdate/BALANCER/snaps.
+
+Usage: python -m src.backfill_snaps [--parse-workers N] [--page-size N]
+"""
+import argparse
+import logging
+import os
+
+from src.balancer.balancer import Balancer
+from src.controller import Controller
+
+
+def backfill(logger, parse_workers: int, page_size: int) -> bool:
+    if page_size < Balancer.MIN_PARALLEL_PARSE_PAGE:
+        logger.warning(f'Pages smaller than {Balancer.MIN_PARALLEL_PARSE_PAGE} snaps are parsed in-process')
+    controller = Controller(Balancer(parse_workers), logger, snap_layout=os.environ.get('SNAP_LAYOUT', 'full'),
+                            aggregate=True)
+    try:
+        return controller.update_snaps(max_objects_in_batch=page_size)
+    finally:
+        controller.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Catch up the Balancer snaps with the snapshot pages parsed '
+                                                 'in a process pool.')
+    parser.add_argument('--parse-workers', type=int, default=os.cpu_count())
+    # The subgraph returns at most 1000 entities per query
+    parser.add_argument('--page-size', type=int, default=1000)
+    args = parser.parse_args()
+    backfill(logging.getLogger('BACKFILL'), args.parse_workers, args.page_size)
@@ -1,9 +1,104 @@
+from concurrent.futures import ProcessPoolExecutor
 from decimal import Decimal
-from typing import List, Dict, Iterable, Callable
+from multiprocessing import get_context
+from typing import List, Dict, Iterable, Callable, Optional, Set, Tuple
 
+from src.balancer.parsing import compact_snap, parse_compact_snap, parse_token
 from src.balancer.queries import _eth_prices_query_generator, _bal_prices_query_generator
+from src.query_planner import QueryPlanner
+from src.query_template import QueryTemplate
 from src.shared.Dex import Dex
-from src.shared.type_definitions import ShareSnap, CurrencyField, PoolToken, Exchange, Pool, StakingService
+from src.shared.type_definitions import ShareSnap, PoolToken, Exchange, Pool, StakingService, PoolContext
+
+
+SNAPS_QUERY = QueryTemplate('BalancerSnaps', {'first': 'Int!', 'skip': 'Int!', 'block': 'Int!'}, '''
+{
+    snaps: poolShareSnapshots(first: $first, skip: $skip, orderBy: block, orderDirection: asc, where: {block_gte: $block}) {
+        id
+        pool {
+            id
+            totalWeight
+        }
+        user {
+            id
+        }
+        balance
+        tokenSnapshots {
+            balance
+            token {
+                address
+                balance
+                denormWeight
+            }
+        }
+        liquidity
+        totalShares
+        txHash
+        block
+        timestamp
+        gasUsed
+        gasPrice
+    }
+}
+''')
+
+POOLS_QUERY = QueryTemplate('BalancerPools', {'first': 'Int!', 'skip': 'Int!', 'minLiquidity': 'BigDecimal!'}, '''
+{
+    pools(first: $first, skip: $skip, orderBy: liquidity, orderDirection: desc, where: {liquidity_gte: $minLiquidity}) {
+        id
+        totalWeight
+        totalShares
+        liquidity
+        swapFee
+        totalSwapVolume
+        tokens {
+            address
+            denormWeight
+            balance
+        }
+    }
+}
+''')
+
+POOL_PAGE_QUERY = QueryTemplate(
+    'BalancerPoolPage', {'first': 'Int!', 'block': 'Int!', 'minLiquidity': 'BigDecimal!', 'lastId': 'ID!'}, '''
+{
+    pools(first: $first, orderBy: id, orderDirection: asc, block: {number: $block}, where: {liquidity_gte: $minLiquidity, id_gt: $lastId}) {
+        id
+        totalWeight
+        totalShares
+        liquidity
+        swapFee
+        totalSwapVolume
+        tokens {
+            address
+            denormWeight
+            balance
+        }
+    }
+}
+''')
+
+LIQUIDITY_BAND_PAGE_QUERY = QueryTemplate(
+    'BalancerLiquidityBandPage',
+    {'first': 'Int!', 'block': 'Int!', 'minLiquidity': 'BigDecimal!', 'maxLiquidity': 'BigDecimal!', 'lastId': 'ID!'},
+    '''
+{
+    pools(first: $first, orderBy: id, orderDirection: asc, block: {number: $block}, where: {liquidity_gte: $minLiquidity, liquidity_lt: $maxLiquidity, id_gt: $lastId}) {
+        id
+        totalWeight
+        totalShares
+        liquidity
+        swapFee
+        totalSwapVolume
+        tokens {
+            address
+            denormWeight
+            balance
+        }
+    }
+}
+''')
 
 
 class Balancer(Dex):
@@ -11,92 +106,57 @@ class Balancer(Dex):
     A handler for Balancer DEX.
     """
 
-    def __init__(self):
+    # Smaller pages are parsed in-process, the pickling overhead is not worth it
+    MIN_PARALLEL_PARSE_PAGE = 200
+
+    def __init__(self, parse_workers: int = 0):
+        """
+        With parse_workers > 0 snapshot pages of at least MIN_PARALLEL_PARSE_PAGE snaps are parsed in a process
+        pool, used by the snap backfill (src/backfill_snaps.py). The workers are spawned (a fork would copy
+        the threads of the job) on the first large page and shut down by close().
+        """
         super().__init__('benesjan/balancer-with-snapshots', Exchange.BALANCER, eth_price_first_block=9783867)
         # rewards start at 10322999 but at that point the prices are not yet in the graph
         self.bal_price_first_block = 10323092
+        self.parse_workers = parse_workers
+        self._parse_executor: Optional[ProcessPoolExecutor] = None
 
     def fetch_new_snaps(self, last_block_update: int, max_objects_in_batch: int) -> Iterable[List[ShareSnap]]:
-        query = '''{
-            snaps: poolShareSnapshots(first: $MAX_OBJECTS, skip: $SKIP, orderBy: block, orderDirection: asc, where: {block_gte: $BLOCK}) {
-                id
-                pool {
-                    id
-                    totalWeight
-                }
-                user {
-                    id
-                }
-                balance
-                tokenSnapshots {
-                    balance
-                    token {
-                        symbol
-                        name
-                        address
-                        balance
-                        denormWeight
-                    }
-                }
-                liquidity
-                totalShares
-                txHash
-                block
-                timestamp
-                gasUsed
-                gasPrice
-            }
-        }'''
-        skip = 0
-        while True:
-            params = {
-                '$MAX_OBJECTS': max_objects_in_batch,
-                '$SKIP': skip,
-                '$BLOCK': last_block_update,
-            }
-            raw_snaps = self.dex_graph.query(query, params)['data']['snaps']
-            if not raw_snaps:
-                break
-            snaps = [self._parse_snap(snap) for snap in raw_snaps]
-            if snaps:
-                self._populate_eth_prices(snaps)
-                self._populate_bal_prices(snaps)
+        yield from self._fetch_snap_pages(SNAPS_QUERY, {'block': last_block_update}, max_objects_in_batch,
+                                          self._parse_snaps)
 
-            yield snaps
-            skip += max_objects_in_batch
+    def _parse_snaps(self, raw_snaps: List[Dict]) -> List[ShareSnap]:
+        self._resolve_tokens(token_snap['token']['address'] for snap in raw_snaps
+                             for token_snap in snap['tokenSnapshots'])
+        compact_snaps = [compact_snap(snap, self.token_registry) for snap in raw_snaps]
+        if self.parse_workers > 0 and len(compact_snaps) >= self.MIN_PARALLEL_PARSE_PAGE:
+            if self._parse_executor is None:
+                self._parse_executor = ProcessPoolExecutor(max_workers=self.parse_workers,
+                                                           mp_context=get_context('spawn'))
+            chunksize = max(1, len(compact_snaps) // (4 * self.parse_workers))
+            # map() returns the results in the order of the input
+            return list(self._parse_executor.map(parse_compact_snap, compact_snaps, chunksize=chunksize))
+        return [parse_compact_snap(snap) for snap in compact_snaps]
 
-    def _parse_snap(self, snap: Dict) -> ShareSnap:
-        pool = snap['pool']
-        total_weight = Decimal(pool['totalWeight'])
-        reserves_usd = Decimal(snap['liquidity'])
-        tokens: List[PoolToken] = []
-        for tokenSnap in snap['tokenSnapshots']:
-            token = tokenSnap['token']
-            # Replace token reserves with the one from token snap
-            token['balance'] = tokenSnap['balance']
-            tokens.append(self._parse_token(token, total_weight, reserves_usd))
-        return ShareSnap(
-            snap['id'],
-            self.exchange,
-            snap['user']['id'],
-            pool['id'],
-            snap['balance'],
-            snap['totalShares'],
-            tokens,
-            snap['block'],
-            snap['timestamp'],
-            snap['txHash'],
-            Decimal(snap['gasPrice']) * Decimal(snap['gasUsed']) * Decimal('1E-18')
-        )
+    def close(self):
+        if self._parse_executor:
+            self._parse_executor.shutdown()
+            self._parse_executor = None
+
+    def _plan_prices(self, planner: QueryPlanner, blocks: Set[int]):
+        super()._plan_prices(planner, blocks)
+        blocks = {block for block in blocks if block >= self.bal_price_first_block}
+        if blocks:
+            planner.add('bal_prices', ''.join(_bal_prices_query_generator(blocks)))
 
-    def _populate_bal_prices(self, snaps: List[ShareSnap]):
-        relevant_snaps = [snap for snap in snaps if snap.block >= self.bal_price_first_block]
-        if not relevant_snaps:
+    def _apply_prices(self, snaps: List[ShareSnap], results: Dict[str, Dict]):
+        super()._apply_prices(snaps, results)
+        if 'bal_prices' not in results:
             return
-        blocks = {snap.block for snap in relevant_snaps}
-        bal_prices = self._get_yield_token_prices(blocks)
-        for snap in relevant_snaps:
-            snap.yield_token_price = bal_prices[snap.block]
+        bal_prices = self._parse_prices(results['bal_prices'])
+        for snap in snaps:
+            if snap.block >= self.bal_price_first_block:
+                snap.yield_token_price = bal_prices[snap.block]
 
     def _get_yield_token_prices(self, blocks: Iterable[int]) -> Dict[int, Decimal]:
         """
@@ -105,47 +165,52 @@ class Balancer(Dex):
         """
         query = ''.join(_bal_prices_query_generator(blocks))
         data = self.dex_graph.query(query, {})
-        return {int(block[1:]): Decimal(price['price']) for
-                block, price in data['data'].items()}
+        return self._parse_prices(data['data'])
 
     def _get_eth_prices_query_generator(self) -> Callable[[Iterable[int]], Iterable[str]]:
         return _eth_prices_query_generator
 
     def fetch_pools(self, max_objects_in_batch: int, min_liquidity: int, skip: int = 0) -> Iterable[List[Pool]]:
-        query = '''{
-            pools(first: $MAX_OBJECTS, skip: $SKIP, orderBy: liquidity, orderDirection: desc, where: {liquidity_gte: $MIN_LIQUIDITY}) {
-                id
-                totalWeight
-                totalShares
-                liquidity
-                swapFee
-                totalSwapVolume
-                tokens {
-                    symbol
-                    name
-                    address
-                    denormWeight
-                    balance
-                }
-            }
-        }'''
-        highest_indexed_block = self.get_highest_indexed_block(self.dex_graph)
-        eth_price = self._get_eth_usd_prices([highest_indexed_block])[highest_indexed_block]
-        yield_token_price = self._get_yield_token_prices([highest_indexed_block])[highest_indexed_block]
+        context = self._get_pool_context()
         while True:
-            params = {
-                '$MAX_OBJECTS': max_objects_in_batch,
-                '$SKIP': skip,
-                '$MIN_LIQUIDITY': min_liquidity,
+            variables = {
+                'first': max_objects_in_batch,
+                'skip': skip,
+                'minLiquidity': str(min_liquidity),
             }
-            raw_pools = self.dex_graph.query(query, params)['data']['pools']
+            raw_pools = self.dex_graph.query(POOLS_QUERY, variables)['data']['pools']
             if not raw_pools:
                 break
 
-            yield [self._parse_pool(pool, highest_indexed_block, eth_price, yield_token_price) for pool in raw_pools]
+            yield self._parse_pools(raw_pools, context)
             skip += max_objects_in_batch
 
-    def _parse_pool(self, raw_pool: Dict, block: int, eth_price: Decimal, yield_token_price: Decimal) -> Pool:
+    def _get_pool_context(self) -> PoolContext:
+        highest_indexed_block = self.get_highest_indexed_block(self.dex_graph)
+        return self._get_pool_contexts([highest_indexed_block])[highest_indexed_block]
+
+    def _get_pool_contexts(self, blocks: Iterable[int]) -> Dict[int, PoolContext]:
+        blocks = set(blocks)
+        eth_prices = self._get_eth_usd_prices(blocks)
+        bal_blocks = {block for block in blocks if block >= self.bal_price_first_block}
+        bal_prices = self._get_yield_token_prices(bal_blocks) if bal_blocks else {}
+        return {block: PoolContext(block, eth_prices[block],
+                                   {StakingService.BALANCER: bal_prices[block]} if block in bal_prices else {})
+                for block in blocks}
+
+    def _pool_page_query(self, block: int, max_objects_in_batch: int, min_liquidity: int,
+                         max_liquidity: Optional[int], last_id: str) -> Tuple[QueryTemplate, Dict]:
+        variables = {
+            'first': max_objects_in_batch,
+            'block': block,
+            'minLiquidity': str(min_liquidity),
+            'lastId': last_id,
+        }
+        if max_liquidity is None:
+            return POOL_PAGE_QUERY, variables
+        return LIQUIDITY_BAND_PAGE_QUERY, {**variables, 'maxLiquidity': str(max_liquidity)}
+
+    def _parse_pool(self, raw_pool: Dict, context: PoolContext) -> Pool:
         total_weight = Decimal(raw_pool['totalWeight'])
         reserves_usd = Decimal(raw_pool['liquidity'])
         tokens: List[PoolToken] = []
@@ -156,26 +221,37 @@ class Balancer(Dex):
             self.exchange,
             Decimal(raw_pool['totalShares']),
             tokens,
-            block,
-            eth_price,
+            context.block,
+            context.eth_price,
             raw_pool['totalSwapVolume'],
-            {StakingService.BALANCER: yield_token_price},
+            context.relevant_yield_token_prices,
             Decimal(raw_pool['swapFee'])
         )
 
     def _parse_token(self, token: Dict, total_weight: Decimal, reserves_usd: Decimal) -> PoolToken:
-        token_weight = Decimal(token['denormWeight']) / total_weight
-        token_reserve = Decimal(token['balance'])
-        price_usd = reserves_usd * token_weight / token_reserve if token_reserve != 0 else 0
-        return PoolToken(
-            CurrencyField(symbol=token['symbol'],
-                          name=token['name'],
-                          contract_address=token['address'],
-                          platform='ethereum'),
-            token_weight,
-            token_reserve,
-            price_usd
-        )
+        currency = self.token_registry.get(token['address'])
+        return parse_token(currency.symbol, currency.name, token['address'], token['balance'], token['denormWeight'],
+                           total_weight, reserves_usd)
+
+    def _pool_token_addresses(self, raw_pools: List[Dict]) -> Iterable[str]:
+        return [token['address'] for pool in raw_pools for token in pool['tokens']]
+
+    def _lookup_tokens(self, addresses: List[str]) -> Dict[str, Tuple[str, str]]:
+        """
+        Token metadata are stored in pool tokens, one pool token of each address is queried.
+        """
+        found = {}
+        for i in range(0, len(addresses), 100):
+            query = '{' + ''.join(f'''
+                a{j}: poolTokens(first: 1, where: {{address: "{address}"}}) {{
+                    address
+                    symbol
+                    name
+                }}''' for j, address in enumerate(addresses[i:i + 100])) + '}'
+            for pool_tokens in self.dex_graph.query(query)['data'].values():
+                for token in pool_tokens:
+                    found[token['address']] = (token['symbol'], token['name'])
+        return found
 
     def fetch_new_staked_snaps(self, last_block_update: int, max_objects_in_batch: int) -> Iterable[List[ShareSnap]]:
         raise NotImplementedError
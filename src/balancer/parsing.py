@@ -0,0 +1,76 @@
+from decimal import Decimal
+from typing import Dict, Tuple
+
+from src.shared.token_registry import TokenRegistry
+from src.shared.type_definitions import ShareSnap, CurrencyField, PoolToken, Exchange
+
+# Compact transfer format of a pool share snapshot (cheap to pickle when sent to a worker process):
+# (id, pool_id, total_weight, user, balance, total_shares, liquidity, block, timestamp, tx_hash, gas_price, gas_used,
+#  ((symbol, name, address, balance, denorm_weight), ...))
+CompactSnap = Tuple
+
+
+def compact_snap(snap: Dict, token_registry: TokenRegistry) -> CompactSnap:
+    """
+    Converts raw poolShareSnapshot into the compact format. Token reserves are taken
+    from token snapshots instead of the current pool token balances, token metadata
+    from the registry (it has to be resolved beforehand).
+    """
+    pool = snap['pool']
+    tokens = [(token_registry.get(token_snap['token']['address']), token_snap)
+              for token_snap in snap['tokenSnapshots']]
+    return (
+        snap['id'],
+        pool['id'],
+        pool['totalWeight'],
+        snap['user']['id'],
+        snap['balance'],
+        snap['totalShares'],
+        snap['liquidity'],
+        snap['block'],
+        snap['timestamp'],
+        snap['txHash'],
+        snap['gasPrice'],
+        snap['gasUsed'],
+        tuple((currency.symbol, currency.name, currency.contract_address, token_snap['balance'],
+               token_snap['token']['denormWeight']) for currency, token_snap in tokens)
+    )
+
+
+def parse_compact_snap(compact: CompactSnap) -> ShareSnap:
+    """
+    Module level so that it can be executed in a worker process.
+    """
+    (id_, pool_id, total_weight, user, balance, total_shares, liquidity, block, timestamp, tx_hash, gas_price,
+     gas_used, tokens) = compact
+    total_weight, reserves_usd = Decimal(total_weight), Decimal(liquidity)
+    return ShareSnap(
+        id_,
+        Exchange.BALANCER,
+        user,
+        pool_id,
+        balance,
+        total_shares,
+        [parse_token(symbol, name, address, token_balance, denorm_weight, total_weight, reserves_usd)
+         for symbol, name, address, token_balance, denorm_weight in tokens],
+        block,
+        timestamp,
+        tx_hash,
+        Decimal(gas_price) * Decimal(gas_used) * Decimal('1E-18')
+    )
+
+
+def parse_token(symbol: str, name: str, address: str, balance: str, denorm_weight: str, total_weight: Decimal,
+                reserves_usd: Decimal) -> PoolToken:
+    token_weight = Decimal(denorm_weight) / total_weight
+    token_reserve = Decimal(balance)
+    price_usd = reserves_usd * token_weight / token_reserve if token_reserve != 0 else 0
+    return PoolToken(
+        CurrencyField(symbol=symbol,
+                      name=name,
+                      contract_address=address,
+                      platform='ethereum'),
+        token_weight,
+        token_reserve,
+        price_usd
+    )
@@ -1,34 +1,231 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Optional
-
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import db
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Union
 
+from src.jobs import JobProgress
+from src.profiling import inherit_profiler
 from src.shared.Dex import Dex
-from src.shared.type_definitions import ShareSnap, YieldReward, Pool, StakingService
+from src.shared.aggregates import PositionAggregate, YieldAggregate, position_aggregate_node, yield_aggregate_key
+from src.shared.deadline import Deadline
+from src.shared.memory import MemoryBudget
+from src.shared.pool_bands import default_band_edges, balanced_band_edges
+from src.shared.pipeline import prefetch
+from src.shared.pool_days import PoolDayChunks
+from src.shared.recent_ids import RecentIds
+from src.shared.type_definitions import ShareSnap, YieldReward, Pool, StakingService, pool_metadata_key
+from src.spool import UploadSpool
+from src.storage import Storage, shared_storage
+from src.subgraph import SubgraphReader
+from src.uploader import ShardedUploader
 
 
 class Controller:
-    def __init__(self, instance: Dex, logger, snap_index=''):
+    POOL_BAND_COUNT = 4
+    RECENT_ID_CAPACITY = 10000
+    # Bounded buffers of the ingestion stages: pages fetched (and parsed) ahead of the upload
+    # and serialized pages waiting for their writes
+    PREFETCH_PAGES = 1
+    UPLOAD_BUFFER_PAGES = 2
+    # Days fetched by one step of a backfill (groups of days are fetched in parallel within a step)
+    BACKFILL_DAYS_PER_STEP = 20
+    # Aggregates kept in memory between the pages (each of them holds the latest snap of its position)
+    AGGREGATE_CACHE_SIZE = 2000
+
+    def __init__(self, instance: Dex, logger, snap_index='', spool_path: Optional[str] = None,
+                 snap_layout: str = 'full', memory_budget_mb: Optional[float] = None, aggregate=False,
+                 upload_workers=8, max_requests_per_second: Optional[float] = None,
+                 time_budget: Optional[float] = None, storage: Optional[Storage] = None,
+                 progress: Optional[JobProgress] = None, pool_layout: str = 'nodes'):
+        """
+        snap_layout 'full' writes complete snaps to users/{addr}/{exchange}/snaps, 'compact' writes snaps
+        referencing pool metadata to users/{addr}/{exchange}/compactSnaps and the metadata to
+        poolMetadata/{exchange}/{pool_id}_{metadata_id} (versioned by the token list of the pool).
+        pool_layout 'nodes' writes a node per pool and day to poolSnaps/{pool_id}/{day_id}, 'columnar' and
+        'compressed' write column-wise chunks of pools (compressed to a blob) to poolDays/{exchange}/{day_id}
+        and the pool metadata to poolMetadata/{exchange}/{pool_id}_{metadata_id}, see src/shared/pool_days.py.
+        The chunks of a day are accumulated over the pages and uploaded when the update (or its step) is over.
+        Metadata are written only for the token lists of pools which don't have them stored yet.
+        With memory_budget_mb the page size is reduced as the RSS growth of the job approaches the budget.
+        The next page is fetched while the current one is uploaded and at most UPLOAD_BUFFER_PAGES pages wait
+        for their writes, the peak RSS is a part of the report.
+        With aggregate set, per-user per-pool aggregates (users/{addr}/{exchange}/aggregates,
+        stakedAggregates/{service} and yieldAggregates) are updated in the same update as the snaps and yields.
+        An existing sink has to be backfilled by src/migrations/aggregates.py first
+        (lastUpdate/{exchange}/aggregatesBackfilled), until then the aggregates are not updated. At most
+        AGGREGATE_CACHE_SIZE aggregates are cached between the pages.
+        Writes are sharded by user address over upload_workers threads, optionally rate limited.
+        With time_budget (seconds) the updates stop at the page boundary (after the checkpoint of the page)
+        when the next page is predicted not to fit into the budget and report that they did not finish,
+        the next run resumes from the checkpoint. The report of the last update is kept in self.report.
+        Data are written to the storage selected by STORAGE_BACKEND unless the storage is given.
+        Uploaded pages are reported to the progress of a background job.
+        """
+        assert snap_layout in ('full', 'compact'), f'Unknown snap layout: {snap_layout}'
+        assert pool_layout in ('nodes', 'columnar', 'compressed'), f'Unknown pool layout: {pool_layout}'
+        self.deadline = Deadline(time_budget)
+        self.report: Dict = {}
+        self.progress = progress
         self.instance = instance
+        self.instance.memory_budget = MemoryBudget(memory_budget_mb)
         self.logger = logger
         self.snap_index = snap_index
+        self.snap_layout = snap_layout
+        self.pool_layout = pool_layout
+        # Keys of the stored pool metadata (of every version), read on first use
+        self._stored_pool_metadata: Optional[Set[str]] = None
+        # Pools of each day not uploaded yet and the checkpoints covering them (columnar pool layouts)
+        self._pool_days: Dict[int, PoolDayChunks] = {}
+        self._pool_checkpoints: Dict[str, Any] = {}
+        self.aggregate = aggregate
+        # Aggregates read or updated during this run by path, evicted by _evict_aggregates
+        self._aggregates = {}
+        self._aggregate_reader: Optional[ThreadPoolExecutor] = None
+        self.upload_workers = upload_workers
+        # Serializes the uploads of the staked snap streams, they share the aggregates and checkpoints
+        self._upload_lock = threading.Lock()
         self.exchange_name = str(instance.exchange.name)
-        if not firebase_admin._apps:
-            cred = credentials.Certificate('serviceAccountKey.json')
-            firebase_admin.initialize_app(cred, {
-                'databaseURL': 'https://croco-finance-a02aa.firebaseio.com/'
-                # 'databaseURL': 'https://croco-finance.firebaseio.com/'
-            })
-        self.root_ref = db.reference('/')
-        self.last_update_ref = self.root_ref.child('lastUpdate').child(self.exchange_name)
-        self.last_update = self.last_update_ref.get()
-
-    def update_snaps(self, max_objects_in_batch):
+        self.storage = storage or shared_storage()
+        self.uploader = ShardedUploader(self.storage.update, upload_workers, max_requests_per_second,
+                                        self.UPLOAD_BUFFER_PAGES)
+        self.spool = None
+        if spool_path:
+            self.spool = UploadSpool(spool_path, self.uploader.write_sync)
+            # Leftovers of a failed run contain checkpoints which have to land before lastUpdate is read
+            try:
+                self.spool.flush()
+            except Exception:
+                self.close()
+                raise
+        # A new local sink starts from the first block
+        self.last_update = self.storage.get(f'lastUpdate/{self.exchange_name}') or {}
+        if self.aggregate:
+            self._init_aggregates()
+
+    def close(self):
+        """
+        Releases the spool (its drainer thread, connection and file lock), the threads of the uploader
+        and the workers of the instance, called once the run is over.
+        """
+        if self.spool:
+            self.spool.close()
+        self.uploader.close()
+        self.instance.close()
+        if self._aggregate_reader:
+            self._aggregate_reader.shutdown()
+
+    def _write(self, updates: Dict):
+        """
+        Write a multi-path update either directly or through the spool.
+        """
+        if self.spool:
+            self.spool.append(updates)
+        else:
+            self.uploader.write(updates)
+
+    def _drain_writes(self):
+        """
+        Waits until all the updates written so far are stored.
+        """
+        if self.spool:
+            self.spool.flush()
+        self.uploader.flush()
+
+    def _commit_checkpoint(self, key: str, value):
+        """
+        Write lastUpdate value. When spooling, it gets written after all the previously spooled data.
+        """
+        *parents, leaf = key.split('/')
+        node = self.last_update
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[leaf] = value
+        updates = {f'lastUpdate/{self.exchange_name}/{key}': value}
+        if self.spool:
+            self.spool.append(updates)
+        else:
+            self.uploader.write_checkpoint(updates)
+
+    def _start_dedup(self, checkpoint_key: str, instance: Optional[Dex] = None):
+        """
+        Fetching resumes at the checkpointed block, the entities of the block which were already processed
+        are known from the resume token in lastUpdate/{exchange}/resume.
+        """
+        token = (self.last_update.get('resume') or {}).get(checkpoint_key) or {}
+        ids = token.get('ids', []) if token.get('block') == self.last_update.get(checkpoint_key, 0) else []
+        (instance or self.instance).recent_ids = RecentIds(max(self.RECENT_ID_CAPACITY, len(ids)), ids)
+
+    def _resume_token(self, checkpoint_key: str, entities: List) -> Dict:
+        """
+        Ids of all the entities processed at the highest block of the entities, including the previous pages.
+        """
+        highest_block = max(entity.block for entity in entities)
+        ids = [entity.id for entity in entities if entity.block == highest_block]
+        token = (self.last_update.get('resume') or {}).get(checkpoint_key) or {}
+        if token.get('block') == highest_block:
+            previous_ids = set(token['ids'])
+            ids = token['ids'] + [id_ for id_ in ids if id_ not in previous_ids]
+        return {'block': highest_block, 'ids': ids}
+
+    def _report_page(self, entities: List):
+        if self.progress:
+            self.progress.page_uploaded(len(entities), max(entity.block for entity in entities))
+
+    def _out_of_time(self, deadline: Optional[Deadline] = None) -> bool:
+        """
+        Called at the end of every page, after its checkpoint was committed.
+        """
+        deadline = deadline or self.deadline
+        deadline.page_done()
+        if deadline.exhausted():
+            self.logger.info(f'Next page predicted to take {deadline.predicted_page_cost:.1f} s, '
+                             f'{deadline.remaining:.1f} s left, yielding after the last checkpoint')
+            return True
+        return False
+
+    def _finish(self, finished=True, checkpoint_key: Optional[str] = None, graph: Optional[SubgraphReader] = None
+                ) -> bool:
+        """
+        Drains the uploads and reports the update. An unfinished update with a block checkpoint reports
+        how many blocks it is behind the graph it reads from.
+        """
+        if self.spool:
+            self.logger.info(f'Draining {self.spool.pending()} spooled uploads')
+        self._drain_writes()
+        memory_budget = self.instance.memory_budget
+        memory_budget.sample()
+        self.logger.info(f'Job finished, peak RSS: {memory_budget.peak_mb:.1f} MB')
+        self.report = {
+            'finished': finished,
+            'pages': self.deadline.pages,
+            'pageSeconds': round(self.deadline.page_cost or 0, 2),
+            'peakRssMb': round(memory_budget.peak_mb, 1),
+            'rssGrowthMb': round(max(memory_budget.peak_mb - memory_budget.baseline_mb, 0), 1),
+        }
+        memory_budget.reset()
+        if not finished and checkpoint_key and graph:
+            checkpoint = self.last_update.get(checkpoint_key, 0)
+            try:
+                highest_block = self.instance.get_highest_indexed_block(graph)
+            except Exception:
+                self.logger.exception('Failed to fetch the highest indexed block')
+                return finished
+            lag = max(highest_block - checkpoint, 0)
+            self.report.update(checkpointBlock=checkpoint, highestIndexedBlock=highest_block, lagBlocks=lag)
+            self.logger.info(f'{lag} blocks behind the subgraph')
+        return finished
+
+    def update_snaps(self, max_objects_in_batch) -> bool:
+        """
+        Returns False when the update was interrupted by the time budget.
+        """
         self.logger.info('SNAP UPDATE INITIATED')
+        checkpoint_key = f'snaps{self.snap_index}'
+        self._start_dedup(checkpoint_key)
+        self.deadline.start()
         prev_lowest, prev_highest = 1000000000, 0
-        for snaps in self.instance.fetch_new_snaps(self.last_update[f'snaps{self.snap_index}'], max_objects_in_batch):
+        for snaps in prefetch(self.instance.fetch_new_snaps(self.last_update.get(checkpoint_key, 0),
+                                                            max_objects_in_batch), self.PREFETCH_PAGES):
             if snaps:
                 lowest, highest = self._get_lowest_highest_block(snaps)
                 self.logger.info(f'Lowest block: {lowest}, highest block: {highest}')
@@ -36,33 +233,235 @@ class Controller:
                                                f'prev_highest: {prev_highest}, lowest: {lowest}'
                 prev_lowest, prev_highest = lowest, highest
                 self._upload_snaps(snaps)
+            if self._out_of_time():
+                return self._finish(False, checkpoint_key, self.instance.dex_graph)
+        return self._finish()
 
-    def update_staked_snaps(self, max_objects_in_batch, staking_service: Optional[StakingService] = None):
+    def update_staked_snaps(self, max_objects_in_batch, staking_service: Optional[StakingService] = None) -> bool:
         self.logger.info('STAKED SNAP UPDATE INITIATED')
+        self.deadline.start()
+        finished = self._update_staked_stream(max_objects_in_batch, 'stakedSnaps', self.instance, self.deadline,
+                                              staking_service)
+        return self._finish(finished, 'stakedSnaps', self.instance.rewards_graph)
+
+    def update_staked_snaps_by_service(self, max_objects_in_batch,
+                                       staking_services: Optional[List[StakingService]] = None) -> bool:
+        """
+        Fetches the stake positions of every staking service (those of the instance by default) in a stream
+        of its own, the streams run in parallel.
+        Every stream resumes from its checkpoint in lastUpdate/{exchange}/stakedSnaps{service}, so a lagging
+        yield subgraph only holds back the stream of its service. lastUpdate/{exchange}/stakedSnaps is
+        the lowest checkpoint of the unfinished streams (the highest one when all finished), streams without
+        a checkpoint start from it.
+        """
+        staking_services = staking_services or self.instance.staking_services()
+        self.logger.info(f'STAKED SNAP UPDATE INITIATED, staking services: '
+                         f'{[staking_service.name for staking_service in staking_services]}')
+        self.deadline.start()
+        merged_checkpoint = self.last_update.get('stakedSnaps', 0)
+        merged_token = (self.last_update.get('resume') or {}).get('stakedSnaps')
+        streams: Dict[StakingService, Dict] = {}
+        for staking_service in staking_services:
+            checkpoint_key = f'stakedSnaps{staking_service.name}'
+            if checkpoint_key not in self.last_update:
+                self.last_update[checkpoint_key] = merged_checkpoint
+                if merged_token:
+                    self.last_update.setdefault('resume', {})[checkpoint_key] = merged_token
+            streams[staking_service] = {'checkpoint_key': checkpoint_key,
+                                        'deadline': Deadline(self.deadline.remaining)}
+
+        def run(staking_service: StakingService) -> bool:
+            stream = streams[staking_service]
+            return self._update_staked_stream(max_objects_in_batch, stream['checkpoint_key'],
+                                              self.instance.stream_copy(), stream['deadline'], staking_service)
+
+        with ThreadPoolExecutor(max_workers=len(staking_services), thread_name_prefix='staked-snaps',
+                                initializer=inherit_profiler()) as executor:
+            finished = dict(zip(staking_services, executor.map(run, staking_services)))
+
+        # Finished streams are up to date even when their service has no recent positions (checkpoint far behind)
+        checkpoints = {staking_service: self.last_update[stream['checkpoint_key']]
+                       for staking_service, stream in streams.items()}
+        unfinished = [checkpoints[staking_service] for staking_service in staking_services
+                      if not finished[staking_service]]
+        checkpoint = min(unfinished) if unfinished else max(checkpoints.values())
+        if checkpoint != merged_checkpoint:
+            self._commit_checkpoint('stakedSnaps', checkpoint)
+        result = self._finish(all(finished.values()), 'stakedSnaps', self.instance.rewards_graph)
+        deadlines = [stream['deadline'] for stream in streams.values()]
+        self.report.update(pages=sum(deadline.pages for deadline in deadlines),
+                           pageSeconds=round(max(deadline.page_cost or 0 for deadline in deadlines), 2))
+        self.report['stakingServices'] = {
+            staking_service.name: {
+                'finished': finished[staking_service],
+                'pages': stream['deadline'].pages,
+                'checkpointBlock': checkpoints[staking_service],
+            } for staking_service, stream in streams.items()
+        }
+        return result
+
+    def _update_staked_stream(self, max_objects_in_batch, checkpoint_key: str, instance: Dex, deadline: Deadline,
+                              staking_service: Optional[StakingService] = None) -> bool:
+        """
+        Returns False when the stream was interrupted by the deadline.
+        """
+        self._start_dedup(checkpoint_key, instance)
+        deadline.start()
         prev_lowest, prev_highest = 1000000000, 0
-        for snaps in self.instance.fetch_new_staked_snaps(self.last_update['stakedSnaps'], max_objects_in_batch,
-                                                          staking_service=staking_service):
+        for snaps in prefetch(instance.fetch_new_staked_snaps(self.last_update.get(checkpoint_key, 0),
+                                                              max_objects_in_batch, staking_service=staking_service),
+                              self.PREFETCH_PAGES):
             if snaps:
                 lowest, highest = self._get_lowest_highest_block(snaps)
-                self.logger.info(f'Lowest block: {lowest}, highest block: {highest}')
+                self.logger.info(f'{checkpoint_key}: lowest block: {lowest}, highest block: {highest}')
                 assert prev_highest <= lowest, f'Blocks not properly sorted: ' \
                                                f'prev_highest: {prev_highest}, lowest: {lowest}'
                 prev_lowest, prev_highest = lowest, highest
-                self._upload_snaps(snaps, staked=True)
+                with self._upload_lock:
+                    self._upload_snaps(snaps, staked=True, checkpoint_key=checkpoint_key)
+            if self._out_of_time(deadline):
+                return False
+        return True
 
-    def _upload_snaps(self, snaps: List[ShareSnap], staked=False):
-        snapPath = 'stakedSnaps' if staked else f'snaps{self.snap_index}'
+    def _upload_snaps(self, snaps: List[ShareSnap], staked=False, checkpoint_key: Optional[str] = None):
+        """
+        Staked snaps are checkpointed in checkpoint_key when given (a stream of one staking service).
+        """
+        snapPath = checkpoint_key or ('stakedSnaps' if staked else f'snaps{self.snap_index}')
         self.logger.info(f'Uploading {len(snaps)} {"staked " if staked else ""}snaps')
-        highest_block = self.last_update[snapPath]
-        for snap in snaps:
-            snap_ref = self.root_ref.child(f'users/{snap.user_addr}/{self.exchange_name}'
-                                           f'/snaps/{snap.pool_id}/{snap.id}')
-            snap_ref.set(snap.to_serializable())
+        self._report_page(snaps)
+        highest_block = self.last_update.get(snapPath, 0)
+        updates = self._aggregate_snaps(snaps, staked) if self.aggregate else {}
+        resume_token = self._resume_token(snapPath, snaps)
+        while snaps:
+            # Consumed from the end so that the parsed snaps get released as they are serialized
+            snap = snaps.pop()
+            if self.snap_layout == 'compact':
+                updates[f'users/{snap.user_addr}/{self.exchange_name}/compactSnaps/{snap.pool_id}/{snap.id}'] = \
+                    snap.to_compact_serializable()
+                self._add_pool_metadata(updates, snap.pool_id, snap)
+            else:
+                updates[f'users/{snap.user_addr}/{self.exchange_name}/snaps/{snap.pool_id}/{snap.id}'] = \
+                    snap.to_serializable()
             if snap.block > highest_block:
                 highest_block = snap.block
-        self.last_update_ref.child(snapPath).set(highest_block)
-        self.last_update[snapPath] = highest_block
+        self._write(updates)
+        # A token ahead of the block checkpoint is ignored, so it is committed first
+        self._commit_checkpoint(f'resume/{snapPath}', resume_token)
+        self._commit_checkpoint(snapPath, highest_block)
         self.logger.info(f'Updated highest snap firebase block to {highest_block}')
+        if self.aggregate:
+            self._evict_aggregates()
+
+    def _init_aggregates(self):
+        """
+        Aggregates of an existing sink start from the backfill, otherwise the first snap of every position
+        older than its aggregate would be counted as a deposit of the whole balance.
+        """
+        if not self.last_update:
+            self._commit_checkpoint('aggregatesBackfilled', True)
+        elif not self.last_update.get('aggregatesBackfilled'):
+            self.logger.warning(f'Aggregates of {self.exchange_name} are not backfilled, not updating them '
+                                f'(python -m src.migrations.aggregates {self.exchange_name})')
+            self.aggregate = False
+            return
+        self._aggregate_reader = ThreadPoolExecutor(max_workers=self.upload_workers,
+                                                    thread_name_prefix='aggregate-reader',
+                                                    initializer=inherit_profiler())
+
+    def _add_pool_metadata(self, updates: Dict, pool_id: str, pool: Union[Pool, ShareSnap]):
+        """
+        Every version of the metadata of a pool (see pool_metadata_id) is written once, when all its tokens
+        are resolved, a token missing from the registry would be stored without its symbol and name for good.
+        """
+        if self._stored_pool_metadata is None:
+            self._stored_pool_metadata = set(self.storage.keys(f'poolMetadata/{self.exchange_name}'))
+        key = pool_metadata_key(pool_id, pool.pool_metadata_id())
+        if key in self._stored_pool_metadata:
+            return
+        if not all(self.instance.token_registry.is_resolved(token.token.contract_address) for token in pool.tokens):
+            return
+        updates[f'poolMetadata/{self.exchange_name}/{key}'] = pool.pool_metadata()
+        self._stored_pool_metadata.add(key)
+
+    def _aggregate_snaps(self, snaps: List[ShareSnap], staked: bool) -> Dict:
+        """
+        Applies the snaps to the position aggregates and returns the updates of the changed aggregates.
+        Staked positions are aggregated per staking service, so every aggregate is updated by one stream.
+        """
+        paths, positions = [], {}
+        for snap in snaps:
+            staking_service = snap.staking_service.name if staked else None
+            path = f'users/{snap.user_addr}/{self.exchange_name}/{position_aggregate_node(staking_service)}/' \
+                   f'{snap.pool_id}'
+            paths.append(path)
+            positions[path] = (snap.user_addr, snap.pool_id, staking_service)
+        self._load_aggregates(positions, PositionAggregate, lambda path: self._read_snap_history(*positions[path]))
+        changed = set()
+        for path, snap in sorted(zip(paths, snaps), key=lambda item: item[1].block):
+            if self._aggregates[path].apply(snap):
+                changed.add(path)
+        return {path: self._aggregates[path].to_serializable() for path in changed}
+
+    def _aggregate_yields(self, yields: List[YieldReward]) -> Dict:
+        paths = [f'users/{yield_.user_addr}/{self.exchange_name}/yieldAggregates/'
+                 f'{yield_.pool_id or yield_.staking_service.name}' for yield_ in yields]
+        self._load_aggregates(paths, YieldAggregate, self._read_yield_history)
+        changed = set()
+        for path, yield_ in sorted(zip(paths, yields), key=lambda item: item[1].block):
+            if self._aggregates[path].apply(yield_):
+                changed.add(path)
+        return {path: self._aggregates[path].to_serializable() for path in changed}
+
+    def _load_aggregates(self, paths: Iterable[str], aggregate_type, read_history: Callable[[str], Dict]):
+        """
+        Reads the aggregates of a page which are not cached yet, one get of the aggregates node of every user
+        (in parallel). An aggregate which is not stored yet is replayed from the stored history of the position
+        (read_history), the position may predate the aggregates or the backfill of its user.
+        """
+        missing = {path for path in paths if path not in self._aggregates}
+        if not missing:
+            return
+        parents = sorted({path.rsplit('/', 1)[0] for path in missing})
+        stored = dict(zip(parents, self._aggregate_reader.map(lambda parent: self.storage.get(parent) or {},
+                                                              parents)))
+        unseeded = sorted(path for path in missing
+                          if not stored[path.rsplit('/', 1)[0]].get(path.rsplit('/', 1)[1]))
+        histories = dict(zip(unseeded, self._aggregate_reader.map(read_history, unseeded)))
+        for path in missing:
+            if path in histories:
+                self._aggregates[path] = aggregate_type.from_history(histories[path])
+            else:
+                parent, key = path.rsplit('/', 1)
+                self._aggregates[path] = aggregate_type.from_serializable(stored[parent][key])
+
+    def _evict_aggregates(self):
+        """
+        Called after the checkpoint of a page. The cached aggregates are dropped once there are more than
+        AGGREGATE_CACHE_SIZE of them or the job is under memory pressure. The writes are drained first,
+        so an aggregate read again by a later page is the updated one.
+        """
+        if len(self._aggregates) <= self.AGGREGATE_CACHE_SIZE and not self.instance.memory_budget.under_pressure():
+            return
+        self.logger.info(f'Evicting {len(self._aggregates)} cached aggregates')
+        self._drain_writes()
+        self._aggregates = {}
+
+    def _read_snap_history(self, user_addr: str, pool_id: str, staking_service: Optional[str]) -> Dict[str, Dict]:
+        """
+        Stored snaps of a position (of both snap layouts) by snap id, snaps of staked positions carry
+        their staking service.
+        """
+        records = {}
+        for node in ('snaps', 'compactSnaps'):
+            records.update(self.storage.get(f'users/{user_addr}/{self.exchange_name}/{node}/{pool_id}') or {})
+        return {snap_id: record for snap_id, record in records.items()
+                if record.get('stakingService') == staking_service}
+
+    def _read_yield_history(self, aggregate_path: str) -> Dict[str, Dict]:
+        user_root, _, key = aggregate_path.rsplit('/', 2)
+        return {yield_id: record for yield_id, record in (self.storage.get(f'{user_root}/yields') or {}).items()
+                if yield_aggregate_key(record) == key}
 
     @staticmethod
     def _get_lowest_highest_block(vals):
@@ -74,10 +473,13 @@ class Controller:
                 lowest_ = snap.block
         return lowest_, highest_
 
-    def update_yields(self, max_objects_in_batch):
+    def update_yields(self, max_objects_in_batch) -> bool:
         self.logger.info('YIELD UPDATE INITIATED')
+        self._start_dedup('yields')
+        self.deadline.start()
         prev_lowest, prev_highest = 1000000000, 0
-        for yields in self.instance.fetch_yields(self.last_update['yields'], max_objects_in_batch):
+        for yields in prefetch(self.instance.fetch_yields(self.last_update.get('yields', 0), max_objects_in_batch),
+                               self.PREFETCH_PAGES):
             if yields:
                 lowest, highest = self._get_lowest_highest_block(yields)
                 self.logger.info(f'Lowest block: {lowest}, highest block: {highest}')
@@ -85,47 +487,149 @@ class Controller:
                                                f'prev_highest: {prev_highest}, lowest: {lowest}'
                 prev_lowest, prev_highest = lowest, highest
                 self._upload_yields(yields)
+            if self._out_of_time():
+                return self._finish(False, 'yields', self.instance.rewards_graph)
+        return self._finish()
 
     def _upload_yields(self, yields: List[YieldReward]):
         self.logger.info(f"Uploading {len(yields)} yields")
-        highest_block = self.last_update['yields']
-        for yield_ in yields:
-            yield_ref = self.root_ref.child(f'users/{yield_.user_addr}/{self.exchange_name}/yields/{yield_.id}')
-            yield_ref.set(yield_.to_serializable())
+        self._report_page(yields)
+        highest_block = self.last_update.get('yields', 0)
+        updates = self._aggregate_yields(yields) if self.aggregate else {}
+        resume_token = self._resume_token('yields', yields)
+        while yields:
+            yield_ = yields.pop()
+            updates[f'users/{yield_.user_addr}/{self.exchange_name}/yields/{yield_.id}'] = yield_.to_serializable()
             if yield_.block > highest_block:
                 highest_block = yield_.block
-        self.last_update_ref.child('yields').set(highest_block)
-        self.last_update['yields'] = highest_block
+        self._write(updates)
+        self._commit_checkpoint('resume/yields', resume_token)
+        self._commit_checkpoint('yields', highest_block)
         self.logger.info(f'Updated highest yields firebase block to {highest_block}')
+        if self.aggregate:
+            self._evict_aggregates()
 
-    def update_pools(self, max_objects_in_batch, min_liquidity=100000):
-        delete_threshold = 10000  # Min liquidity amount which will be considered as full update
+    def update_pools(self, max_objects_in_batch, min_liquidity=100000) -> bool:
+        """
+        The full update resumes from the band cursors, the update of the pools above the full update threshold
+        starts over the next run.
+        """
+        full_update_threshold = 10000  # Min liquidity amount which will be considered as full update
         day_id = int(datetime.now().timestamp() / 86400)
-        full_update = min_liquidity <= delete_threshold
-        day_id_to_delete = None
-        skip = 0
+        full_update = min_liquidity <= full_update_threshold
 
+        # Old days are deleted by the retention sweep (src/retention.py)
+        self.logger.info(f'POOL UPDATE INITIATED, day_id: {day_id}')
+        self.deadline.start()
         if full_update:
-            day_id_to_delete = day_id - 30
-            skip = self.last_update['daySkip']
+            return self._finish(self._update_pool_bands(max_objects_in_batch, min_liquidity, day_id))
+        for pools in self.instance.fetch_pools(max_objects_in_batch, min_liquidity):
+            if pools:
+                self._upload_pools(pools, day_id)
+            if self._out_of_time():
+                self._flush_pool_days()
+                return self._finish(False)
+        self._flush_pool_days()
+        return self._finish()
+
+    def _update_pool_bands(self, max_objects_in_batch: int, min_liquidity: int, day_id: int) -> bool:
+        """
+        Fetches pools of all liquidity bands in parallel, checkpointing a cursor per band in lastUpdate/poolBands.
+        """
+        bands = self.last_update.get('poolBands') or {}
+        edges = bands.get('edges')
+        if not edges or edges[0] != min_liquidity:
+            edges, bands = default_band_edges(min_liquidity, self.POOL_BAND_COUNT), {}
+        cursors: Dict[int, Optional[str]] = {int(key[1:]): cursor for key, cursor in
+                                             (bands.get('cursors') or {}).items()}
+        for key in (bands.get('finished') or {}):
+            cursors[int(key[1:])] = None
+        # Band layout is rebalanced only when all the pools were observed within this run
+        fresh_run = not cursors
+        self.logger.info(f'Liquidity band edges: {edges}, resumed cursors: {cursors}')
 
-        self.logger.info(f'POOL UPDATE INITIATED, day_id: {day_id}' +
-                         (f', day_id_to_delete: {day_id_to_delete}' if day_id_to_delete else ''))
-        for pools in self.instance.fetch_pools(max_objects_in_batch, min_liquidity, skip):
+        liquidities = []
+        for band, pools, cursor in self.instance.fetch_pool_bands(max_objects_in_batch, edges, cursors):
             if pools:
-                self._upload_pools(pools, day_id, day_id_to_delete)
-                skip += max_objects_in_batch
-                if full_update:
-                    self.last_update_ref.child('daySkip').set(skip)
+                self._upload_pools(pools, day_id)
+                self._commit_pool_checkpoint(f'poolBands/cursors/b{band}', cursor)
+                liquidities.extend(sum(token.reserve * token.price_usd for token in pool.tokens) for pool in pools)
+            else:
+                self._commit_pool_checkpoint(f'poolBands/finished/b{band}', True)
+            if self._out_of_time():
+                self._flush_pool_days()
+                return False
+        self._flush_pool_days()
 
-        if full_update:
-            # Full update finished without error
-            self.last_update_ref.child('dayId').set(day_id)
-            self.last_update_ref.child('daySkip').set(0)
+        # Full update finished without error
+        if fresh_run:
+            edges = balanced_band_edges(liquidities, min_liquidity, self.POOL_BAND_COUNT)
+        self._commit_checkpoint('dayId', day_id)
+        self._commit_checkpoint('poolBands', {'edges': edges})
+        return True
+
+    def backfill_pools(self, first_day_id: int, last_day_id: int, max_objects_in_batch: int, min_liquidity: int
+                       ) -> bool:
+        """
+        Rebuilds pool snaps (in the pool layout) of days in [first_day_id, last_day_id] from the pool states
+        at the closing block of each day. Days are fetched in steps of BACKFILL_DAYS_PER_STEP, the first day
+        of the next step is checkpointed in lastUpdate/{exchange}/poolBackfill, so a backfill of the same range
+        interrupted by the time budget resumes from it. Returns False when the time budget ran out.
+        """
+        checkpoint = self.last_update.get('poolBackfill') or {}
+        next_day_id = first_day_id
+        if checkpoint.get('firstDayId') == first_day_id and checkpoint.get('lastDayId') == last_day_id:
+            next_day_id = checkpoint['nextDayId']
+        self.logger.info(f'POOL BACKFILL INITIATED, days: {first_day_id}-{last_day_id}, next day: {next_day_id}')
+        self.deadline.start()
+        while next_day_id <= last_day_id:
+            day_ids = list(range(next_day_id, min(next_day_id + self.BACKFILL_DAYS_PER_STEP, last_day_id + 1)))
+            for day_id, pools in self.instance.fetch_pool_history(day_ids, max_objects_in_batch, min_liquidity):
+                if pools:
+                    self._upload_pools(pools, day_id)
+                # Days of an interrupted step are fetched again by the next run
+                if self._out_of_time():
+                    self._flush_pool_days()
+                    return self._finish(False)
+            self._flush_pool_days()
+            next_day_id = day_ids[-1] + 1
+            self._commit_checkpoint('poolBackfill', {'firstDayId': first_day_id, 'lastDayId': last_day_id,
+                                                     'nextDayId': next_day_id})
+        # A finished range can be backfilled again
+        self._commit_checkpoint('poolBackfill', None)
+        return self._finish()
 
-    def _upload_pools(self, pools: List[Pool], day_id: int, day_id_to_delete: Optional[int]):
+    def _upload_pools(self, pools: List[Pool], day_id: int):
         self.logger.info(f"Uploading {len(pools)} pools")
+        self._report_page(pools)
+        if self.pool_layout == 'nodes':
+            self._write({f'poolSnaps/{pool.id}/{day_id}': pool.to_serializable() for pool in pools})
+            return
+        self._pool_days.setdefault(day_id, PoolDayChunks()).add(pools)
+        updates = {}
         for pool in pools:
-            self.root_ref.child(f'poolSnaps/{pool.id}/{day_id}').set(pool.to_serializable())
-            if day_id_to_delete:
-                self.root_ref.child(f'poolSnaps/{pool.id}/{day_id_to_delete}').delete()
+            self._add_pool_metadata(updates, pool.id, pool)
+        if updates:
+            self._write(updates)
+
+    def _commit_pool_checkpoint(self, key: str, value):
+        """
+        Checkpoints of pages whose pools wait in the day chunks are committed after the chunks are written.
+        """
+        if self.pool_layout == 'nodes':
+            self._commit_checkpoint(key, value)
+        else:
+            self._pool_checkpoints[key] = value
+
+    def _flush_pool_days(self):
+        """
+        Writes the accumulated chunks, one update per day, then the checkpoints covering them.
+        """
+        for day_id, chunks in sorted(self._pool_days.items()):
+            self.logger.info(f'Uploading {chunks.pool_count} pools of day {day_id}')
+            self._write({f'poolDays/{self.exchange_name}/{day_id}/chunks/{chunk_id}': chunk
+                         for chunk_id, chunk in chunks.encode(compress=self.pool_layout == 'compressed').items()})
+        self._pool_days = {}
+        for key, value in self._pool_checkpoints.items():
+            self._commit_checkpoint(key, value)
+        self._pool_checkpoints = {}
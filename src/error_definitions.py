@@ -4,3 +4,7 @@ class NonExistentUserException(Exception):
 
 class NotIndexedBlockException(Exception):
     pass
+
+
+class SpoolLockedException(Exception):
+    pass
@@ -0,0 +1,86 @@
+import json
+from decimal import Decimal
+from typing import Dict, Optional, Tuple
+
+import attr
+
+from src.shared.type_definitions import FORKS_PATH, Exchange, StakingService
+from src.uniswap_v2.uniswap import Uniswap
+from src.uniswap_v2.yield_pools import yield_pools
+
+FORK_JOBS = ('snaps', 'staked_snaps', 'yields', 'pools')
+
+# Cron group of the forks without a group of their own (see cron.yaml)
+DEFAULT_GROUP = 'default'
+
+
+@attr.s(auto_attribs=True, slots=True)
+class Fork(object):
+    """
+    Uniswap v2 fork handled by the Uniswap class, configured in forks.json.
+    """
+    exchange: Exchange
+    subgraph_name: str
+    jobs: Tuple[str, ...]
+    min_liquidity: int = 0  # Min liquidity of the pools updated by default
+    eth_price_first_block: int = 0
+    price_overrides: Optional[Dict[str, Decimal]] = None  # Token prices before the price discovery
+    staking_services: Optional[Tuple[StakingService, ...]] = None  # Yield pools of the fork, all by default
+    group: str = DEFAULT_GROUP  # Forks of a group are run by the same cron entries
+
+    def create_dex(self) -> Uniswap:
+        pools = None
+        if self.staking_services is not None:
+            pools = {service: yield_pools[service] for service in self.staking_services}
+        return Uniswap(self.subgraph_name, self.exchange, self.eth_price_first_block,
+                       price_overrides=self.price_overrides, yield_pools=pools)
+
+
+def _parse_fork(name: str, config: Dict) -> Fork:
+    if name not in Exchange.__members__:
+        # Exchange members are loaded from the registry of the process (FORKS_PATH)
+        raise ValueError(f'Fork {name} is not a member of Exchange, it has to be registered in {FORKS_PATH}')
+    jobs = tuple(config['jobs'])
+    unknown_jobs = set(jobs) - set(FORK_JOBS)
+    if unknown_jobs:
+        raise ValueError(f'Unknown jobs of fork {name}: {", ".join(sorted(unknown_jobs))}')
+    price_overrides = config.get('priceOverrides')
+    staking_services = config.get('yieldPools')
+    return Fork(
+        Exchange[name],
+        config['subgraph'],
+        jobs,
+        config.get('minLiquidity', 0),
+        config.get('ethPriceFirstBlock', 0),
+        None if price_overrides is None else {token: Decimal(price) for token, price in price_overrides.items()},
+        None if staking_services is None else tuple(StakingService[service] for service in staking_services),
+        config.get('group', DEFAULT_GROUP),
+    )
+
+
+def load_forks(path: str = FORKS_PATH) -> Dict[str, Fork]:
+    """
+    Loads the fork registry, keyed by the exchange name. Entries of the file look like
+    {"SUSHI": {"subgraph": "benesjan/sushi-swap", "jobs": ["snaps", "pools"], "minLiquidity": 0,
+    "ethPriceFirstBlock": 0, "priceOverrides": {"0x...": "1"}, "yieldPools": ["SUSHI"], "group": "slow"}}
+    where only the subgraph and the jobs are required. Forks with a group are run by the cron entries
+    of the group (/forks/<entity_type>/?group=slow) on the schedule of the group.
+    The names of the forks in forks.json are members of Exchange (src/shared/type_definitions.py), so a fork
+    is added by its entry only. The name is stored in the data and used by the rewards subgraph, staked
+    snaps and yields of a new fork need the subgraph to index it.
+    """
+    with open(path) as f:
+        return {name: _parse_fork(name, config) for name, config in json.load(f).items()}
+
+
+_forks: Optional[Dict[str, Fork]] = None
+
+
+def forks() -> Dict[str, Fork]:
+    """
+    Fork registry of the process, loaded on first use.
+    """
+    global _forks
+    if _forks is None:
+        _forks = load_forks()
+    return _forks
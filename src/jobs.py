@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+class JobProgress:
+    """
+    Progress of an update reported by the controller after every uploaded page.
+    """
+
+    def __init__(self):
+        self.pages = 0
+        self.objects = 0
+        self.block: Optional[int] = None
+        self.started = time.monotonic()
+        self.stopped: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def page_uploaded(self, objects: int, block: Optional[int]):
+        with self._lock:
+            self.pages += 1
+            self.objects += objects
+            if block is not None:
+                self.block = max(self.block or 0, block)
+
+    def stop(self):
+        self.stopped = time.monotonic()
+
+    def to_serializable(self) -> Dict:
+        with self._lock:
+            elapsed = (self.stopped or time.monotonic()) - self.started
+            return {
+                'pages': self.pages,
+                'objects': self.objects,
+                'block': self.block,
+                'elapsedSeconds': round(elapsed, 1),
+                'objectsPerSecond': round(self.objects / elapsed, 2) if elapsed > 0 else 0,
+            }
+
+
+class Job:
+    def __init__(self, key: str, params: Optional[Dict] = None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        # Parameters of the run which are not a part of the key
+        self.params = params
+        self.status = 'queued'
+        self.progress = JobProgress()
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.submitted = time.time()
+        self.finished: Optional[float] = None
+        self._done = threading.Event()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Returns False when the job didn't end within the timeout.
+        """
+        return self._done.wait(timeout)
+
+    @property
+    def active(self) -> bool:
+        return self.status in ('queued', 'running')
+
+    def to_serializable(self) -> Dict:
+        serializable = {
+            'id': self.id,
+            'key': self.key,
+            'status': self.status,
+            'submitted': self.submitted,
+            'finished': self.finished,
+            'progress': self.progress.to_serializable(),
+        }
+        if self.params is not None:
+            serializable['params'] = self.params
+        if self.result is not None:
+            serializable['result'] = self.result
+        if self.error is not None:
+            serializable['error'] = self.error
+        return serializable
+
+
+class JobRunner:
+    """
+    Runs jobs on a thread pool of the process so that a request only enqueues the job and returns its id
+    instead of running into the request deadline. A job submitted while a job with the same key
+    (e.g. exchange and entity type) is queued or running is not started again, the running one is returned.
+    Status of the last `history` jobs is kept in memory.
+    """
+
+    def __init__(self, max_workers=4, history=100):
+        self.history = history
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs: 'OrderedDict[str, Job]' = OrderedDict()
+        self._active: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key: str, run: Callable[[JobProgress], Any], params: Optional[Dict] = None
+               ) -> Tuple[Job, bool]:
+        """
+        run(progress) returns a JSON serializable result. Returns the job and whether it was created,
+        the params of a job which was not created are the ones of the queued or running job.
+        """
+        with self._lock:
+            if key in self._active:
+                return self._active[key], False
+            job = Job(key, params)
+            self._jobs[job.id] = job
+            self._active[key] = job
+            self._evict()
+        self._executor.submit(self._run, job, run)
+        return job, True
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _evict(self):
+        for job_id in list(self._jobs):
+            if len(self._jobs) <= self.history:
+                return
+            if not self._jobs[job_id].active:
+                del self._jobs[job_id]
+
+    def _run(self, job: Job, run: Callable[[JobProgress], Any]):
+        job.status = 'running'
+        job.progress = JobProgress()
+        try:
+            job.result = run(job.progress)
+            job.status = 'finished'
+        except Exception as e:
+            logging.getLogger(job.key).exception(f'Job {job.id} failed')
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job.progress.stop()
+            job.finished = time.time()
+            with self._lock:
+                del self._active[job.key]
+            job._done.set()
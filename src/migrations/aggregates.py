@@ -0,0 +1,52 @@
+"""
+Backfills the per-user aggregates (users/{addr}/{exchange}/aggregates, stakedAggregates/{service} and
+yieldAggregates) from the stored snaps (both layouts) and yields, then sets
+lastUpdate/{exchange}/aggregatesBackfilled which enables their incremental updates (Controller aggregate).
+Existing aggregates are rebuilt.
+Run it while the updates of the exchange are stopped, snaps uploaded during the backfill are not aggregated
+for users which were already backfilled.
+
+Usage: python -m src.migrations.aggregates EXCHANGE [--start-after ADDRESS]
+"""
+import argparse
+import logging
+
+from src.shared.aggregates import user_aggregates
+from src.storage import firebase_root_ref
+
+
+def migrate(root_ref, exchange: str, logger, start_after=''):
+    user_addresses = sorted(addr for addr in (root_ref.child('users').get(shallow=True) or {}) if addr > start_after)
+    logger.info(f'Backfilling aggregates of {len(user_addresses)} users')
+    for user_addr in user_addresses:
+        snaps_by_pool = {}
+        for node in ('snaps', 'compactSnaps'):
+            for pool_id, snaps in (root_ref.child(f'users/{user_addr}/{exchange}/{node}').get() or {}).items():
+                snaps_by_pool.setdefault(pool_id, {}).update(snaps)
+        yields = root_ref.child(f'users/{user_addr}/{exchange}/yields').get() or {}
+        aggregates = user_aggregates(snaps_by_pool, yields)
+        if not aggregates:
+            continue
+        updates, staked = {}, {}
+        for path, aggregate in aggregates.items():
+            if path.startswith('stakedAggregates/'):
+                _, staking_service, pool_id = path.split('/')
+                staked.setdefault(staking_service, {})[pool_id] = aggregate
+            else:
+                updates[f'users/{user_addr}/{exchange}/{path}'] = aggregate
+        # The node is replaced as a whole, aggregates of staked positions used to be keyed by the pool only
+        updates[f'users/{user_addr}/{exchange}/stakedAggregates'] = staked or None
+        root_ref.update(updates)
+        # Print the address so that an interrupted backfill can be resumed with --start-after
+        logger.info(f'Backfilled user {user_addr}')
+    root_ref.update({f'lastUpdate/{exchange}/aggregatesBackfilled': True})
+    logger.info(f'Aggregates of {exchange} are backfilled')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Backfill the per-user aggregates.')
+    parser.add_argument('exchange')
+    parser.add_argument('--start-after', default='', help='Resume after this user address')
+    args = parser.parse_args()
+    migrate(firebase_root_ref(), args.exchange, logging.getLogger('MIGRATION'), args.start_after)
@@ -0,0 +1,58 @@
+"""
+Rewrites snaps stored in the full layout (users/{addr}/{exchange}/snaps) into the compact layout
+(users/{addr}/{exchange}/compactSnaps + poolMetadata/{exchange}/{pool_id}_{metadata_id}).
+
+Usage: python -m src.migrations.compact_snaps EXCHANGE [--delete-full] [--start-after ADDRESS]
+"""
+import argparse
+import logging
+from typing import Dict, Tuple
+
+from src.shared.type_definitions import pool_metadata_id, pool_metadata_key
+from src.storage import firebase_root_ref
+
+
+def compact_snap_record(snap: Dict) -> Tuple[Dict, Dict]:
+    """
+    Converts serialized snap (ShareSnap.to_serializable) into the output of ShareSnap.to_compact_serializable
+    and ShareSnap.pool_metadata.
+    """
+    record = {key: value for key, value in snap.items() if key not in ('exchange', 'tokens')}
+    record['tokens'] = [{'weight': token['weight'], 'reserve': token['reserve'], 'priceUsd': token['priceUsd']}
+                        for token in snap['tokens']]
+    record['metadataId'] = pool_metadata_id(token['token']['contractAddress'] for token in snap['tokens'])
+    return record, {'tokens': [token['token'] for token in snap['tokens']]}
+
+
+def migrate(root_ref, exchange: str, logger, delete_full=False, start_after=''):
+    stored_pool_metadata = set(root_ref.child(f'poolMetadata/{exchange}').get(shallow=True) or {})
+    user_addresses = sorted(addr for addr in (root_ref.child('users').get(shallow=True) or {}) if addr > start_after)
+    logger.info(f'Migrating snaps of {len(user_addresses)} users to the compact layout')
+    for user_addr in user_addresses:
+        snaps_by_pool = root_ref.child(f'users/{user_addr}/{exchange}/snaps').get()
+        if not snaps_by_pool:
+            continue
+        updates = {}
+        for pool_id, snaps in snaps_by_pool.items():
+            for snap_id, snap in snaps.items():
+                record, metadata = compact_snap_record(snap)
+                updates[f'users/{user_addr}/{exchange}/compactSnaps/{pool_id}/{snap_id}'] = record
+                metadata_key = pool_metadata_key(pool_id, record['metadataId'])
+                if metadata_key not in stored_pool_metadata:
+                    updates[f'poolMetadata/{exchange}/{metadata_key}'] = metadata
+                    stored_pool_metadata.add(metadata_key)
+        if delete_full:
+            updates[f'users/{user_addr}/{exchange}/snaps'] = None
+        root_ref.update(updates)
+        # Print the address so that an interrupted migration can be resumed with --start-after
+        logger.info(f'Migrated user {user_addr}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Migrate snaps to the compact layout.')
+    parser.add_argument('exchange')
+    parser.add_argument('--delete-full', action='store_true', help='Delete the full snaps after migration')
+    parser.add_argument('--start-after', default='', help='Resume after this user address')
+    args = parser.parse_args()
+    migrate(firebase_root_ref(), args.exchange, logging.getLogger('MIGRATION'), args.delete_full, args.start_after)
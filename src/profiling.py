@@ -0,0 +1,156 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import thread as futures_thread
+from typing import Callable, Dict, Optional, List, Tuple
+
+# Stage of a sample is given by the innermost frame matching (file suffix, function names)
+STAGES: List[Tuple[str, str, Tuple[str, ...]]] = [
+    ('subgraph', 'src/subgraph.py', ('_post',)),
+    ('storage', 'src/storage.py', ('get', 'update')),
+    ('serialization', 'src/shared/type_definitions.py', ('to_serializable', 'to_compact_serializable')),
+    ('parsing', 'src/uniswap_v2/uniswap.py', ('_process_snap', '_parse_pool', '_get_staked_snaps')),
+    ('parsing', 'src/balancer/balancer.py', ('_parse_snaps', '_parse_pool')),
+    ('parsing', 'src/balancer/parsing.py', ('compact_snap', 'parse_compact_snap')),
+    ('parsing', 'src/shared/Dex.py', ('_parse_yield', '_parse_prices')),
+    ('aggregation', 'src/controller.py', ('_aggregate_snaps', '_aggregate_yields')),
+    ('waiting', 'threading.py', ('wait',)),
+    ('waiting', 'queue.py', ('get', 'put')),
+]
+
+PROFILE_DIR = '/tmp/profiles'
+
+# Loop of a ThreadPoolExecutor worker, it is the innermost Python frame only while the worker is blocked
+# in the (C implemented) get of its work queue
+_POOL_WORKER_LOOP = futures_thread._worker.__code__
+
+# Profiler of every thread working for a profiled job, by thread id
+_profiled_threads: Dict[int, 'SamplingProfiler'] = {}
+_profiled_threads_lock = threading.Lock()
+
+
+def _not_profiled():
+    pass
+
+
+def inherit_profiler() -> Callable[[], None]:
+    """
+    Returns an initializer which registers the thread calling it with the profiler of the current thread,
+    if the current thread is profiled. Worker pools and threads started by a job run it first
+    (ThreadPoolExecutor initializer), so only the threads of the profiled job get sampled.
+    """
+    profiler = _profiled_threads.get(threading.get_ident())
+    return profiler._register_current_thread if profiler else _not_profiled
+
+
+def _stage(frame) -> Optional[str]:
+    while frame is not None:
+        code = frame.f_code
+        for stage, file_suffix, functions in STAGES:
+            if code.co_name in functions and code.co_filename.endswith(file_suffix):
+                return stage
+        frame = frame.f_back
+    return None
+
+
+def _folded_stack(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    Samples stacks of the thread running a job and of its worker threads (see inherit_profiler) in
+    a background thread, concurrent jobs are not sampled. Writes the stacks
+    in the folded format (input of flamegraph.pl and speedscope) and estimates time spent in the stages
+    of a job (subgraph queries, parsing, storage writes, ...).
+
+    Nothing is sampled outside of the `with` block, so jobs which are not profiled don't pay anything.
+    """
+
+    def __init__(self, name: str, interval=0.005):
+        self.name = name
+        self.interval = interval
+        self.stacks = Counter()
+        # Samples of the thread running the job by stage (a wall time breakdown) and of the worker threads
+        self.stages = Counter()
+        self.worker_stages = Counter()
+        self.rounds = 0
+        self.wall_seconds = 0.0
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._target_thread_id: Optional[int] = None
+        # Threads of the job by thread id, ids of finished threads can be reused by other threads
+        self._threads: Dict[int, threading.Thread] = {}
+
+    def __enter__(self) -> 'SamplingProfiler':
+        self._target_thread_id = threading.get_ident()
+        self._register_current_thread()
+        self._started = time.monotonic()
+        self._thread = threading.Thread(target=self._sample_loop, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+        self.wall_seconds = time.monotonic() - self._started
+        with _profiled_threads_lock:
+            for thread_id in self._threads:
+                if _profiled_threads.get(thread_id) is self:
+                    del _profiled_threads[thread_id]
+
+    def _register_current_thread(self):
+        with _profiled_threads_lock:
+            _profiled_threads[threading.get_ident()] = self
+            self._threads[threading.get_ident()] = threading.current_thread()
+
+    def _sample_loop(self):
+        while not self._stopped.wait(self.interval):
+            self.rounds += 1
+            frames = sys._current_frames()
+            with _profiled_threads_lock:
+                threads = list(self._threads.items())
+            for thread_id, thread in threads:
+                frame = frames.get(thread_id)
+                if frame is None or not thread.is_alive():
+                    continue
+                stage = _stage(frame)
+                if thread_id == self._target_thread_id:
+                    self.stages[stage or 'other'] += 1
+                elif stage == 'waiting' or frame.f_code is _POOL_WORKER_LOOP:
+                    # Blocked worker (in a wait or in the work queue of its executor)
+                    continue
+                else:
+                    # Only threads of the job are sampled, so unclassified work of a worker is a part of the job
+                    self.worker_stages[stage or 'other'] += 1
+                self.stacks[_folded_stack(frame)] += 1
+
+    def write_folded(self, directory=PROFILE_DIR) -> str:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{self.name}-{int(time.time())}.folded')
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        return path
+
+    def report(self, top_stacks=10) -> Dict:
+        """
+        Stage times of the job thread add up to the wall time, stage times of the worker threads
+        (uploads, parallel fetches) are in thread-seconds.
+        """
+        seconds_per_round = self.wall_seconds / self.rounds if self.rounds else 0
+        return {
+            'wallSeconds': round(self.wall_seconds, 3),
+            'samplingRounds': self.rounds,
+            'stageSeconds': {stage: round(count * seconds_per_round, 3) for stage, count in self.stages.most_common()},
+            'workerStageSeconds': {stage: round(count * seconds_per_round, 3)
+                                   for stage, count in self.worker_stages.most_common()},
+            'topStacks': [{'stack': stack, 'samples': count} for stack, count in self.stacks.most_common(top_stacks)],
+        }
@@ -0,0 +1,135 @@
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Iterable, Match, Union
+
+from src.query_template import QueryTemplate
+from src.subgraph import SubgraphReader
+
+_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[_A-Za-z][_0-9A-Za-z]*|\S')
+_VARIABLE = re.compile(r'\$([_A-Za-z][_0-9A-Za-z]*)')
+
+
+def _root_keys(query: str) -> Iterable[Tuple[Match, bool]]:
+    """
+    Yields tokens of the root response keys (alias if present, field name otherwise) of the query
+    and whether the token is an alias.
+    """
+    tokens = list(_TOKEN.finditer(query))
+    braces = parens = 0
+    expecting_field_name = False
+    for i, match in enumerate(tokens):
+        token = match.group()
+        if token == '{':
+            braces += 1
+        elif token == '}':
+            braces -= 1
+        elif token == '(':
+            parens += 1
+        elif token == ')':
+            parens -= 1
+        elif braces == 1 and parens == 0 and (token[0].isalpha() or token[0] == '_'):
+            if expecting_field_name:
+                # Field name following an alias
+                expecting_field_name = False
+            else:
+                expecting_field_name = i + 1 < len(tokens) and tokens[i + 1].group() == ':'
+                yield match, expecting_field_name
+
+
+def root_response_keys(query: str) -> List[str]:
+    """
+    Returns keys under which the root fields of the query appear in the response data
+    (alias if present, field name otherwise).
+    """
+    return [match.group() for match, _ in _root_keys(query)]
+
+
+def _prefix_root_keys(query: str, prefix: str) -> str:
+    """
+    Aliases every root field of the query as {prefix}_{response key}.
+    """
+    parts, position = [], 0
+    for match, is_alias in _root_keys(query):
+        parts.append(query[position:match.start()])
+        parts.append(f'{prefix}_{match.group()}' if is_alias else f'{prefix}_{match.group()}: {match.group()}')
+        position = match.end()
+    parts.append(query[position:])
+    return ''.join(parts)
+
+
+def _selection_body(query: str) -> str:
+    query = query.strip()
+    assert query[0] == '{' and query[-1] == '}', 'Only anonymous query documents can be merged'
+    return query[1:-1]
+
+
+@lru_cache(maxsize=256)
+def _merge_templates(parts: Tuple[Tuple[str, QueryTemplate], ...]) -> QueryTemplate:
+    """
+    Merges templates into one document, variables and root keys of each template are prefixed
+    with the name of its part. Cached, so the merged document is built once per combination.
+    """
+    variables, bodies = {}, []
+    for name, template in parts:
+        variables.update({f'{name}_{variable}': type_ for variable, type_ in template.variables.items()})
+        query = _VARIABLE.sub(lambda match: f'${name}_{match.group(1)}', template.query)
+        bodies.append(_selection_body(_prefix_root_keys(query, name)))
+    return QueryTemplate('_'.join(template.name for _, template in parts), variables,
+                         '{' + '\n'.join(bodies) + '}')
+
+
+class QueryPlanner:
+    """
+    Merges root fields of several query documents targeting the same subgraph into one
+    request and splits the response data back per document.
+
+    Templates are merged with their variables and root fields prefixed by the part name, so the
+    merged document only depends on the combination of templates. Plain documents (e.g. queries
+    aliased per block) are merged as they are and must not collide.
+    """
+
+    def __init__(self, graph: SubgraphReader):
+        self.graph = graph
+        self._parts: Dict[str, Tuple[Union[str, QueryTemplate], List[str], Dict]] = {}
+
+    def add(self, name: str, query: Union[str, QueryTemplate], params: Optional[Dict] = None):
+        """
+        params are the variables of a template or $-parameters substituted into a plain document.
+        """
+        if isinstance(query, QueryTemplate):
+            self._parts[name] = (query, root_response_keys(query.query), params or {})
+            return
+        if params:
+            query = SubgraphReader._pass_params(query, params)
+        keys = root_response_keys(query)
+        for other_name, (other_query, other_keys, _) in self._parts.items():
+            if isinstance(other_query, str):
+                conflicts = set(keys) & set(other_keys)
+                assert not conflicts, f'Root fields {conflicts} of "{name}" collide with "{other_name}"'
+        self._parts[name] = (query, keys, {})
+
+    def execute(self) -> Dict[str, Dict]:
+        """
+        Returns response data of each added document under its name.
+        """
+        if not self._parts:
+            return {}
+        parts, self._parts = self._parts, {}
+        if len(parts) == 1:
+            (name, (query, keys, params)), = parts.items()
+            data = self.graph.query(query, params)['data']
+            return {name: {key: data[key] for key in keys}}
+
+        templates = tuple((name, query) for name, (query, _, _) in parts.items() if isinstance(query, QueryTemplate))
+        merged = _merge_templates(templates) if templates else None
+        plain_bodies = [_selection_body(query) for query, _, _ in parts.values() if isinstance(query, str)]
+        if plain_bodies:
+            # Plain documents differ request to request, such a document is not worth persisting
+            merged = QueryTemplate(merged.name if merged else 'Planned', merged.variables if merged else {},
+                                   '{' + '\n'.join(([_selection_body(merged.query)] if merged else []) +
+                                                    plain_bodies) + '}', persist=False)
+        variables = {f'{name}_{variable}': value for name, (query, _, params) in parts.items()
+                     if isinstance(query, QueryTemplate) for variable, value in params.items()}
+        data = self.graph.query(merged, variables)['data']
+        return {name: {key: data[f'{name}_{key}' if isinstance(query, QueryTemplate) else key] for key in keys}
+                for name, (query, keys, _) in parts.items()}
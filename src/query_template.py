@@ -0,0 +1,38 @@
+import hashlib
+from typing import Dict
+
+
+class QueryTemplate:
+    """
+    Named GraphQL query document declared once at module level. Values are sent as GraphQL variables,
+    so the document text (and its hash, used by persisted queries) is the same for every request.
+    """
+
+    def __init__(self, name: str, variables: Dict[str, str], query: str, persist=True):
+        """
+        variables maps variable names (without $) to their GraphQL types, query is the selection
+        set of the operation (an anonymous document referencing the variables).
+        Documents built for a single request are not worth persisting (persist=False).
+        """
+        self.name = name
+        self.variables = variables
+        self.query = query.strip()
+        self.persist = persist
+        definitions = ', '.join(f'${variable}: {type_}' for variable, type_ in variables.items())
+        self.document = f'query {name}({definitions}) {self.query}' if variables else f'query {name} {self.query}'
+        self.sha256 = hashlib.sha256(self.document.encode()).hexdigest()
+
+    def __repr__(self):
+        return f'QueryTemplate({self.name})'
+
+
+# Indexing status of a subgraph, shared by all the readers so that it's one persisted query
+HIGHEST_INDEXED_BLOCK_QUERY = QueryTemplate('HighestIndexedBlock', {}, '''
+{
+    _meta {
+        block {
+            number
+        }
+    }
+}
+''')
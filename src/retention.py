@@ -0,0 +1,93 @@
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from src.shared.rate_limiter import RateLimiter
+from src.storage import Storage
+
+# Days of pool snaps within the window are kept
+RETENTION_DAYS = 30
+
+
+class PoolSnapRetention:
+    """
+    Deletes days older than the retention window from poolSnaps/{pool_id}/{day_id}
+    and poolDays/{exchange}/{day_id}.
+
+    Pool ids are read with a shallow read and only the expired days of each pool are read (key ranges ending
+    before the cutoff, in pages of days_per_read), so the days within the window are never transferred.
+    The deletes are written as batched multi-path updates. The id of the last swept pool is checkpointed
+    in lastUpdate/retention/poolSnaps so that the sweep can resume in the next run.
+    """
+
+    def __init__(self, storage: Storage, logger, retention_days=RETENTION_DAYS, batch_size=500,
+                 max_requests_per_second=10, days_per_read=100):
+        self.storage = storage
+        self.logger = logger
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.days_per_read = days_per_read
+        self.limiter = RateLimiter(max_requests_per_second)
+
+    def sweep(self, time_budget: Optional[float] = None) -> bool:
+        """
+        Returns True when the whole poolSnaps node was swept, False when the time budget ran out.
+        poolDays has a handful of exchanges and is swept first, without a cursor.
+        """
+        deadline = None if time_budget is None else time.monotonic() + time_budget
+        cutoff_day_id = int(datetime.now().timestamp() / 86400) - self.retention_days
+        cursor = self.storage.get('lastUpdate/retention/poolSnaps') or ''
+        self.logger.info(f'RETENTION SWEEP INITIATED, cutoff day_id: {cutoff_day_id}, cursor: "{cursor}"')
+
+        updates: Dict[str, None] = {}
+        deleted = self._sweep_pool_days(cutoff_day_id, updates, cursor)
+        self.limiter.wait()
+        pool_ids = sorted(pool_id for pool_id in self.storage.keys('poolSnaps') if pool_id > cursor)
+        for pool_id in pool_ids:
+            if deadline and time.monotonic() > deadline:
+                deleted += self._flush(updates, cursor)
+                self.logger.info(f'Retention sweep paused at pool {cursor}, deleted {deleted} days')
+                return False
+            for day_ids in self._expired_days(f'poolSnaps/{pool_id}', cutoff_day_id):
+                for day_id in day_ids:
+                    updates[f'poolSnaps/{pool_id}/{day_id}'] = None
+            cursor = pool_id
+            if len(updates) >= self.batch_size:
+                deleted += self._flush(updates, cursor)
+
+        deleted += self._flush(updates, '')
+        self.logger.info(f'Retention sweep finished, deleted {deleted} days')
+        return True
+
+    def _sweep_pool_days(self, cutoff_day_id: int, updates: Dict[str, None], cursor: str) -> int:
+        self.limiter.wait()
+        for exchange in self.storage.keys('poolDays'):
+            for day_ids in self._expired_days(f'poolDays/{exchange}', cutoff_day_id):
+                for day_id in day_ids:
+                    updates[f'poolDays/{exchange}/{day_id}'] = None
+        return self._flush(updates, cursor)
+
+    def _expired_days(self, path: str, cutoff_day_id: int) -> Iterable[List[str]]:
+        """
+        Ids of the days before the cutoff, newest first in pages of days_per_read.
+        Day ids are integer keys, so their key order is the numeric one.
+        """
+        end_day_id = cutoff_day_id - 1
+        while True:
+            self.limiter.wait()
+            day_ids = list(self.storage.get_range(path, str(end_day_id), self.days_per_read))
+            yield day_ids
+            if len(day_ids) < self.days_per_read:
+                break
+            end_day_id = min(int(day_id) for day_id in day_ids) - 1
+
+    def _flush(self, updates: Dict[str, None], cursor: str) -> int:
+        """
+        Writes the deletes together with the cursor, so the checkpoint never gets ahead of the data.
+        """
+        amount = len(updates)
+        updates['lastUpdate/retention/poolSnaps'] = cursor or None
+        self.limiter.wait()
+        self.storage.update(updates)
+        updates.clear()
+        return amount
@@ -0,0 +1,139 @@
+import heapq
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.forks import DEFAULT_GROUP, forks
+from src.shared.Dex import Dex
+from src.storage import Storage
+
+# (exchange, entity type) pairs which are checkpointed by a block number, the Uniswap forks of the default
+# cron group add theirs from the fork registry (see default_jobs), the other groups keep their cron schedule
+BALANCER_JOBS = [
+    ('BALANCER', 'snaps'),
+    ('BALANCER', 'yields'),
+]
+
+# Key of the checkpoint in lastUpdate/{exchange}
+CHECKPOINT_KEYS = {
+    'snaps': 'snaps',
+    'staked_snaps': 'stakedSnaps',
+    'yields': 'yields',
+}
+
+Job = Tuple[str, str]
+
+
+def default_jobs() -> List[Job]:
+    return BALANCER_JOBS + [(exchange, entity_type) for exchange, fork in forks().items()
+                            if fork.group == DEFAULT_GROUP
+                            for entity_type in fork.jobs if entity_type in CHECKPOINT_KEYS]
+
+
+class LagScheduler:
+    """
+    Spends a shared time budget on the jobs with the largest backlog instead of running every job
+    on a fixed schedule.
+
+    Lag of a job is the number of blocks between its lastUpdate checkpoint and the highest block
+    indexed by the subgraph it reads from. Jobs are run by max_workers threads in the order of
+    their lag, each for at most time_slice seconds, after which the job checkpoints and yields
+    and is requeued with its remaining lag. A job which has a lag and was not run for
+    starvation_seconds is run before all the others. Time of the last run of each job is stored
+    in lastUpdate/scheduler.
+    """
+
+    def __init__(self, storage: Storage, logger, create_dex: Callable[[str], Optional[Dex]],
+                 run_job: Callable[[str, str, float], bool], jobs: List[Job] = None, max_workers=2,
+                 time_slice=120.0, starvation_seconds=3600.0):
+        """
+        run_job(exchange, entity_type, time_budget) returns True when the job caught up.
+        """
+        self.storage = storage
+        self.logger = logger
+        self.create_dex = create_dex
+        self.run_job = run_job
+        self.jobs = jobs or default_jobs()
+        self.max_workers = max_workers
+        self.time_slice = time_slice
+        self.starvation_seconds = starvation_seconds
+        self._highest_blocks: Dict[Tuple[str, str], int] = {}
+
+    def run(self, time_budget: float) -> List[Dict]:
+        """
+        Runs the jobs until all of them caught up or the time budget ran out, returns a report
+        of the job lags and runs.
+        """
+        deadline = time.monotonic() + time_budget
+        last_update = self.storage.get('lastUpdate') or {}
+        last_runs = last_update.get('scheduler') or {}
+        now = time.time()
+
+        report = {}
+        queue = []
+        for exchange, entity_type in self.jobs:
+            key = f'{exchange}_{entity_type}'
+            lag = self._measure_lag(exchange, entity_type, last_update)
+            waited = now - last_runs.get(key, 0)
+            starving = lag > 0 and waited > self.starvation_seconds
+            report[key] = {'exchange': exchange, 'entityType': entity_type, 'lag': lag, 'starving': starving,
+                           'slices': 0, 'finished': lag == 0}
+            if lag > 0:
+                # Starving jobs first, then by the largest lag
+                heapq.heappush(queue, (not starving, -lag, key, (exchange, entity_type)))
+        self.logger.info(f'Scheduled jobs: {[(item[2], -item[1]) for item in sorted(queue)]}')
+
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                remaining = deadline - time.monotonic()
+                # A slice shorter than a few pages would spend most of its time on the setup
+                if remaining < min(self.time_slice, 30):
+                    return
+                with lock:
+                    if not queue:
+                        return
+                    _, _, key, (exchange, entity_type) = heapq.heappop(queue)
+                self._record_run(key)
+                try:
+                    finished = self.run_job(exchange, entity_type, min(self.time_slice, remaining))
+                except Exception as e:
+                    self.logger.exception(f'Job {key} failed')
+                    with lock:
+                        report[key]['slices'] += 1
+                        report[key]['error'] = str(e)
+                    continue
+                lag = 0 if finished else \
+                    self._measure_lag(exchange, entity_type, self.storage.get('lastUpdate') or {})
+                with lock:
+                    report[key].update(slices=report[key]['slices'] + 1, finished=finished, lag=lag)
+                    if not finished:
+                        # Requeued jobs are not starving anymore
+                        heapq.heappush(queue, (True, -lag, key, (exchange, entity_type)))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='scheduler') as executor:
+            workers = [executor.submit(worker) for _ in range(self.max_workers)]
+        for future in workers:
+            future.result()
+        return list(report.values())
+
+    def _measure_lag(self, exchange: str, entity_type: str, last_update: Dict) -> int:
+        checkpoint = (last_update.get(exchange) or {}).get(CHECKPOINT_KEYS[entity_type], 0)
+        return max(self._highest_block(exchange, entity_type) - checkpoint, 0)
+
+    def _highest_block(self, exchange: str, entity_type: str) -> int:
+        """
+        Snaps are read from the exchange subgraph, staked snaps and yields from the rewards subgraph.
+        Queried once per run, blocks indexed during the run are left for the next one.
+        """
+        key = (exchange, 'dex' if entity_type == 'snaps' else 'rewards')
+        if key not in self._highest_blocks:
+            dex = self.create_dex(exchange)
+            graph = dex.dex_graph if entity_type == 'snaps' else dex.rewards_graph
+            self._highest_blocks[key] = Dex.get_highest_indexed_block(graph)
+        return self._highest_blocks[key]
+
+    def _record_run(self, key: str):
+        self.storage.update({f'lastUpdate/scheduler/{key}': time.time()})
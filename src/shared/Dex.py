@@ -1,13 +1,49 @@
+import copy
 import logging
 from abc import ABC, abstractmethod
+from concurrent.futures import Future
 from datetime import datetime
 from decimal import Decimal
-from typing import List, Dict, Iterable, Callable
+from typing import List, Dict, Iterable, Callable, Tuple, Optional, Set
 
-from src.shared.type_definitions import ShareSnap, Exchange, Pool, YieldReward, StakingService
+from src.query_planner import QueryPlanner
+from src.query_template import HIGHEST_INDEXED_BLOCK_QUERY, QueryTemplate
+from src.shared.block_index import shared_block_index
+from src.shared.eth_price_oracle import EthPriceOracle, shared_eth_price_oracle
+from src.shared.memory import MemoryBudget
+from src.shared.pipeline import iterate_in_parallel
+from src.shared.recent_ids import RecentIds
+from src.shared.token_registry import shared_token_registry
+from src.shared.type_definitions import ShareSnap, Exchange, Pool, YieldReward, StakingService, PoolContext
 from src.subgraph import SubgraphReader
 
 
+REWARDS_QUERY = QueryTemplate(
+    'Rewards', {'first': 'Int!', 'skip': 'Int!', 'block': 'BigInt!', 'exchange': 'String!'}, '''
+{
+    rewards(first: $first, skip: $skip, orderBy: blockNumber, orderDirection: asc, where: {blockNumber_gte: $block, exchange: $exchange}) {
+        id
+        stakingService
+        exchange
+        pool
+        amount
+        user
+        transaction
+        blockNumber
+        blockTimestamp
+    }
+}
+''')
+
+BLOCK_AFTER_QUERY = QueryTemplate('BlockAfter', {'timestamp': 'BigInt!'}, '''
+{
+    blocks(first: 1, orderBy: timestamp, orderDirection: asc, where: {timestamp_gt: $timestamp}) {
+        number
+    }
+}
+''')
+
+
 class Dex(ABC):
     """
     Base class defining the interface for DEXes.
@@ -18,8 +54,35 @@ class Dex(ABC):
         self.exchange = exchange
         self.eth_price_first_block = eth_price_first_block
         self.block_graph = SubgraphReader('blocklytics/ethereum-blocks')
+        self.block_index = shared_block_index()
+        self.memory_budget = MemoryBudget()
+        # Ids of the entities processed by the previous run at its last block and during this run
+        self.recent_ids = RecentIds()
+        self.token_registry = shared_token_registry()
+        self.eth_price_oracle = shared_eth_price_oracle()
+        # Oracle samples of the planned prices fetched concurrently with the planned query
+        self._oracle_fetch: Optional[Future] = None
         self.rewards_graph = SubgraphReader('benesjan/dex-rewards-subgraph')
 
+    def stream_copy(self) -> 'Dex':
+        """
+        Shallow copy for a stream running concurrently with the other streams of the same job. The copies
+        share the subgraph readers, the memory budget of the job and the process-wide caches (token registry,
+        price oracle, block index, pair states), all of which lock their mutable state. The dedup of the
+        processed entities (replaced again by the controller when the stream starts) and the pending oracle
+        fetch are per stream.
+        """
+        instance = copy.copy(self)
+        instance.recent_ids = RecentIds()
+        instance._oracle_fetch = None
+        return instance
+
+    def close(self):
+        """
+        Releases the resources of the instance (e.g. worker processes), called once the run is over.
+        """
+        pass
+
     @abstractmethod
     def fetch_new_snaps(self, last_block_update: int, max_objects_in_batch: int) -> Iterable[List[ShareSnap]]:
         """
@@ -36,24 +99,119 @@ class Dex(ABC):
         """
         raise NotImplementedError()
 
-    def _populate_eth_prices(self, snaps: List[ShareSnap]):
-        snaps = [snap for snap in snaps if snap.block >= self.eth_price_first_block]
-        if not snaps:
-            return
-        blocks = {snap.block for snap in snaps}
-        eth_prices = self._get_eth_usd_prices(blocks)
+    def staking_services(self) -> List[StakingService]:
+        """
+        Staking services of the exchange, the staked snaps are fetched in a stream per service.
+        """
+        return []
+
+    def _fetch_snap_pages(self, query: QueryTemplate, variables: Dict, max_objects_in_batch: int,
+                          parse: Callable[[List[Dict]], List[ShareSnap]]) -> Iterable[List[ShareSnap]]:
+        """
+        Pages through snaps of the dex graph (root field aliased as snaps, paged by the $first and $skip
+        variables). Every round trip fetches the next page together with the prices of the current one
+        (see _plan_prices).
+        """
+        planner = QueryPlanner(self.dex_graph)
+        planner.add('meta', HIGHEST_INDEXED_BLOCK_QUERY)
+        planner.add('page', query, {**variables, 'skip': 0, 'first': self._page_size(max_objects_in_batch)})
+        results = planner.execute()
+        logging.info(f'{self.exchange}: Last update block: {variables["block"]}, '
+                     f'highest indexed block: {results["meta"]["_meta"]["block"]["number"]}')
+        raw_snaps, skip = results['page']['snaps'], 0
+        while raw_snaps:
+            skip += len(raw_snaps)
+            raw_snaps = self._drop_seen(raw_snaps)
+            snaps = parse(raw_snaps) if raw_snaps else []
+            # Release the raw page before the next one arrives
+            raw_snaps = results = None
+            planner.add('page', query,
+                        {**variables, 'skip': skip, 'first': self._page_size(max_objects_in_batch)})
+            self._plan_prices(planner, {snap.block for snap in snaps})
+            results = planner.execute()
+            self._apply_prices(snaps, results)
+
+            yield snaps
+            raw_snaps = results['page']['snaps']
+
+    def _drop_seen(self, raw_entities: List[Dict]) -> List[Dict]:
+        """
+        Drops entities which were already processed before their prices are fetched.
+        """
+        fresh = self.recent_ids.filter(raw_entities)
+        if len(fresh) < len(raw_entities):
+            logging.info(f'{self.exchange}: Skipped {len(raw_entities) - len(fresh)} already processed entities')
+        return fresh
+
+    def _page_size(self, max_objects_in_batch: int) -> int:
+        """
+        Page size reduced according to the memory budget.
+        """
+        page_size = self.memory_budget.page_size(max_objects_in_batch)
+        if page_size < max_objects_in_batch:
+            logging.info(f'{self.exchange}: Page size reduced to {page_size} due to memory budget')
+        return page_size
+
+    def _plan_prices(self, planner: QueryPlanner, blocks: Set[int]):
+        """
+        Adds queries of the prices which are then set to snaps by _apply_prices. ETH prices of blocks
+        covered by the price oracle are taken from the oracle, the samples it is missing are a part of
+        the planned query when the planner queries the canonical source, otherwise they are fetched
+        concurrently with it.
+        """
+        old_blocks = {block for block in blocks
+                      if self.eth_price_first_block <= block < EthPriceOracle.CANONICAL_FIRST_BLOCK}
+        if old_blocks:
+            planner.add('eth_prices', ''.join(self._get_eth_prices_query_generator()(old_blocks)))
+        samples = self.eth_price_oracle.missing_samples(block for block in blocks
+                                                        if block >= EthPriceOracle.CANONICAL_FIRST_BLOCK)
+        if samples and self.eth_price_oracle.serves(planner.graph):
+            planner.add('oracle_prices', self.eth_price_oracle.query_document(samples))
+        elif samples:
+            self._oracle_fetch = self.eth_price_oracle.fetch_async(samples)
+
+    def _apply_prices(self, snaps: List[ShareSnap], results: Dict[str, Dict]):
+        if 'oracle_prices' in results:
+            self.eth_price_oracle.store_response(results['oracle_prices'])
+        if self._oracle_fetch:
+            fetch, self._oracle_fetch = self._oracle_fetch, None
+            fetch.result()
+        eth_prices = self._parse_prices(results['eth_prices']) if 'eth_prices' in results else {}
+        missing = {snap.block for snap in snaps if snap.block >= self.eth_price_first_block} - eth_prices.keys()
+        if missing:
+            eth_prices.update(self._get_eth_usd_prices(missing))
         for snap in snaps:
-            snap.eth_price = eth_prices[snap.block]
+            if snap.block >= self.eth_price_first_block:
+                snap.eth_price = eth_prices[snap.block]
+
+    def _populate_eth_prices(self, snaps: List[ShareSnap]):
+        planner = QueryPlanner(self.dex_graph)
+        Dex._plan_prices(self, planner, {snap.block for snap in snaps})
+        Dex._apply_prices(self, snaps, planner.execute())
 
     def _get_eth_usd_prices(self, blocks: Iterable[int]) -> Dict[int, Decimal]:
         """
         Fetch eth prices in specific block times.
         (used to denominate the returns in ETH)
+        Prices are served by the shared oracle, only the blocks it doesn't cover (before its first block
+        or not indexed by its source yet) are queried from the dex graph.
+        """
+        blocks = set(blocks)
+        prices = self.eth_price_oracle.prices(block for block in blocks
+                                              if block >= EthPriceOracle.CANONICAL_FIRST_BLOCK)
+        missing = blocks - prices.keys()
+        if missing:
+            query = ''.join(self._get_eth_prices_query_generator()(missing))
+            data = self.dex_graph.query(query, {})
+            prices.update(self._parse_prices(data['data']))
+        return prices
+
+    @staticmethod
+    def _parse_prices(data: Dict) -> Dict[int, Decimal]:
+        """
+        Parses response of aliased price queries, aliases are the block number prefixed with one letter.
         """
-        query = ''.join(self._get_eth_prices_query_generator()(blocks))
-        data = self.dex_graph.query(query, {})
-        return {int(block[1:]): Decimal(price['price']) for
-                block, price in data['data'].items()}
+        return {int(block[1:]): Decimal(price['price']) for block, price in data.items()}
 
     @abstractmethod
     def _get_eth_prices_query_generator(self) -> Callable[[Iterable[int]], Iterable[str]]:
@@ -70,51 +228,138 @@ class Dex(ABC):
         """
         raise NotImplementedError()
 
+    @abstractmethod
+    def _get_pool_context(self) -> PoolContext:
+        """
+        Returns values shared by all the pools fetched in one run (block, eth price, yield token prices).
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def _get_pool_contexts(self, blocks: Iterable[int]) -> Dict[int, PoolContext]:
+        """
+        Returns pool contexts at historical blocks.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def _pool_page_query(self, block: int, max_objects_in_batch: int, min_liquidity: int,
+                         max_liquidity: Optional[int], last_id: str) -> Tuple[QueryTemplate, Dict]:
+        """
+        Returns a query template and its variables of pools with liquidity in [min_liquidity, max_liquidity)
+        and id greater than last_id ordered by id, at the given block. The root field is aliased as pools.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def _parse_pool(self, raw_pool: Dict, context: PoolContext) -> Pool:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def _pool_token_addresses(self, raw_pools: List[Dict]) -> Iterable[str]:
+        raise NotImplementedError()
+
+    def _parse_pools(self, raw_pools: List[Dict], context: PoolContext) -> List[Pool]:
+        self._resolve_tokens(self._pool_token_addresses(raw_pools))
+        return [self._parse_pool(pool, context) for pool in raw_pools]
+
+    def _resolve_tokens(self, addresses: Iterable[str]):
+        """
+        Makes sure the token registry contains metadata of the tokens (queries only return token addresses).
+        """
+        self.token_registry.resolve(addresses, self._lookup_tokens)
+
+    @abstractmethod
+    def _lookup_tokens(self, addresses: List[str]) -> Dict[str, Tuple[str, str]]:
+        """
+        Returns (symbol, name) of the tokens.
+        """
+        raise NotImplementedError()
+
+    def fetch_pool_bands(self, max_objects_in_batch: int, band_edges: List[int],
+                         cursors: Dict[int, Optional[str]]) -> Iterable[Tuple[int, List[Pool], str]]:
+        """
+        Fetches pools of all the liquidity bands in parallel. Yields tuples (band index, pools, cursor)
+        where cursor is the id of the last pool in the page. Finished band is signaled by an empty
+        list of pools. Bands with None cursor are skipped (finished in a previous run).
+        """
+        context = self._get_pool_context()
+
+        def fetch_band(band: int) -> Iterable[Tuple[int, List[Pool], str]]:
+            upper = band_edges[band + 1] if band + 1 < len(band_edges) else None
+            last_id = cursors.get(band, '')
+            while True:
+                query, variables = self._pool_page_query(context.block, max_objects_in_batch, band_edges[band], upper,
+                                                         last_id)
+                pools = self._parse_pools(self.dex_graph.query(query, variables)['data']['pools'], context)
+                if not pools:
+                    break
+                last_id = pools[-1].id
+                yield band, pools, last_id
+            yield band, [], None
+
+        bands = [band for band in range(len(band_edges)) if cursors.get(band, '') is not None]
+        yield from iterate_in_parallel([lambda band=band: fetch_band(band) for band in bands])
+
+    def fetch_pool_history(self, day_ids: List[int], max_objects_in_batch: int, min_liquidity: int,
+                           days_per_request=5, max_workers=4) -> Iterable[Tuple[int, List[Pool]]]:
+        """
+        Yields tuples (day id, pools) with the pool states at the closing block of each day.
+        Pages of several days are fetched in one request (aliased per day) and the groups
+        of days are fetched in parallel.
+        """
+        closing_timestamps = {day_id: (day_id + 1) * 86400 - 1 for day_id in day_ids}
+        blocks_after = self.get_blocks_after(closing_timestamps.values())
+        # The day which is not over yet (or not indexed yet) is taken at the highest indexed block
+        highest_block = self.get_highest_indexed_block(self.dex_graph)
+        closing_blocks = {day_id: min(blocks_after[timestamp] - 1, highest_block) if blocks_after[timestamp]
+                          else highest_block for day_id, timestamp in closing_timestamps.items()}
+        contexts = self._get_pool_contexts(set(closing_blocks.values()))
+        logging.info(f'{self.exchange}: Backfilling pools of days {min(day_ids)}-{max(day_ids)}, '
+                     f'closing blocks: {closing_blocks}')
+
+        def fetch_days(days: List[int]) -> Iterable[Tuple[int, List[Pool]]]:
+            cursors = {day_id: '' for day_id in days}
+            planner = QueryPlanner(self.dex_graph)
+            while cursors:
+                for day_id, last_id in cursors.items():
+                    planner.add(f'd{day_id}', *self._pool_page_query(closing_blocks[day_id], max_objects_in_batch,
+                                                                     min_liquidity, None, last_id))
+                results = planner.execute()
+                for day_id in list(cursors):
+                    raw_pools = results[f'd{day_id}']['pools']
+                    if len(raw_pools) < max_objects_in_batch:
+                        del cursors[day_id]
+                    else:
+                        cursors[day_id] = raw_pools[-1]['id']
+                    yield day_id, self._parse_pools(raw_pools, contexts[closing_blocks[day_id]])
+
+        groups = [day_ids[i:i + days_per_request] for i in range(0, len(day_ids), days_per_request)]
+        yield from iterate_in_parallel([lambda days=days: fetch_days(days) for days in groups], max_workers)
+
     def fetch_yields(self, last_block_update: int, max_objects_in_batch: int) -> Iterable[List[YieldReward]]:
         """
         Returns Yield rewards for a given exchange.
         """
-        query = '''{
-            rewards(first: $MAX_OBJECTS, skip: $SKIP, orderBy: blockNumber, orderDirection: asc, where: {blockNumber_gte: $BLOCK, exchange: "$EXCHANGE"}) {
-                id
-                stakingService
-                exchange
-                pool
-                amount
-                user
-                transaction
-                blockNumber
-                blockTimestamp
-            }
-        }'''
         logging.info(f'{self.exchange}: Last update block: {last_block_update}')
         skip = 0
         while True:
-            params = {
-                '$MAX_OBJECTS': max_objects_in_batch,
-                '$SKIP': skip,
-                '$BLOCK': last_block_update,
-                '$EXCHANGE': self.exchange.name,
+            variables = {
+                'first': self._page_size(max_objects_in_batch),
+                'skip': skip,
+                'block': last_block_update,
+                'exchange': self.exchange.name,
             }
-            raw_rewards = self.rewards_graph.query(query, params)['data']['rewards']
+            raw_rewards = self.rewards_graph.query(REWARDS_QUERY, variables)['data']['rewards']
             if not raw_rewards:
                 break
 
-            yield [self._parse_yield(reward) for reward in raw_rewards]
-            skip += max_objects_in_batch
+            skip += len(raw_rewards)
+            yield [self._parse_yield(reward) for reward in self._drop_seen(raw_rewards)]
 
     @staticmethod
     def get_highest_indexed_block(graph: SubgraphReader) -> int:
-        query = '''
-        {
-            _meta {
-                block {
-                    number
-                }
-            }
-        }
-        '''
-        resp = graph.query(query, {})
+        resp = graph.query(HIGHEST_INDEXED_BLOCK_QUERY, {})
         return int(resp['data']['_meta']['block']['number'])
 
     def _parse_yield(self, reward: Dict) -> YieldReward:
@@ -130,13 +375,19 @@ class Dex(ABC):
             StakingService[reward['stakingService']]
         )
 
-    def get_block_seconds_ago(self, seconds=86400):
-        query = '''{
-            blocks(first: 1, orderBy: timestamp, orderDirection: asc, where: {timestamp_gt: $TIMESTAMP}) {
-                number
-            }
-        }'''
-        params = {
-            '$TIMESTAMP': int(datetime.now().timestamp() - seconds)
-        }
-        return int(self.block_graph.query(query, params)['data']['blocks'][0]['number'])
+    def get_block_seconds_ago(self, seconds=86400) -> Optional[int]:
+        return self.get_blocks_after([int(datetime.now().timestamp() - seconds)]).popitem()[1]
+
+    def get_blocks_after(self, timestamps: Iterable[int]) -> Dict[int, Optional[int]]:
+        """
+        Returns the first block after each timestamp, None when there is no such block yet. Answered
+        by the local block index, the blocks subgraph is queried only for timestamps outside of the index.
+        """
+        blocks = self.block_index.blocks_after(timestamps)
+        for timestamp in [timestamp for timestamp, block in blocks.items() if block is None]:
+            blocks[timestamp] = self._query_block_after(timestamp)
+        return blocks
+
+    def _query_block_after(self, timestamp: int) -> Optional[int]:
+        blocks = self.block_graph.query(BLOCK_AFTER_QUERY, {'timestamp': timestamp})['data']['blocks']
+        return int(blocks[0]['number']) if blocks else None
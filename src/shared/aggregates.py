@@ -0,0 +1,203 @@
+from decimal import Decimal
+from typing import Callable, Dict, List, Optional
+
+import attr
+
+from src.shared.type_definitions import ShareSnap, YieldReward
+
+
+def _decimal(value) -> Decimal:
+    return Decimal(value)
+
+
+@attr.s(auto_attribs=True, slots=True)
+class PositionAggregate(object):
+    """
+    Position of a user in a pool, incrementally updated by the snaps in block order
+    """
+    liquidity_token_balance: Decimal = attr.ib(default=Decimal(0), converter=_decimal)
+    deposits_usd: Decimal = attr.ib(default=Decimal(0), converter=_decimal)
+    deposits_eth: Decimal = attr.ib(default=Decimal(0), converter=_decimal)
+    withdrawals_usd: Decimal = attr.ib(default=Decimal(0), converter=_decimal)
+    withdrawals_eth: Decimal = attr.ib(default=Decimal(0), converter=_decimal)
+    tx_cost_eth: Decimal = attr.ib(default=Decimal(0), converter=_decimal)
+    tx_cost_usd: Decimal = attr.ib(default=Decimal(0), converter=_decimal)
+    # Used to skip snaps which were already applied (fetching resumes at the last processed block)
+    last_block: int = 0
+    last_block_snap_ids: List[str] = attr.ib(factory=list)
+    latest_snap: Optional[Dict] = None
+
+    def apply(self, snap: ShareSnap) -> bool:
+        """
+        Returns False when the snap was already applied.
+        """
+        pool_value_usd = sum(token.reserve * token.price_usd for token in snap.tokens)
+        return self._apply(snap.id, snap.block, snap.liquidity_token_balance, snap.liquidity_token_total_supply,
+                           pool_value_usd, snap.eth_price, snap.tx_cost_eth, snap.to_serializable)
+
+    def apply_record(self, snap_id: str, record: Dict) -> bool:
+        """
+        Applies a stored snap (ShareSnap.to_serializable or to_compact_serializable).
+        """
+        pool_value_usd = sum(Decimal(token['reserve']) * Decimal(token['priceUsd']) for token in record['tokens'])
+        eth_price = record.get('ethPrice')
+        return self._apply(snap_id, int(record['block']), Decimal(record['liquidityTokenBalance']),
+                           Decimal(record['liquidityTokenTotalSupply']), pool_value_usd,
+                           Decimal(eth_price) if eth_price not in (None, 'None') else None,
+                           Decimal(record['txCostEth']), lambda: record)
+
+    def _apply(self, snap_id: str, block: int, balance: Decimal, total_supply: Decimal, pool_value_usd: Decimal,
+               eth_price: Optional[Decimal], tx_cost_eth: Decimal, serialize: Callable[[], Dict]) -> bool:
+        if block < self.last_block or (block == self.last_block and snap_id in self.last_block_snap_ids):
+            return False
+        delta = balance - self.liquidity_token_balance
+        amount_usd = abs(delta) * pool_value_usd / total_supply if total_supply else Decimal(0)
+        amount_eth = amount_usd / eth_price if eth_price else Decimal(0)
+        if delta > 0:
+            self.deposits_usd += amount_usd
+            self.deposits_eth += amount_eth
+        elif delta < 0:
+            self.withdrawals_usd += amount_usd
+            self.withdrawals_eth += amount_eth
+        self.tx_cost_eth += tx_cost_eth
+        if eth_price:
+            self.tx_cost_usd += tx_cost_eth * eth_price
+
+        self.liquidity_token_balance = balance
+        if block > self.last_block:
+            self.last_block, self.last_block_snap_ids = block, []
+        self.last_block_snap_ids.append(snap_id)
+        self.latest_snap = serialize()
+        return True
+
+    @staticmethod
+    def from_history(records: Dict[str, Dict]) -> 'PositionAggregate':
+        """
+        Aggregate of a position replayed from its stored snaps by snap id, used for positions which
+        existed before their aggregate.
+        """
+        aggregate = PositionAggregate()
+        for snap_id, record in sorted(records.items(), key=lambda item: (int(item[1]['block']), item[0])):
+            aggregate.apply_record(snap_id, record)
+        return aggregate
+
+    def to_serializable(self) -> Dict:
+        return {
+            'liquidityTokenBalance': str(self.liquidity_token_balance),
+            'depositsUsd': str(self.deposits_usd),
+            'depositsEth': str(self.deposits_eth),
+            'withdrawalsUsd': str(self.withdrawals_usd),
+            'withdrawalsEth': str(self.withdrawals_eth),
+            'txCostEth': str(self.tx_cost_eth),
+            'txCostUsd': str(self.tx_cost_usd),
+            'lastBlock': self.last_block,
+            'lastBlockSnapIds': self.last_block_snap_ids,
+            'latestSnap': self.latest_snap,
+        }
+
+    @staticmethod
+    def from_serializable(serializable: Optional[Dict]) -> 'PositionAggregate':
+        if not serializable:
+            return PositionAggregate()
+        return PositionAggregate(
+            serializable['liquidityTokenBalance'],
+            serializable['depositsUsd'],
+            serializable['depositsEth'],
+            serializable['withdrawalsUsd'],
+            serializable['withdrawalsEth'],
+            serializable['txCostEth'],
+            serializable['txCostUsd'],
+            serializable['lastBlock'],
+            serializable.get('lastBlockSnapIds', []),
+            serializable.get('latestSnap')
+        )
+
+
+@attr.s(auto_attribs=True, slots=True)
+class YieldAggregate(object):
+    """
+    Yields accrued by a user in a pool (or a staking service when the pool is not known)
+    """
+    amount: Decimal = attr.ib(default=Decimal(0), converter=_decimal)
+    count: int = 0
+    last_block: int = 0
+    last_block_yield_ids: List[str] = attr.ib(factory=list)
+
+    def apply(self, yield_: YieldReward) -> bool:
+        return self._apply(yield_.id, yield_.block, yield_.amount)
+
+    def _apply(self, yield_id: str, block: int, amount: Decimal) -> bool:
+        if block < self.last_block or (block == self.last_block and yield_id in self.last_block_yield_ids):
+            return False
+        self.amount += amount
+        self.count += 1
+        if block > self.last_block:
+            self.last_block, self.last_block_yield_ids = block, []
+        self.last_block_yield_ids.append(yield_id)
+        return True
+
+    @staticmethod
+    def from_history(records: Dict[str, Dict]) -> 'YieldAggregate':
+        """
+        Aggregate replayed from the stored yields (YieldReward.to_serializable) by yield id.
+        """
+        aggregate = YieldAggregate()
+        for yield_id, record in sorted(records.items(), key=lambda item: (int(item[1]['block']), item[0])):
+            aggregate._apply(yield_id, int(record['block']), Decimal(record['amount']))
+        return aggregate
+
+    def to_serializable(self) -> Dict:
+        return {
+            'amount': str(self.amount),
+            'count': self.count,
+            'lastBlock': self.last_block,
+            'lastBlockYieldIds': self.last_block_yield_ids,
+        }
+
+    @staticmethod
+    def from_serializable(serializable: Optional[Dict]) -> 'YieldAggregate':
+        if not serializable:
+            return YieldAggregate()
+        return YieldAggregate(
+            serializable['amount'],
+            serializable['count'],
+            serializable['lastBlock'],
+            serializable.get('lastBlockYieldIds', [])
+        )
+
+
+def position_aggregate_node(staking_service: Optional[str]) -> str:
+    """
+    Node of the position aggregates in users/{addr}/{exchange}, the positions staked in a staking service
+    are aggregated separately per service (the streams of the services are not ordered by block among
+    each other).
+    """
+    return f'stakedAggregates/{staking_service}' if staking_service else 'aggregates'
+
+
+def yield_aggregate_key(yield_: Dict) -> str:
+    """
+    Key of the aggregate of a stored yield (YieldReward.to_serializable) in yieldAggregates.
+    """
+    return yield_.get('poolId') or yield_['stakingService']
+
+
+def user_aggregates(snaps_by_pool: Dict[str, Dict], yields: Dict[str, Dict]) -> Dict[str, Dict]:
+    """
+    Serialized aggregates of a user by their path relative to users/{addr}/{exchange}.
+    """
+    aggregates = {}
+    for pool_id, snaps in snaps_by_pool.items():
+        histories = {}
+        for snap_id, snap in snaps.items():
+            # Stored snaps of staked positions carry their staking service
+            histories.setdefault(snap.get('stakingService'), {})[snap_id] = snap
+        for staking_service, history in histories.items():
+            aggregates[f'{position_aggregate_node(staking_service)}/{pool_id}'] = \
+                PositionAggregate.from_history(history).to_serializable()
+    yields_by_key = {}
+    for yield_id, yield_ in yields.items():
+        yields_by_key.setdefault(yield_aggregate_key(yield_), {})[yield_id] = yield_
+    for key, history in yields_by_key.items():
+        aggregates[f'yieldAggregates/{key}'] = YieldAggregate.from_history(history).to_serializable()
+    return aggregates
@@ -0,0 +1,125 @@
+import logging
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from typing import Optional, Iterable, Dict
+
+from src.query_template import QueryTemplate
+from src.subgraph import SubgraphReader
+
+BLOCKS_AFTER_NUMBER_QUERY = QueryTemplate('BlocksAfterNumber', {'first': 'Int!', 'number': 'BigInt!'}, '''
+{
+    blocks(first: $first, orderBy: number, orderDirection: asc, where: {number_gt: $number}) {
+        number
+        timestamp
+    }
+}
+''')
+
+BLOCKS_AFTER_TIMESTAMP_QUERY = QueryTemplate('BlocksAfterTimestamp', {'first': 'Int!', 'timestamp': 'BigInt!'}, '''
+{
+    blocks(first: $first, orderBy: number, orderDirection: asc, where: {timestamp_gt: $timestamp}) {
+        number
+        timestamp
+    }
+}
+''')
+
+
+class BlockIndex:
+    """
+    Local index of block numbers and timestamps answering timestamp -> block lookups
+    with a binary search. It's filled from the blocks subgraph, extended forward
+    when a lookup gets past its end and persisted to a file between runs.
+
+    An empty index starts at the oldest looked up timestamp (at most history_seconds ago) and a fill
+    appends at most max_fill_pages pages, so that a lookup never pays for a long fill. Timestamps
+    the index doesn't cover yet are answered with None and the index catches up over the next lookups.
+    """
+
+    PAGE_SIZE = 1000
+
+    def __init__(self, path: str, graph: SubgraphReader, history_seconds: int = 35 * 86400, max_fill_pages=10):
+        self.path = path
+        self.graph = graph
+        self.history_seconds = history_seconds
+        self.max_fill_pages = max_fill_pages
+        self.numbers = array('q')
+        self.timestamps = array('q')
+        self._lock = threading.Lock()
+        self._load()
+
+    def block_after(self, timestamp: int) -> Optional[int]:
+        """
+        Returns the first block with timestamp greater than the given one, or None when the timestamp
+        is older than the index history (or younger than the last block of the subgraph).
+        """
+        return self.blocks_after([timestamp])[timestamp]
+
+    def blocks_after(self, timestamps: Iterable[int]) -> Dict[int, Optional[int]]:
+        timestamps = sorted(set(timestamps))
+        if timestamps and (not self.timestamps or timestamps[-1] >= self.timestamps[-1]):
+            self.fill(timestamps[0])
+        blocks = {}
+        for timestamp in timestamps:
+            i = bisect_right(self.timestamps, timestamp)
+            # Index 0 means that the block could be older than the beginning of the index
+            blocks[timestamp] = self.numbers[i] if 0 < i < len(self.numbers) else None
+        return blocks
+
+    def fill(self, since: Optional[int] = None):
+        """
+        Appends up to max_fill_pages pages of blocks newer than the last indexed one, an empty index
+        starts at the since timestamp (clamped to the history).
+        """
+        with self._lock:
+            appended = 0
+            for _ in range(self.max_fill_pages):
+                if self.numbers:
+                    query, variables = BLOCKS_AFTER_NUMBER_QUERY, {'number': self.numbers[-1]}
+                else:
+                    oldest = int(time.time()) - self.history_seconds
+                    # A few blocks earlier, the lookup of the since timestamp needs the block preceding it
+                    variables = {'timestamp': max(oldest, since - 60) if since is not None else oldest}
+                    query = BLOCKS_AFTER_TIMESTAMP_QUERY
+                blocks = self.graph.query(query, {'first': self.PAGE_SIZE, **variables})['data']['blocks']
+                self.numbers.extend(int(block['number']) for block in blocks)
+                self.timestamps.extend(int(block['timestamp']) for block in blocks)
+                appended += len(blocks)
+                if len(blocks) < self.PAGE_SIZE:
+                    break
+            if appended:
+                logging.info(f'Appended {appended} blocks to the block index, last block: {self.numbers[-1]}')
+                self._save()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            count = array('q')
+            count.fromfile(f, 1)
+            self.numbers.fromfile(f, count[0])
+            self.timestamps.fromfile(f, count[0])
+
+    def _save(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            array('q', [len(self.numbers)]).tofile(f)
+            self.numbers.tofile(f)
+            self.timestamps.tofile(f)
+        os.replace(tmp_path, self.path)
+
+
+_shared_index: Optional[BlockIndex] = None
+
+
+def shared_block_index() -> BlockIndex:
+    """
+    Block index shared by all the Dex instances of the process.
+    """
+    global _shared_index
+    if _shared_index is None:
+        _shared_index = BlockIndex('/tmp/block-index.bin', SubgraphReader('blocklytics/ethereum-blocks'))
+    return _shared_index
@@ -0,0 +1,47 @@
+import time
+from typing import Optional
+
+
+class Deadline:
+    """
+    Wall-clock budget of an update loop. Cost of the next page (fetch, parsing and upload) is predicted
+    by an exponentially weighted moving average of the recent pages, so that the loop can stop at a page
+    boundary when the next page would not fit into the remaining time.
+    """
+
+    def __init__(self, budget: Optional[float], alpha=0.3, margin=1.5):
+        """
+        alpha is the weight of the last page in the average, the prediction is multiplied by margin.
+        """
+        self.end = None if budget is None else time.monotonic() + budget
+        self.alpha = alpha
+        self.margin = margin
+        self.page_cost: Optional[float] = None
+        self.pages = 0
+        self._page_started = time.monotonic()
+
+    def start(self):
+        """
+        Starts timing the first page of a loop.
+        """
+        self._page_started = time.monotonic()
+
+    def page_done(self):
+        now = time.monotonic()
+        cost, self._page_started = now - self._page_started, now
+        self.page_cost = cost if self.page_cost is None else self.alpha * cost + (1 - self.alpha) * self.page_cost
+        self.pages += 1
+
+    @property
+    def remaining(self) -> Optional[float]:
+        return None if self.end is None else self.end - time.monotonic()
+
+    @property
+    def predicted_page_cost(self) -> float:
+        return (self.page_cost or 0) * self.margin
+
+    def exhausted(self) -> bool:
+        """
+        True when the next page is predicted to end past the deadline.
+        """
+        return self.end is not None and self.remaining < self.predicted_page_cost
@@ -0,0 +1,192 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from decimal import Decimal
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from src.query_template import HIGHEST_INDEXED_BLOCK_QUERY
+from src.subgraph import SubgraphReader
+from src.uniswap_v2.queries import _eth_prices_query_generator
+
+
+class EthPriceOracle:
+    """
+    ETH/USD price series shared by all the exchanges, indexed by block and persisted to SQLite.
+    Missing prices are fetched in batches from one canonical source (bundle.ethPrice of Uniswap v2).
+
+    With interpolation_blocks > 0 the series is sampled on a grid of that many blocks and the prices
+    of blocks between two samples are interpolated linearly, so the prices of consecutive pages
+    and of different exchanges are served by the same few samples.
+
+    Exchanges fetching pages with a query planner get the missing samples (missing_samples) in the same
+    round trip as the page when they query the canonical subgraph (query_document, store_response),
+    the other exchanges fetch them concurrently with the page (fetch_async).
+    """
+
+    CANONICAL_SUBGRAPH = 'benesjan/uniswap-v2'
+    # Uniswap v2 prices are meaningful after its price discovery (see Uniswap.PRICE_DISCOVERY_START_TIMESTAMP)
+    CANONICAL_FIRST_BLOCK = 10100000
+    BATCH_SIZE = 100
+    HIGHEST_BLOCK_TTL = 60
+
+    def __init__(self, path: str, interpolation_blocks=0, graph: Optional[SubgraphReader] = None):
+        self.interpolation_blocks = interpolation_blocks
+        self.graph = graph or SubgraphReader(self.CANONICAL_SUBGRAPH)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS eth_prices (block INTEGER PRIMARY KEY, price TEXT NOT NULL)')
+        self._lock = threading.Lock()
+        self._highest_block = (0, 0.0)
+        self._fetcher = ThreadPoolExecutor(max_workers=2, thread_name_prefix='eth-price-oracle')
+
+    def prices(self, blocks: Iterable[int]) -> Dict[int, Decimal]:
+        """
+        Prices of blocks starting at CANONICAL_FIRST_BLOCK (the exchanges query older blocks themselves).
+        Blocks not indexed by the canonical source yet are left out.
+        """
+        blocks = set(blocks)
+        assert all(block >= self.CANONICAL_FIRST_BLOCK for block in blocks), 'Block before the canonical source'
+        found = self._load(blocks)
+        missing = blocks - found.keys()
+        if missing and self.interpolation_blocks:
+            found.update(self._interpolate(missing))
+            missing -= found.keys()
+        if missing:
+            found.update(self._fill(missing))
+        return found
+
+    def serves(self, graph: SubgraphReader) -> bool:
+        """
+        Whether the graph is the canonical source (its queries can be merged with the samples).
+        """
+        return graph.url == self.graph.url
+
+    def missing_samples(self, blocks: Iterable[int]) -> Set[int]:
+        """
+        Blocks which have to be fetched so that prices() of the blocks is served from the stored series
+        (the samples around the blocks when interpolating). Blocks not indexed by the source yet are left out.
+        """
+        blocks = set(blocks)
+        if not blocks:
+            return set()
+        assert all(block >= self.CANONICAL_FIRST_BLOCK for block in blocks), 'Block before the canonical source'
+        highest_block = self._get_highest_block()
+        if self.interpolation_blocks:
+            needed = {sample for pair in self._sample_pairs(blocks, highest_block).values() for sample in pair}
+        else:
+            needed = {block for block in blocks if block <= highest_block}
+        return needed - self._load(needed).keys()
+
+    def query_document(self, blocks: Iterable[int]) -> str:
+        """
+        Query of the canonical source for the prices of the blocks, its response data go to store_response.
+        """
+        return ''.join(_eth_prices_query_generator(sorted(blocks)))
+
+    def store_response(self, data: Dict) -> Dict[int, Decimal]:
+        fetched = {int(alias[1:]): Decimal(bundle['price']) for alias, bundle in data.items()}
+        self._store(fetched)
+        return fetched
+
+    def fetch_async(self, blocks: Iterable[int]) -> Future:
+        """
+        Fetches and stores the prices of the blocks (e.g. missing_samples) in the background.
+        """
+        return self._fetcher.submit(self._fill, set(blocks))
+
+    def fill_range(self, first_block: int, last_block: int):
+        """
+        Fetches the samples of the blocks in [first_block, last_block] (e.g. before a backfill).
+        """
+        step = self.interpolation_blocks or 1
+        first_sample = max(first_block - first_block % step, self.CANONICAL_FIRST_BLOCK)
+        self._fill(set(range(first_sample, last_block + step, step)))
+
+    def _sample_pairs(self, blocks: Set[int], highest_block: int) -> Dict[int, Tuple[int, int]]:
+        """
+        Samples (lower, upper) of every block which can be interpolated.
+        """
+        step = self.interpolation_blocks
+        samples = {}
+        for block in blocks:
+            lower = block - block % step
+            if lower == block:
+                samples[block] = (block, block)
+            elif lower + step <= highest_block:
+                samples[block] = (max(lower, self.CANONICAL_FIRST_BLOCK), lower + step)
+        return samples
+
+    def _interpolate(self, blocks: Set[int]) -> Dict[int, Decimal]:
+        samples = self._sample_pairs(blocks, self._get_highest_block())
+        sample_blocks = {sample for pair in samples.values() for sample in pair}
+        # _fill loads the stored samples first
+        sample_prices = self._fill(sample_blocks)
+        interpolated = {}
+        for block, (lower, upper) in samples.items():
+            if lower not in sample_prices or upper not in sample_prices:
+                continue
+            if lower == upper:
+                interpolated[block] = sample_prices[lower]
+            else:
+                weight = Decimal(block - lower) / Decimal(upper - lower)
+                interpolated[block] = sample_prices[lower] + (sample_prices[upper] - sample_prices[lower]) * weight
+        return interpolated
+
+    def _load(self, blocks: Set[int]) -> Dict[int, Decimal]:
+        blocks, found = sorted(blocks), {}
+        with self._lock:
+            for i in range(0, len(blocks), 900):
+                chunk = blocks[i:i + 900]
+                for block, price in self._conn.execute(f'SELECT block, price FROM eth_prices WHERE block IN '
+                                                       f'({",".join("?" * len(chunk))})', chunk):
+                    found[block] = Decimal(price)
+        return found
+
+    def _fill(self, blocks: Set[int]) -> Dict[int, Decimal]:
+        """
+        Returns prices of the blocks, the ones not stored yet are fetched from the canonical source.
+        """
+        stored = self._load(blocks)
+        highest_block = self._get_highest_block()
+        blocks = sorted(block for block in blocks - stored.keys() if block <= highest_block)
+        fetched = {}
+        for i in range(0, len(blocks), self.BATCH_SIZE):
+            data = self.graph.query(self.query_document(blocks[i:i + self.BATCH_SIZE]))['data']
+            fetched.update({int(alias[1:]): Decimal(bundle['price']) for alias, bundle in data.items()})
+        self._store(fetched)
+        return {**stored, **fetched}
+
+    def _store(self, fetched: Dict[int, Decimal]):
+        if fetched:
+            logging.info(f'Fetched {len(fetched)} ETH prices from the canonical source')
+            with self._lock:
+                self._conn.executemany('INSERT OR REPLACE INTO eth_prices (block, price) VALUES (?, ?)',
+                                       [(block, str(price)) for block, price in fetched.items()])
+
+    def _get_highest_block(self) -> int:
+        """
+        Blocks above the highest indexed block of the canonical source can't be fetched yet.
+        """
+        block, checked = self._highest_block
+        if time.monotonic() - checked > self.HIGHEST_BLOCK_TTL:
+            resp = self.graph.query(HIGHEST_INDEXED_BLOCK_QUERY, {})
+            block = int(resp['data']['_meta']['block']['number'])
+            self._highest_block = (block, time.monotonic())
+        return block
+
+
+_shared_oracle: Optional[EthPriceOracle] = None
+
+
+def shared_eth_price_oracle() -> EthPriceOracle:
+    """
+    Oracle shared by all the Dex instances of the process, ETH_PRICE_INTERPOLATION_BLOCKS enables
+    the interpolation.
+    """
+    global _shared_oracle
+    if _shared_oracle is None:
+        _shared_oracle = EthPriceOracle('/tmp/eth-prices.sqlite3',
+                                        int(os.environ.get('ETH_PRICE_INTERPOLATION_BLOCKS', '0')))
+    return _shared_oracle
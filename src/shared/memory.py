@@ -0,0 +1,59 @@
+import os
+import resource
+from typing import Optional
+
+MIN_PAGE_SIZE = 10
+
+
+def rss_mb() -> float:
+    """
+    Current resident set size of the process in MB.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        # Not Linux, peak RSS is the best estimate available (ru_maxrss is in kB)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class MemoryBudget:
+    """
+    Tracks peak RSS sampled between pages and shrinks the page size as the RSS growth since the start
+    of the job approaches the limit. RSS covers the whole process (shared caches, concurrent jobs and
+    memory CPython keeps after the previous jobs), so the job is measured against its own baseline.
+    Without a limit it only tracks the peak.
+    """
+
+    def __init__(self, limit_mb: Optional[float] = None):
+        self.limit_mb = limit_mb
+        self.peak_mb = 0.0
+        self.baseline_mb = rss_mb()
+
+    def sample(self) -> float:
+        rss = rss_mb()
+        self.peak_mb = max(self.peak_mb, rss)
+        return rss
+
+    def reset(self):
+        self.peak_mb = 0.0
+        self.baseline_mb = rss_mb()
+
+    def under_pressure(self) -> bool:
+        """
+        True once the job grew the RSS by half of the budget (the point where the page size starts to shrink).
+        """
+        rss = self.sample()
+        return self.limit_mb is not None and rss - self.baseline_mb >= self.limit_mb / 2
+
+    def page_size(self, requested: int) -> int:
+        """
+        Full page size while the job grew the RSS by less than half of the budget, then linearly smaller.
+        """
+        rss = self.sample()
+        if self.limit_mb is None:
+            return requested
+        headroom = self.limit_mb - max(rss - self.baseline_mb, 0)
+        if headroom >= self.limit_mb / 2:
+            return requested
+        return max(MIN_PAGE_SIZE, min(requested, int(requested * headroom / (self.limit_mb / 2))))
@@ -0,0 +1,64 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional
+
+from src.profiling import inherit_profiler
+
+
+def iterate_in_parallel(generators: List[Callable[[], Iterable]], max_workers: Optional[int] = None,
+                        buffer_size: Optional[int] = None) -> Iterable:
+    """
+    Runs the generators in a thread pool and yields their items as they arrive. At most buffer_size
+    items (two per generator by default) wait for the consumer, the generators block until it catches up.
+    Exceptions raised in the generators are re-raised in the caller.
+    """
+    items = queue.Queue(maxsize=buffer_size or 2 * max(len(generators), 1))
+    stopped = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        # Returns False when the consumer stopped reading
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(generator: Callable[[], Iterable]):
+        if stopped.is_set():
+            return
+        try:
+            for item in generator():
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((None, e))
+
+    with ThreadPoolExecutor(max_workers=max_workers or max(len(generators), 1),
+                            initializer=inherit_profiler()) as executor:
+        for generator in generators:
+            executor.submit(run, generator)
+        try:
+            running = len(generators)
+            while running:
+                item, error = items.get()
+                if error:
+                    raise error
+                if item is done:
+                    running -= 1
+                else:
+                    yield item
+        finally:
+            stopped.set()
+
+
+def prefetch(pages: Iterable, buffer_size: int) -> Iterable:
+    """
+    Fetches (and parses) the next pages in a background thread while the consumer processes the current
+    one, bounded by buffer_size pages.
+    """
+    return iterate_in_parallel([lambda: pages], buffer_size=buffer_size)
@@ -0,0 +1,30 @@
+from decimal import Decimal
+from typing import List, Iterable
+
+# Upper edges of the default layout, used before any pool density was observed
+DEFAULT_EDGES = [50000, 250000, 1000000, 10000000]
+
+
+def default_band_edges(min_liquidity: int, band_count: int) -> List[int]:
+    """
+    Returns lower edges of liquidity bands. Band i covers [edges[i], edges[i + 1]),
+    the last band is unbounded.
+    """
+    edges = [min_liquidity] + [edge for edge in DEFAULT_EDGES if edge > min_liquidity]
+    return edges[:band_count]
+
+
+def balanced_band_edges(liquidities: Iterable[Decimal], min_liquidity: int, band_count: int) -> List[int]:
+    """
+    Computes band edges so that each band contains roughly the same amount of pools
+    (quantiles of the observed liquidity distribution).
+    """
+    values = sorted(liquidity for liquidity in liquidities if liquidity >= min_liquidity)
+    if len(values) < band_count:
+        return default_band_edges(min_liquidity, band_count)
+    edges = [min_liquidity]
+    for i in range(1, band_count):
+        edge = int(values[len(values) * i // band_count])
+        if edge > edges[-1]:
+            edges.append(edge)
+    return edges
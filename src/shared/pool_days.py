@@ -0,0 +1,111 @@
+import base64
+import json
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+from src.shared.type_definitions import Pool, pool_metadata_key
+
+# Per-pool fields of a chunk, stored as one list per field in the order of the pool ids
+POOL_COLUMNS = ('liquidityTokenTotalSupply', 'volumeUsd', 'swapFee')
+
+
+def _shared_fields(pool: Pool) -> Dict:
+    """
+    Fields of the pool state which are the same for all the pools fetched at one block.
+    """
+    shared = {'block': pool.block, 'ethPrice': str(pool.eth_price)}
+    if pool.relevant_yield_token_prices:
+        shared['relevantYieldTokenPrices'] = {staking_service.name: str(price) for staking_service, price
+                                              in pool.relevant_yield_token_prices.items()}
+    return shared
+
+
+class PoolDayChunks:
+    """
+    Chunks of poolDays/{exchange}/{day_id}/chunks accumulated over the pages of pools of one day, so that
+    a day is uploaded as one chunk per group of pools sharing the block, eth price and yield token prices
+    instead of a chunk per page. Pools are kept as their columns, the pages can be released once added.
+    """
+
+    def __init__(self):
+        # Shared fields and columns by the JSON of the shared fields
+        self._groups: Dict[str, Tuple[Dict, Dict[str, List]]] = {}
+        self.pool_count = 0
+
+    def add(self, pools: List[Pool]):
+        for pool in pools:
+            shared = _shared_fields(pool)
+            key = json.dumps(shared, sort_keys=True)
+            if key not in self._groups:
+                self._groups[key] = (shared, {column: [] for column in ('id', 'metadataId', 'tokens') + POOL_COLUMNS})
+            columns = self._groups[key][1]
+            serializable = pool.to_serializable()
+            columns['id'].append(pool.id)
+            columns['metadataId'].append(pool.pool_metadata_id())
+            columns['tokens'].append([token.to_compact_serializable() for token in pool.tokens])
+            for column in POOL_COLUMNS:
+                columns[column].append(serializable[column])
+            self.pool_count += 1
+
+    def encode(self, compress=False) -> Dict[str, Dict]:
+        """
+        Chunks keyed by their block and first pool id so that a retried day overwrites its own chunks. Pool data
+        are stored column-wise, tokens without their metadata (see Pool.pool_metadata) and with the version
+        of the metadata (metadataId). With compress set the columns are stored as a zlib compressed, base64
+        encoded JSON blob instead.
+        """
+        chunks = {}
+        for shared, columns in self._groups.values():
+            order = sorted(range(len(columns['id'])), key=lambda i: columns['id'][i])
+            columns = {column: [values[i] for i in order] for column, values in columns.items()}
+            chunk = dict(shared)
+            if compress:
+                chunk['blob'] = base64.b64encode(zlib.compress(json.dumps(columns).encode())).decode()
+            else:
+                chunk['columns'] = columns
+            chunks[f'{shared["block"]}_{columns["id"][0]}'] = chunk
+        return chunks
+
+
+def encode_pool_day_chunks(pools: List[Pool], compress=False) -> Dict[str, Dict]:
+    """
+    Encodes a page of pools as chunks of poolDays/{exchange}/{day_id}/chunks, see PoolDayChunks.
+    """
+    chunks = PoolDayChunks()
+    chunks.add(pools)
+    return chunks.encode(compress)
+
+
+def decode_pool_day(day: Dict, exchange: str, pool_metadata: Optional[Dict[str, Dict]] = None) -> Dict[str, Dict]:
+    """
+    Decodes poolDays/{exchange}/{day_id} to pool snaps by pool id in the format of poolSnaps/{pool_id}/{day_id}.
+    Token metadata are taken from pool_metadata (poolMetadata/{exchange}) by the metadata version of each pool
+    (chunks written before the versioning reference the metadata of the pool id), tokens of pools without
+    metadata are left without it. A pool present in several chunks (the day was rewritten with different page
+    boundaries) is taken from the chunk with the highest block.
+    """
+    pool_metadata = pool_metadata or {}
+    pools = {}
+    for chunk in sorted((day.get('chunks') or {}).values(), key=lambda chunk: chunk['block']):
+        columns = chunk.get('columns')
+        if columns is None:
+            columns = json.loads(zlib.decompress(base64.b64decode(chunk['blob'])))
+        for i, pool_id in enumerate(columns['id']):
+            tokens = columns['tokens'][i]
+            metadata_ids = columns.get('metadataId')
+            metadata = pool_metadata.get(pool_metadata_key(pool_id, metadata_ids[i] if metadata_ids else None))
+            if metadata:
+                tokens = [{'token': token_metadata, **token} for token_metadata, token
+                          in zip(metadata['tokens'], tokens)]
+            pool = {
+                'exchange': exchange,
+                'tokens': tokens,
+                'block': chunk['block'],
+                'ethPrice': chunk['ethPrice'],
+            }
+            for column in POOL_COLUMNS:
+                pool[column] = columns[column][i]
+            if chunk.get('relevantYieldTokenPrices'):
+                pool['relevantYieldTokenPrices'] = chunk['relevantYieldTokenPrices']
+            pools[pool_id] = pool
+    return pools
@@ -0,0 +1,21 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter spacing out requests to at most `rate` per second.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
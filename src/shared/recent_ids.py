@@ -0,0 +1,37 @@
+from collections import OrderedDict
+from typing import Dict, Iterable, List
+
+
+class RecentIds:
+    """
+    Bounded set of the most recently seen entity ids, the oldest ids are evicted first.
+    """
+
+    def __init__(self, capacity=10000, ids: Iterable[str] = ()):
+        self.capacity = capacity
+        self._ids = OrderedDict()
+        for id_ in ids:
+            self.add(id_)
+
+    def add(self, id_: str) -> bool:
+        """
+        Returns False when the id was already seen.
+        """
+        if id_ in self._ids:
+            return False
+        self._ids[id_] = None
+        if len(self._ids) > self.capacity:
+            self._ids.popitem(last=False)
+        return True
+
+    def filter(self, raw_entities: List[Dict]) -> List[Dict]:
+        """
+        Drops the entities which were already seen and marks the rest as seen.
+        """
+        return [entity for entity in raw_entities if self.add(entity['id'])]
+
+    def __contains__(self, id_: str) -> bool:
+        return id_ in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
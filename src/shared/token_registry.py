@@ -0,0 +1,71 @@
+import logging
+import sqlite3
+import threading
+from typing import Dict, Iterable, Callable, Tuple, List, Optional
+
+from src.shared.type_definitions import CurrencyField
+
+# Returns (symbol, name) of the given token addresses
+TokenLookup = Callable[[List[str]], Dict[str, Tuple[str, str]]]
+
+
+class TokenRegistry:
+    """
+    Token metadata shared across exchanges. Kept in memory and persisted to SQLite,
+    unknown tokens are fetched in batches by the lookup of the exchange which
+    encountered them. Tokens which the lookup does not find (or finds without symbol and name)
+    are not cached, they are looked up again when encountered next time.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS tokens (address TEXT PRIMARY KEY, symbol TEXT, name TEXT)')
+        self._lock = threading.Lock()
+        self._tokens: Dict[str, CurrencyField] = {
+            address: CurrencyField(symbol=symbol, name=name, contract_address=address, platform='ethereum')
+            for address, symbol, name in self._conn.execute('SELECT address, symbol, name FROM tokens')
+        }
+
+    def resolve(self, addresses: Iterable[str], lookup: TokenLookup):
+        """
+        Makes sure metadata of all the addresses are known.
+        """
+        unknown = sorted({address for address in addresses if address not in self._tokens})
+        if not unknown:
+            return
+        found = {address: (symbol, name) for address, (symbol, name) in lookup(unknown).items() if symbol or name}
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO tokens (address, symbol, name) VALUES (?, ?, ?)',
+                                   [(address, symbol, name) for address, (symbol, name) in found.items()])
+            for address, (symbol, name) in found.items():
+                self._tokens[address] = CurrencyField(symbol=symbol, name=name, contract_address=address,
+                                                      platform='ethereum')
+        missing = set(unknown) - set(found)
+        if missing:
+            logging.warning(f'Metadata of tokens {missing} not found')
+
+    def get(self, address: str) -> CurrencyField:
+        token = self._tokens.get(address)
+        if token is None:
+            # Not persisted, the lookup might succeed next time
+            return CurrencyField(symbol='', name='', contract_address=address, platform='ethereum')
+        return token
+
+    def is_resolved(self, address: str) -> bool:
+        """
+        False for tokens whose metadata are not known yet (get returns an empty symbol and name).
+        """
+        return address in self._tokens
+
+
+_shared_registry: Optional[TokenRegistry] = None
+
+
+def shared_token_registry() -> TokenRegistry:
+    """
+    Token registry shared by all the Dex instances of the process.
+    """
+    global _shared_registry
+    if _shared_registry is None:
+        _shared_registry = TokenRegistry('/tmp/token-registry.sqlite3')
+    return _shared_registry
@@ -1,6 +1,9 @@
+import hashlib
+import json
+import os
 from decimal import Decimal
 from enum import Enum
-from typing import List, Optional, Dict
+from typing import Iterable, List, Optional, Dict
 
 import attr
 
@@ -36,12 +39,54 @@ class PoolToken(object):
             'priceUsd': str(self.price_usd)
         }
 
+    def to_compact_serializable(self) -> Dict:
+        """
+        Same as to_serializable without the token metadata (stored once per pool, see ShareSnap.pool_metadata).
+        """
+        return {
+            'weight': str(self.weight),
+            'reserve': str(self.reserve),
+            'priceUsd': str(self.price_usd)
+        }
 
-class Exchange(Enum):
-    UNI_V2 = 0
-    BALANCER = 1
-    SUSHI = 2
-    MATERIA = 3
+
+def pool_metadata_id(token_addresses: Iterable[str]) -> str:
+    """
+    Version of the metadata of a pool, a hash of its token addresses in their order. Records referencing
+    the metadata store it, a pool whose tokens change (a Balancer pool adding or removing a token) gets
+    new metadata instead of having its earlier records decoded against the wrong tokens.
+    """
+    return hashlib.sha1(','.join(token_addresses).encode()).hexdigest()[:10]
+
+
+def pool_metadata_key(pool_id: str, metadata_id: Optional[str]) -> str:
+    """
+    Key of the metadata in poolMetadata/{exchange}, records without a metadata id (written before
+    the metadata were versioned) reference the metadata keyed by the pool id.
+    """
+    return f'{pool_id}_{metadata_id}' if metadata_id else pool_id
+
+
+# Fork registry (see src/forks.py)
+FORKS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                          'forks.json')
+
+
+def _fork_exchanges(path: str) -> List[str]:
+    try:
+        with open(path) as f:
+            return list(json.load(f))
+    except FileNotFoundError:
+        return []
+
+
+_EXCHANGES = ['UNI_V2', 'BALANCER', 'SUSHI', 'MATERIA']
+
+# Forks registered in forks.json are members as well (following the exchanges above in the order of the file),
+# so that adding a fork is a change of the registry only
+Exchange = Enum('Exchange', [(name, value) for value, name in
+                             enumerate(_EXCHANGES + [name for name in _fork_exchanges(FORKS_PATH)
+                                                     if name not in _EXCHANGES])])
 
 
 class StakingService(Enum):
@@ -78,6 +123,22 @@ class Pool(object):
                                                         in self.relevant_yield_token_prices.items()}
         return serializable
 
+    def pool_metadata(self) -> Dict:
+        return {'tokens': [token.token.to_serializable() for token in self.tokens]}
+
+    def pool_metadata_id(self) -> str:
+        return pool_metadata_id(token.token.contract_address for token in self.tokens)
+
+
+@attr.s(auto_attribs=True, slots=True)
+class PoolContext(object):
+    """
+    Values shared by all the pools fetched at one block
+    """
+    block: int
+    eth_price: Decimal
+    relevant_yield_token_prices: Dict[StakingService, Decimal]
+
 
 @attr.s(auto_attribs=True, slots=True)
 class ShareSnap(object):
@@ -121,6 +182,24 @@ class ShareSnap(object):
             serializable['idWithinStakingContract'] = int(self.id.split('-')[0])
         return serializable
 
+    def to_compact_serializable(self) -> Dict:
+        """
+        Snap record which references the pool metadata instead of repeating it, the metadata are
+        poolMetadata/{exchange}/{pool_metadata_key(pool_id, metadataId)}. The exchange is omitted because
+        it's a part of the path. Tokens are in the same order as in pool_metadata().
+        """
+        serializable = self.to_serializable()
+        del serializable['exchange']
+        serializable['tokens'] = [token.to_compact_serializable() for token in self.tokens]
+        serializable['metadataId'] = self.pool_metadata_id()
+        return serializable
+
+    def pool_metadata(self) -> Dict:
+        return {'tokens': [token.token.to_serializable() for token in self.tokens]}
+
+    def pool_metadata_id(self) -> str:
+        return pool_metadata_id(token.token.contract_address for token in self.tokens)
+
 
 @attr.s(auto_attribs=True, slots=True)
 class YieldReward(object):
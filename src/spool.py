@@ -0,0 +1,129 @@
+import fcntl
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, Callable, Optional
+
+from src.error_definitions import SpoolLockedException
+from src.profiling import inherit_profiler
+
+
+class UploadSpool:
+    """
+    Durable local write-ahead log of database uploads.
+
+    Every entry is a multi-path update (path -> serializable value) which is persisted
+    to SQLite before a background thread drains it to the database in insertion order.
+    Checkpoints are spooled as ordinary entries after the data they cover, so they
+    get written only once everything before them was written.
+
+    A spool file is used by one spool at a time (an exclusive lock of {path}.lock), two drainers
+    would replay the same entries. The lock, the drainer thread and the connection are released by close().
+    """
+
+    def __init__(self, path: str, writer: Callable[[Dict], None], max_retries=5, retry_delay=1.0):
+        self.path = path
+        self.writer = writer
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._lock_file = open(f'{path}.lock', 'w')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            raise SpoolLockedException(f'Spool {path} is used by another job')
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                           '(seq INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL)')
+        self._cond = threading.Condition()
+        self._error: Optional[Exception] = None
+        self._closed = False
+        self._drainer = threading.Thread(target=self._drain_loop, args=(inherit_profiler(),),
+                                         name=f'spool-drainer-{path}', daemon=True)
+        self._drainer.start()
+
+    def append(self, updates: Dict):
+        """
+        Persist an update to the spool and schedule it for draining.
+        """
+        if not updates:
+            return
+        with self._cond:
+            if self._error:
+                raise self._error
+            self._conn.execute('INSERT INTO entries (payload) VALUES (?)', (json.dumps(updates),))
+            self._cond.notify_all()
+
+    def pending(self) -> int:
+        with self._cond:
+            return self._conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def flush(self, timeout: Optional[float] = None):
+        """
+        Block until all the spooled entries are drained. Raises the drain error
+        in case the retries were exhausted (the entries stay on disk for the next run).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while not self._error and self._peek() is not None:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f'Spool {self.path} not drained in {timeout} seconds')
+                self._cond.wait(remaining)
+            if self._error:
+                raise self._error
+
+    def close(self):
+        """
+        Waits for the drainer to write the spooled entries and stops it, entries which failed to drain
+        stay on disk for the next run.
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._drainer.join()
+        self._conn.close()
+        # Closing the file releases the lock
+        self._lock_file.close()
+
+    def _peek(self):
+        return self._conn.execute('SELECT seq, payload FROM entries ORDER BY seq LIMIT 1').fetchone()
+
+    def _drain_loop(self, initializer: Callable[[], None]):
+        initializer()
+        while True:
+            with self._cond:
+                entry = self._peek()
+                while entry is None or self._error:
+                    if self._closed:
+                        return
+                    self._cond.wait()
+                    entry = self._peek()
+            seq, payload = entry
+            try:
+                self._write_with_retries(json.loads(payload))
+            except Exception as e:
+                logging.error(f'Draining of spool {self.path} failed, entry {seq} kept on disk: {e}')
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                continue
+            with self._cond:
+                self._conn.execute('DELETE FROM entries WHERE seq = ?', (seq,))
+                self._cond.notify_all()
+
+    def _write_with_retries(self, updates: Dict):
+        for attempt in range(self.max_retries):
+            try:
+                self.writer(updates)
+                return
+            except Exception as e:
+                if attempt == self.max_retries - 1:
+                    raise
+                delay = self.retry_delay * 2 ** attempt
+                logging.warning(f'Spool write failed ({e}), retrying in {delay} seconds')
+                time.sleep(delay)
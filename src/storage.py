@@ -0,0 +1,242 @@
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, Any, Optional, List, Tuple
+
+import firebase_admin
+from firebase_admin import credentials
+from firebase_admin import db
+
+
+def firebase_root_ref():
+    if not firebase_admin._apps:
+        cred = credentials.Certificate('serviceAccountKey.json')
+        firebase_admin.initialize_app(cred, {
+            'databaseURL': 'https://croco-finance-a02aa.firebaseio.com/'
+            # 'databaseURL': 'https://croco-finance.firebaseio.com/'
+        })
+    return db.reference('/')
+
+
+class Storage(ABC):
+    """
+    Tree of JSON values addressed by '/'-separated paths (the Firebase Realtime Database model).
+    """
+
+    @abstractmethod
+    def get(self, path: str) -> Any:
+        """
+        Returns the value at the path (including all the descendants) or None.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def keys(self, path: str) -> List[str]:
+        """
+        Returns the keys of the children of the node at the path without reading their values.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_range(self, path: str, end_at: str, limit_to_last: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Returns the children of the node at the path whose keys are at most end_at in the key order
+        (the last limit_to_last of them when given), only these children are read.
+        Keys which are integers are ordered numerically before the other keys, as in the Realtime Database.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def update(self, updates: Dict[str, Any]):
+        """
+        Atomically replaces the value at every path of the multi-path update, None deletes the value.
+        """
+        raise NotImplementedError
+
+
+class FirebaseStorage(Storage):
+    def __init__(self, root_ref=None):
+        self.root_ref = root_ref or firebase_root_ref()
+
+    def get(self, path: str) -> Any:
+        return self.root_ref.child(path).get() if path else self.root_ref.get()
+
+    def keys(self, path: str) -> List[str]:
+        return list(self.root_ref.child(path).get(shallow=True) or {})
+
+    def get_range(self, path: str, end_at: str, limit_to_last: Optional[int] = None) -> Dict[str, Any]:
+        query = self.root_ref.child(path).order_by_key().end_at(end_at)
+        if limit_to_last is not None:
+            query = query.limit_to_last(limit_to_last)
+        return dict(query.get() or {})
+
+    def update(self, updates: Dict[str, Any]):
+        self.root_ref.update(updates)
+
+
+class SQLiteStorage(Storage):
+    """
+    Local sink storing every value of a multi-path update as a single JSON row, so that ingestion
+    runs at the speed of the subgraphs and the snaps can be queried with the SQLite JSON functions.
+    Each update is a single transaction of bulk inserts.
+    """
+
+    # Max number of SQL variables in a statement of older SQLite versions
+    CHUNK_SIZE = 900
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS nodes (path TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> Any:
+        path = path.strip('/')
+        with self._lock:
+            # The value might be stored as a part of an ancestor
+            prefixes = _prefixes(path) + [path] if path else []
+            rows = dict(self._select_paths(prefixes))
+            for prefix in prefixes:
+                if prefix in rows:
+                    value = json.loads(rows[prefix])
+                    for key in path[len(prefix):].split('/')[1:]:
+                        if not isinstance(value, dict) or key not in value:
+                            return None
+                        value = value[key]
+                    return value
+            rows = self._select_descendants(path)
+        if not rows:
+            return None
+        tree = {}
+        for row_path, value in rows:
+            *parents, leaf = row_path[len(path) + 1 if path else 0:].split('/')
+            node = tree
+            for parent in parents:
+                node = node.setdefault(parent, {})
+            node[leaf] = json.loads(value)
+        return tree
+
+    def keys(self, path: str) -> List[str]:
+        path = path.strip('/')
+        with self._lock:
+            stored_within = self._select_paths(_prefixes(path) + [path]) if path else []
+            if not stored_within:
+                if path:
+                    # '0' follows '/' in the collation order
+                    rows = self._conn.execute('SELECT path FROM nodes WHERE path > ? AND path < ?',
+                                              (path + '/', path + '0')).fetchall()
+                else:
+                    rows = self._conn.execute('SELECT path FROM nodes').fetchall()
+                return sorted({row_path[len(path) + 1 if path else 0:].split('/', 1)[0] for row_path, in rows})
+        value = self.get(path)
+        return list(value) if isinstance(value, dict) else []
+
+    def get_range(self, path: str, end_at: str, limit_to_last: Optional[int] = None) -> Dict[str, Any]:
+        path = path.strip('/')
+        keys = sorted((key for key in self.keys(path) if _key_order(key) <= _key_order(end_at)), key=_key_order)
+        if limit_to_last is not None:
+            keys = keys[-limit_to_last:] if limit_to_last else []
+        return {key: self.get(f'{path}/{key}') for key in keys}
+
+    def update(self, updates: Dict[str, Any]):
+        updates = {path.strip('/'): value for path, value in updates.items()}
+        with self._lock, self._conn:
+            # Values stored as a part of an ancestor row are written to the ancestor
+            ancestors = {path: json.loads(value) for path, value in
+                         self._select_paths({prefix for path in updates for prefix in _prefixes(path)})}
+            rows = {}
+            for path, value in updates.items():
+                ancestor = next((prefix for prefix in _prefixes(path) if prefix in ancestors), None)
+                if ancestor is None:
+                    rows[path] = value
+                    continue
+                if not isinstance(ancestors[ancestor], dict):
+                    ancestors[ancestor] = {}
+                _set_nested(ancestors[ancestor], path[len(ancestor) + 1:].split('/'), value)
+                rows[ancestor] = ancestors[ancestor]
+            self._conn.executemany('DELETE FROM nodes WHERE path > ? AND path < ?',
+                                   [(path + '/', path + '0') for path in updates])
+            # Empty nodes don't exist in the Realtime Database either
+            self._conn.executemany('DELETE FROM nodes WHERE path = ?',
+                                   [(path,) for path, value in rows.items() if value is None or value == {}])
+            self._conn.executemany('INSERT OR REPLACE INTO nodes (path, value) VALUES (?, ?)',
+                                   [(path, json.dumps(value)) for path, value in rows.items()
+                                    if value is not None and value != {}])
+
+    def _select_paths(self, paths) -> List:
+        paths, rows = list(paths), []
+        for i in range(0, len(paths), self.CHUNK_SIZE):
+            chunk = paths[i:i + self.CHUNK_SIZE]
+            rows.extend(self._conn.execute(f'SELECT path, value FROM nodes WHERE path IN '
+                                           f'({",".join("?" * len(chunk))})', chunk))
+        return rows
+
+    def _select_descendants(self, path: str) -> List:
+        if not path:
+            return self._conn.execute('SELECT path, value FROM nodes').fetchall()
+        # '0' follows '/' in the collation order
+        return self._conn.execute('SELECT path, value FROM nodes WHERE path > ? AND path < ?',
+                                  (path + '/', path + '0')).fetchall()
+
+
+def _prefixes(path: str) -> List[str]:
+    """
+    Proper ancestors of the path, e.g. ['a', 'a/b'] of 'a/b/c'.
+    """
+    parts = path.split('/')
+    return ['/'.join(parts[:i]) for i in range(1, len(parts))]
+
+
+def _key_order(key: str) -> Tuple:
+    """
+    Sort key of the Realtime Database key order, 32-bit integer keys go first in numeric order.
+    """
+    try:
+        number = int(key)
+    except ValueError:
+        return 1, 0, key
+    if str(number) == key and -2 ** 31 <= number < 2 ** 31:
+        return 0, number, ''
+    return 1, 0, key
+
+
+def _set_nested(node: Dict, keys: List[str], value):
+    *parents, leaf = keys
+    for parent in parents:
+        if not isinstance(node.get(parent), dict):
+            node[parent] = {}
+        node = node[parent]
+    if value is None:
+        node.pop(leaf, None)
+    else:
+        node[leaf] = value
+
+
+def create_storage() -> Storage:
+    """
+    Storage selected by the STORAGE_BACKEND environment variable: 'firebase' (default) or 'sqlite'
+    (written to STORAGE_PATH, /tmp/storage.sqlite3 by default).
+    """
+    backend = os.environ.get('STORAGE_BACKEND', 'firebase')
+    if backend == 'firebase':
+        return FirebaseStorage()
+    elif backend == 'sqlite':
+        return SQLiteStorage(os.environ.get('STORAGE_PATH', '/tmp/storage.sqlite3'))
+    raise ValueError(f'Unknown storage backend: {backend}')
+
+
+_shared_storage: Optional[Storage] = None
+
+
+def shared_storage() -> Storage:
+    """
+    Storage shared by all the controllers of the process (a local sink is a single SQLite connection).
+    """
+    global _shared_storage
+    if _shared_storage is None:
+        _shared_storage = create_storage()
+    return _shared_storage
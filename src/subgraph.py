@@ -1,9 +1,35 @@
 import logging
+import os
+import threading
+from typing import Dict, Optional, Set, Union
 from urllib.parse import urljoin
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from src.error_definitions import NonExistentUserException, NotIndexedBlockException
+from src.query_template import QueryTemplate
+
+# Connections kept open per host, enough for the forks and pool workers running concurrently
+HTTP_POOL_SIZE = 32
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def shared_session() -> requests.Session:
+    """
+    HTTP session shared by all the readers of the process, so that the connections to the hosts
+    (most subgraphs are served by the same one) are reused instead of opened per request.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+    return _session
 
 
 class SubgraphReader:
@@ -11,28 +37,65 @@ class SubgraphReader:
     General read handler of subgraph's data.
     """
 
-    def __init__(self, subgraph):
+    def __init__(self, subgraph, persisted_queries: Optional[bool] = None):
+        """
+        With persisted_queries (PERSISTED_QUERIES=1 by default) templates are sent as a hash of the document
+        and variables once the document was registered (automatic persisted queries protocol).
+        """
         if subgraph.startswith('http'):
             self.url = subgraph
         else:
-            provider = 'https://api.thegraph.com/subgraphs/name/'
+            # SUBGRAPH_PROVIDER points the readers e.g. to the synthetic subgraphs of the load tests (benchmarks/)
+            provider = os.environ.get('SUBGRAPH_PROVIDER', 'https://api.thegraph.com/subgraphs/name/')
             # provider = 'http://graph.marlin.pro/subgraphs/name/'
             self.url = urljoin(provider, subgraph)
+        if persisted_queries is None:
+            persisted_queries = os.environ.get('PERSISTED_QUERIES') == '1'
+        self.persisted_queries = persisted_queries
+        # Hashes of the documents registered by this reader
+        self._persisted: Set[str] = set()
 
-    def query(self, query, params=None):
+    def query(self, query: Union[str, QueryTemplate], params=None):
         """
-        Execute query, with optional parameters.
+        Execute query, with optional parameters (variables of a template).
         """
+        if isinstance(query, QueryTemplate):
+            return self._query_template(query, params or {})
         if params:
             query = self._pass_params(query, params)
-        result = requests.post(self.url, json={'query': query}).json()
+        return self._post({'query': query}, query)
+
+    def _query_template(self, template: QueryTemplate, variables: Dict):
+        payload = {'operationName': template.name, 'variables': variables}
+        if not (self.persisted_queries and template.persist):
+            return self._post({**payload, 'query': template.document}, template.document)
+        payload['extensions'] = {'persistedQuery': {'version': 1, 'sha256Hash': template.sha256}}
+        if template.sha256 in self._persisted:
+            result = self._post(payload, template.document, persisted=True)
+            if not self._persisted_query_not_found(result):
+                return result
+        result = self._post({**payload, 'query': template.document}, template.document)
+        self._persisted.add(template.sha256)
+        return result
+
+    @staticmethod
+    def _persisted_query_not_found(result) -> bool:
+        return bool(result) and any(error.get('message') == 'PersistedQueryNotFound'
+                                    for error in result.get('errors', []))
+
+    def _post(self, payload: Dict, query: str, persisted=False):
+        result = shared_session().post(self.url, json=payload).json()
+        if persisted and self._persisted_query_not_found(result):
+            # Evicted by the server, the caller registers the document again
+            return result
         if result and 'data' not in result:
             for error in result['errors']:
                 if error['message'] == 'Null value resolved for non-null field `user`':
                     raise NonExistentUserException()
                 elif 'Failed to decode `block.number`' in error['message']:
                     raise NotIndexedBlockException(f'Subgraph: {self.url}, message: {error["message"]}')
-            logging.error(f'Request fetching failed. Result: {result},\nquery: {query}, subgraph: {self.url}')
+            logging.error(f'Request fetching failed. Result: {result},\nquery: {query}, '
+                          f'variables: {payload.get("variables")}, subgraph: {self.url}')
         return result
 
     @staticmethod
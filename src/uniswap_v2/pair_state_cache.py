@@ -0,0 +1,66 @@
+import json
+import sqlite3
+import threading
+from typing import Dict, Iterable, Tuple, Optional
+
+# (block, pair id)
+PairStateKey = Tuple[int, str]
+
+
+class PairStateCache:
+    """
+    Historical pair states (pair entities at a block) persisted to SQLite. A state at a past block never
+    changes, so it can be reused by later pages and runs. The least recently used states are evicted
+    once there are more than `capacity` of them.
+    """
+
+    def __init__(self, path: str, capacity=100000):
+        self.capacity = capacity
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS pair_states (exchange TEXT, block INTEGER, pair TEXT, '
+                           'state TEXT NOT NULL, used INTEGER NOT NULL, PRIMARY KEY (exchange, block, pair))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS pair_states_used ON pair_states (used)')
+        self._lock = threading.Lock()
+        self._clock = self._conn.execute('SELECT COALESCE(MAX(used), 0) FROM pair_states').fetchone()[0]
+
+    def get_many(self, exchange: str, keys: Iterable[PairStateKey]) -> Dict[PairStateKey, Dict]:
+        found = {}
+        with self._lock:
+            self._clock += 1
+            for block, pair in keys:
+                row = self._conn.execute('SELECT state FROM pair_states WHERE exchange = ? AND block = ? AND pair = ?',
+                                         (exchange, block, pair)).fetchone()
+                if row:
+                    found[(block, pair)] = json.loads(row[0])
+            self._conn.executemany('UPDATE pair_states SET used = ? WHERE exchange = ? AND block = ? AND pair = ?',
+                                   [(self._clock, exchange, block, pair) for block, pair in found])
+        return found
+
+    def put_many(self, exchange: str, states: Dict[PairStateKey, Dict]):
+        if not states:
+            return
+        with self._lock:
+            self._clock += 1
+            self._conn.execute('BEGIN')
+            self._conn.executemany('INSERT OR REPLACE INTO pair_states (exchange, block, pair, state, used) '
+                                   'VALUES (?, ?, ?, ?, ?)',
+                                   [(exchange, block, pair, json.dumps(state), self._clock)
+                                    for (block, pair), state in states.items()])
+            excess = self._conn.execute('SELECT COUNT(*) FROM pair_states').fetchone()[0] - self.capacity
+            if excess > 0:
+                self._conn.execute('DELETE FROM pair_states WHERE rowid IN '
+                                   '(SELECT rowid FROM pair_states ORDER BY used LIMIT ?)', (excess,))
+            self._conn.execute('COMMIT')
+
+
+_shared_cache: Optional[PairStateCache] = None
+
+
+def shared_pair_state_cache() -> PairStateCache:
+    """
+    Pair state cache shared by all the Uniswap instances of the process.
+    """
+    global _shared_cache
+    if _shared_cache is None:
+        _shared_cache = PairStateCache('/tmp/pair-states.sqlite3')
+    return _shared_cache
@@ -1,4 +1,4 @@
-from typing import Iterable, List
+from typing import Iterable, Tuple
 
 
 def _eth_prices_query_generator(block_heights: Iterable[int]) -> Iterable[str]:
@@ -23,8 +23,10 @@ def _eth_prices_query_generator(block_heights: Iterable[int]) -> Iterable[str]:
     yield '}'
 
 
-def _staked_query_generator(staked: List) -> Iterable[str]:
+def _staked_query_generator(pair_states: Iterable[Tuple[int, str]]) -> Iterable[str]:
     """
+    Generates one alias per (block, pair id), positions sharing a pair state share the alias.
+
     Example return value:
     {
         b11113293_0xbb2b8038a1640196fbe3e38816f3e67cba72d940: pair(id:"0xbb2b8038a1640196fbe3e38816f3e67cba72d940", block: { number: 11113293 }) {
@@ -35,21 +37,16 @@ def _staked_query_generator(staked: List) -> Iterable[str]:
             reserveUSD
             token0 {
                 id
-                symbol
-                name
             }
             token1 {
                 id
-                symbol
-                name
             }
         }
        ...
     }
     """
     yield '{\n'
-    for position in staked:
-        pool_id, block = position["pool"], position['blockNumber']
+    for block, pool_id in pair_states:
         yield f'''b{block}_{pool_id}: pair(id:"{pool_id}", block: {{ number: {block} }}) {{
             id
             totalSupply
@@ -58,13 +55,9 @@ def _staked_query_generator(staked: List) -> Iterable[str]:
             reserveUSD
             token0 {{
                 id
-                symbol
-                name
             }}
             token1 {{
                 id
-                symbol
-                name
             }}
         }}
         '''
@@ -1,13 +1,165 @@
 import logging
+import threading
 from collections import defaultdict
 from decimal import Decimal
-from typing import List, Dict, Iterable, Callable, Optional
+from typing import List, Dict, Iterable, Callable, Optional, Tuple
 
-from src.shared.Dex import Dex
-from src.shared.type_definitions import ShareSnap, PoolToken, CurrencyField, Pool, StakingService
+from src.query_planner import QueryPlanner
+from src.query_template import QueryTemplate
+from src.shared.Dex import Dex, HIGHEST_INDEXED_BLOCK_QUERY
+from src.shared.type_definitions import ShareSnap, PoolToken, Pool, StakingService, PoolContext, Exchange
 from src.subgraph import SubgraphReader
 from src.uniswap_v2.queries import _staked_query_generator, _eth_prices_query_generator, yield_reserves_query_generator
-from src.uniswap_v2.yield_pools import yield_pools
+from src.uniswap_v2.pair_state_cache import shared_pair_state_cache
+from src.uniswap_v2.type_definitions import YieldPool
+from src.uniswap_v2.yield_pools import yield_pools as default_yield_pools
+
+YIELD_TOKEN_PRICE_CACHE_SIZE = 100000
+
+# (yield pool id, block) -> price of the yield token, shared by the Uniswap forks of the process
+_yield_token_prices: Dict[Tuple[str, int], Decimal] = {}
+_yield_token_prices_lock = threading.Lock()
+
+SNAPS_QUERY = QueryTemplate('UniswapSnaps', {'first': 'Int!', 'skip': 'Int!', 'block': 'Int!'}, '''
+{
+    snaps: liquidityPositionSnapshots(first: $first, skip: $skip, orderBy: block, orderDirection: asc, where: {block_gte: $block}) {
+        id
+        timestamp
+        block
+        user {
+            id
+        }
+        pair {
+            id
+            token0 {
+                id
+            }
+            token1 {
+                id
+            }
+        }
+        reserve0
+        reserve1
+        reserveUSD
+        totalSupply: liquidityTokenTotalSupply
+        liquidityTokenBalance
+        transaction {
+            id
+            gasUsed
+            gasPrice
+        }
+    }
+}
+''')
+
+STAKE_POSITIONS_QUERY = QueryTemplate(
+    'UniswapStakePositions', {'first': 'Int!', 'skip': 'Int!', 'block': 'BigInt!', 'exchange': 'Exchange!'}, '''
+{
+    stakePositionSnapshots(first: $first, skip: $skip, orderBy: blockNumber, orderDirection: asc, where: {blockNumber_gte: $block, exchange: $exchange}) {
+        id
+        stakingService
+        user
+        pool
+        liquidityTokenBalance
+        blockNumber
+        blockTimestamp
+        txHash
+        txGasUsed
+        txGasPrice
+    }
+}
+''')
+
+STAKING_SERVICE_POSITIONS_QUERY = QueryTemplate(
+    'UniswapStakingServicePositions',
+    {'first': 'Int!', 'skip': 'Int!', 'block': 'BigInt!', 'exchange': 'Exchange!', 'stakingService': 'StakingService!'},
+    '''
+{
+    stakePositionSnapshots(first: $first, skip: $skip, orderBy: blockNumber, orderDirection: asc, where: {blockNumber_gte: $block, exchange: $exchange, stakingService: $stakingService}) {
+        id
+        stakingService
+        user
+        pool
+        liquidityTokenBalance
+        blockNumber
+        blockTimestamp
+        txHash
+        txGasUsed
+        txGasPrice
+    }
+}
+''')
+
+POOLS_QUERY = QueryTemplate('UniswapPools', {'first': 'Int!', 'skip': 'Int!', 'minLiquidity': 'BigDecimal!'}, '''
+{
+    pairs(first: $first, skip: $skip, orderBy: reserveUSD, orderDirection: desc, where: {reserveUSD_gte: $minLiquidity}) {
+        id
+        reserveUSD
+        reserve0
+        reserve1
+        volumeUSD
+        totalSupply
+        token0 {
+            id
+        }
+        token1 {
+            id
+        }
+    }
+}
+''')
+
+POOL_PAGE_QUERY = QueryTemplate(
+    'UniswapPoolPage', {'first': 'Int!', 'block': 'Int!', 'minLiquidity': 'BigDecimal!', 'lastId': 'ID!'}, '''
+{
+    pools: pairs(first: $first, orderBy: id, orderDirection: asc, block: {number: $block}, where: {reserveUSD_gte: $minLiquidity, id_gt: $lastId}) {
+        id
+        reserveUSD
+        reserve0
+        reserve1
+        volumeUSD
+        totalSupply
+        token0 {
+            id
+        }
+        token1 {
+            id
+        }
+    }
+}
+''')
+
+LIQUIDITY_BAND_PAGE_QUERY = QueryTemplate(
+    'UniswapLiquidityBandPage',
+    {'first': 'Int!', 'block': 'Int!', 'minLiquidity': 'BigDecimal!', 'maxLiquidity': 'BigDecimal!', 'lastId': 'ID!'},
+    '''
+{
+    pools: pairs(first: $first, orderBy: id, orderDirection: asc, block: {number: $block}, where: {reserveUSD_gte: $minLiquidity, reserveUSD_lt: $maxLiquidity, id_gt: $lastId}) {
+        id
+        reserveUSD
+        reserve0
+        reserve1
+        volumeUSD
+        totalSupply
+        token0 {
+            id
+        }
+        token1 {
+            id
+        }
+    }
+}
+''')
+
+TOKENS_QUERY = QueryTemplate('UniswapTokens', {'ids': '[ID!]!'}, '''
+{
+    tokens(first: 1000, where: {id_in: $ids}) {
+        id
+        symbol
+        name
+    }
+}
+''')
 
 
 class Uniswap(Dex):
@@ -25,58 +177,30 @@ class Uniswap(Dex):
     # - taken from uniswap.info source code
     PRICE_DISCOVERY_START_TIMESTAMP = 1589747086
 
+    def __init__(self, dex_graph_name: str, exchange: Exchange, eth_price_first_block=0,
+                 price_overrides: Optional[Dict[str, Decimal]] = None,
+                 yield_pools: Optional[Dict[StakingService, YieldPool]] = None):
+        """
+        Forks configure their own price overrides and yield pools (see src/forks.py).
+        """
+        super().__init__(dex_graph_name, exchange, eth_price_first_block)
+        self.price_overrides = self.PRICE_OVERRIDES if price_overrides is None else price_overrides
+        self.yield_pools = default_yield_pools if yield_pools is None else yield_pools
+        self.pair_state_cache = shared_pair_state_cache()
+
     def fetch_new_snaps(self, last_block_update: int, max_objects_in_batch: int) -> Iterable[List[ShareSnap]]:
-        query = '''{
-            snaps: liquidityPositionSnapshots(first: $MAX_OBJECTS, skip: $SKIP, orderBy: block, orderDirection: asc, where: {block_gte: $BLOCK}) {
-                id
-                timestamp
-                block
-                user {
-                    id
-                }
-                pair {
-                    id
-                    token0 {
-                        id
-                        symbol
-                        name
-                    }
-                    token1 {
-                        id
-                        symbol
-                        name
-                    }
-                }
-                reserve0
-                reserve1
-                reserveUSD
-                totalSupply: liquidityTokenTotalSupply
-                liquidityTokenBalance
-                transaction {
-                    id
-                    gasUsed
-                    gasPrice
-                }
-            }
-        }'''
-        highest_indexed_block = self.get_highest_indexed_block(self.dex_graph)
-        logging.info(f'{self.exchange}: Last update block: {last_block_update}, '
-                     f'highest indexed block: {highest_indexed_block}')
-        skip = 0
-        while True:
-            params = {
-                '$MAX_OBJECTS': max_objects_in_batch,
-                '$SKIP': skip,
-                '$BLOCK': last_block_update,
-            }
-            raw_snaps = self.dex_graph.query(query, params)['data']['snaps']
-            if not raw_snaps:
-                break
-            snaps = [self._process_snap(snap) for snap in raw_snaps]
-            self._populate_eth_prices(snaps)
+        yield from self._fetch_snap_pages(SNAPS_QUERY, {'block': last_block_update}, max_objects_in_batch,
+                                          self._process_snaps)
 
-            yield snaps
-            skip += max_objects_in_batch
+    def staking_services(self) -> List[StakingService]:
+        """
+        Services of the yield pools of the fork (yieldPools in forks.json).
+        """
+        return list(self.yield_pools)
+
+    def _process_snaps(self, raw_snaps: List[Dict]) -> List[ShareSnap]:
+        self._resolve_tokens(self._pool_token_addresses([snap['pair'] for snap in raw_snaps]))
+        return [self._process_snap(snap) for snap in raw_snaps]
 
     def _process_snap(self, snap: Dict) -> ShareSnap:
         reserves_usd = Decimal(snap['reserveUSD'])
@@ -87,12 +211,9 @@ class Uniswap(Dex):
                 price = reserves_usd / (2 * res)
             else:
                 price = 0
-                logging.warning(f'0 reserves for token {tok["symbol"]} in snap {snap["id"]}. '
+                logging.warning(f'0 reserves for token {tok["id"]} in snap {snap["id"]}. '
                                 'Setting token price to 0.')
-            tokens.append(PoolToken(CurrencyField(symbol=tok['symbol'],
-                                                  name=tok['name'],
-                                                  contract_address=tok['id'],
-                                                  platform='ethereum'),
+            tokens.append(PoolToken(self.token_registry.get(tok['id']),
                                     Decimal('0.5'),
                                     res,
                                     price
@@ -115,60 +236,57 @@ class Uniswap(Dex):
 
     def fetch_new_staked_snaps(self, last_block_update: int, max_objects_in_batch: int,
                                staking_service: Optional[StakingService] = None) -> Iterable[List[ShareSnap]]:
-        highest_indexed_block = self.get_highest_indexed_block(self.rewards_graph)
+        variables = {
+            'first': self._page_size(max_objects_in_batch),
+            'skip': 0,
+            'block': last_block_update,
+            'exchange': self.exchange.name,
+        }
+        query = STAKE_POSITIONS_QUERY
+        if staking_service:
+            query = STAKING_SERVICE_POSITIONS_QUERY
+            variables['stakingService'] = staking_service.name
+        planner = QueryPlanner(self.rewards_graph)
+        planner.add('meta', HIGHEST_INDEXED_BLOCK_QUERY)
+        planner.add('page', query, variables)
+        results = planner.execute()
         logging.info(f'{self.exchange}: Last update block: {last_block_update}, '
-                     f'highest indexed block: {highest_indexed_block}')
-        skip = 0
-        while True:
-            params = {
-                '$MAX_OBJECTS': max_objects_in_batch,
-                '$SKIP': skip,
-                '$BLOCK': last_block_update,
-                '$EXCHANGE': self.exchange.name,
-                '$STAKING_SERVICE_FILTER': f', stakingService: {staking_service.name}' if staking_service else ''
-            }
-            snaps = self._get_staked_snaps(params)
-            skip += max_objects_in_batch
-            if len(snaps) == 0:
-                break
-            self._populate_eth_prices(snaps)
+                     f'highest indexed block: {results["meta"]["_meta"]["block"]["number"]}')
+        stake_positions = results['page']['stakePositionSnapshots']
+        while stake_positions:
+            variables['skip'] += len(stake_positions)
+            stake_positions = self._drop_seen(stake_positions)
+            snaps = self._get_staked_snaps(stake_positions) if stake_positions else []
+            stake_positions = results = None
             self._populate_yield_prices(snaps)
 
             yield snaps
+            variables['first'] = self._page_size(max_objects_in_batch)
+            stake_positions = self.rewards_graph.query(query, variables)['data']['stakePositionSnapshots']
 
-    def _get_staked_snaps(self, params: Dict) -> List[ShareSnap]:
-        query = '''
-        {
-            stakePositionSnapshots(first: $MAX_OBJECTS, skip: $SKIP, orderBy: blockNumber, orderDirection: asc, where: {blockNumber_gte: $BLOCK, exchange: $EXCHANGE$STAKING_SERVICE_FILTER}) {
-                id
-                stakingService
-                user
-                pool
-                liquidityTokenBalance
-                blockNumber
-                blockTimestamp
-                txHash
-                txGasUsed
-                txGasPrice
-            }
-        }
-        '''
-        # 1. Get the positions and snapshots
-        stake_position = self.rewards_graph.query(query, params)['data']['stakePositionSnapshots']
-        staked_dict = {f'b{stake["blockNumber"]}_{stake["pool"]}-{stake["id"]}': stake for stake in stake_position}
-
-        if not stake_position:
-            return []
-
-        # 2. get the pool shares at the time of those snapshots
-        query = ''.join(_staked_query_generator(stake_position))
-        data = self.dex_graph.query(query, {})['data']
-        # build the snap list and return
-        snaps = []
-        for key, stake_position in staked_dict.items():
-            pool_key = key.split("-")[0]
-            pool = data[pool_key]
-            snaps.append(self._build_share_snap(stake_position, pool))
+    def _get_staked_snaps(self, stake_positions: List[Dict]) -> List[ShareSnap]:
+        """
+        Fetches the pool states at the time of the stake position snapshots together with eth prices
+        in one request and builds the snaps.
+        """
+        keys = {(int(position['blockNumber']), position['pool']) for position in stake_positions}
+        pools = self.pair_state_cache.get_many(self.exchange.name, keys)
+        missing = sorted(keys - pools.keys())
+        logging.info(f'{self.exchange}: {len(stake_positions)} stake positions, {len(keys)} pair states, '
+                     f'{len(missing)} not cached')
+        planner = QueryPlanner(self.dex_graph)
+        if missing:
+            planner.add('pools', ''.join(_staked_query_generator(missing)))
+        self._plan_prices(planner, {block for block, _ in keys})
+        results = planner.execute()
+        if missing:
+            fetched = {(block, pool_id): results['pools'][f'b{block}_{pool_id}'] for block, pool_id in missing}
+            self.pair_state_cache.put_many(self.exchange.name, fetched)
+            pools.update(fetched)
+        self._resolve_tokens(self._pool_token_addresses(pools.values()))
+        snaps = [self._build_share_snap(position, pools[(int(position['blockNumber']), position['pool'])])
+                 for position in stake_positions]
+        self._apply_prices(snaps, results)
         return snaps
 
     def _build_share_snap(self, stake_position: Dict, pool: Dict) -> ShareSnap:
@@ -178,8 +296,8 @@ class Uniswap(Dex):
             tok, res = pool[f'token{i}'], Decimal(pool[f'reserve{i}'])
 
             if int(stake_position['blockTimestamp']) < self.PRICE_DISCOVERY_START_TIMESTAMP and \
-                    tok['id'] in self.PRICE_OVERRIDES:
-                price_usd = self.PRICE_OVERRIDES[tok['id']]
+                    tok['id'] in self.price_overrides:
+                price_usd = self.price_overrides[tok['id']]
             else:
                 # In the graph Pair object the price is stored relatively
                 # between the 2 tokens. To compute the USD price I used
@@ -190,11 +308,7 @@ class Uniswap(Dex):
                 # ==> t1Dollars = reserveUSD/(2*r1)
                 price_usd = 0 if res == 0 else reserves_usd / (2 * res)
 
-            token_type = CurrencyField(symbol=tok['symbol'],
-                                       name=tok['name'],
-                                       contract_address=tok['id'],
-                                       platform='ethereum')
-            tokens.append(PoolToken(token_type,
+            tokens.append(PoolToken(self.token_registry.get(tok['id']),
                                     Decimal('0.5'),
                                     res,
                                     price_usd))
@@ -219,81 +333,108 @@ class Uniswap(Dex):
     def _populate_yield_prices(self, snaps: List[ShareSnap]):
         yield_grouped_block_filtered_snaps = defaultdict(list)
         for snap in snaps:
-            yield_pool = yield_pools[snap.staking_service]
-            if snap.block >= yield_pool.firs_block:
+            yield_pool = self.yield_pools.get(snap.staking_service)
+            if yield_pool and snap.block >= yield_pool.firs_block:
                 yield_grouped_block_filtered_snaps[snap.staking_service].append(snap)
         if not yield_grouped_block_filtered_snaps:
             return
 
         for staking_service_name, snap_list in yield_grouped_block_filtered_snaps.items():
-            blocks = {snap.block for snap in snap_list}
-            yield_pool = yield_pools[staking_service_name]
-            query = ''.join(yield_reserves_query_generator(blocks, yield_pools[staking_service_name].pool_id))
-            data = SubgraphReader(yield_pool.subgraph_name).query(query)
-            prices = {int(block[1:]): Decimal(val['reserveUSD']) / (2 * Decimal(val['reserve0'])) for
-                      block, val in data['data'].items()}
+            prices = self._get_yield_token_prices(self.yield_pools[staking_service_name],
+                                                  {snap.block for snap in snap_list})
             for snap in snap_list:
                 snap.yield_token_price = prices[snap.block]
 
+    @staticmethod
+    def _get_yield_token_prices(yield_pool: YieldPool, blocks: Iterable[int]) -> Dict[int, Decimal]:
+        """
+        The prices are cached for the whole process, the forks share the same yield pools.
+        """
+        blocks = set(blocks)
+        with _yield_token_prices_lock:
+            prices = {block: _yield_token_prices[(yield_pool.pool_id, block)] for block in blocks
+                      if (yield_pool.pool_id, block) in _yield_token_prices}
+        missing = blocks - prices.keys()
+        if not missing:
+            return prices
+        query = ''.join(yield_reserves_query_generator(missing, yield_pool.pool_id))
+        data = SubgraphReader(yield_pool.subgraph_name).query(query)
+        fetched = {int(block[1:]): Decimal(val['reserveUSD']) / (2 * Decimal(val['reserve0'])) for
+                   block, val in data['data'].items()}
+        with _yield_token_prices_lock:
+            if len(_yield_token_prices) > YIELD_TOKEN_PRICE_CACHE_SIZE:
+                _yield_token_prices.clear()
+            _yield_token_prices.update({(yield_pool.pool_id, block): price for block, price in fetched.items()})
+        return {**prices, **fetched}
+
     def fetch_pools(self, max_objects_in_batch: int, min_liquidity: int, skip: int = 0) -> Iterable[List[Pool]]:
-        query = '''{
-            pairs(first: $MAX_OBJECTS, skip: $SKIP, orderBy: reserveUSD, orderDirection: desc, where: {reserveUSD_gte: $MIN_LIQUIDITY}) {
-                id
-                reserveUSD
-                reserve0
-                reserve1
-                volumeUSD
-                totalSupply
-                token0 {
-                    id
-                    symbol
-                    name
-                }
-                token1 {
-                    id
-                    symbol
-                    name
-                }
-            }
-        }'''
-        highest_indexed_block = self.get_highest_indexed_block(self.dex_graph)
-        eth_price = self._get_eth_usd_prices([highest_indexed_block])[highest_indexed_block]
-        yield_token_prices = self._get_relevant_yield_token_prices()
+        context = self._get_pool_context()
         while True:
-            params = {
-                '$MAX_OBJECTS': max_objects_in_batch,
-                '$SKIP': skip,
-                '$MIN_LIQUIDITY': min_liquidity,
+            variables = {
+                'first': max_objects_in_batch,
+                'skip': skip,
+                'minLiquidity': str(min_liquidity),
             }
-            raw_pools = self.dex_graph.query(query, params)['data']['pairs']
+            raw_pools = self.dex_graph.query(POOLS_QUERY, variables)['data']['pairs']
             if not raw_pools:
                 break
 
-            yield [self._parse_pool(pool, highest_indexed_block, eth_price, yield_token_prices) for pool in raw_pools]
+            yield self._parse_pools(raw_pools, context)
             skip += max_objects_in_batch
 
+    def _get_pool_context(self) -> PoolContext:
+        highest_indexed_block = self.get_highest_indexed_block(self.dex_graph)
+        eth_price = self._get_eth_usd_prices([highest_indexed_block])[highest_indexed_block]
+        return PoolContext(highest_indexed_block, eth_price, self._get_relevant_yield_token_prices())
+
+    def _get_pool_contexts(self, blocks: Iterable[int]) -> Dict[int, PoolContext]:
+        blocks = set(blocks)
+        eth_prices = self._get_eth_usd_prices(blocks)
+        yield_token_prices = defaultdict(dict)
+        for staking_service, yield_pool in self.yield_pools.items():
+            relevant_blocks = {block for block in blocks if block >= yield_pool.firs_block}
+            if relevant_blocks:
+                for block, price in self._get_yield_token_prices(yield_pool, relevant_blocks).items():
+                    yield_token_prices[block][staking_service] = price
+        return {block: PoolContext(block, eth_prices[block], yield_token_prices[block]) for block in blocks}
+
+    def _pool_page_query(self, block: int, max_objects_in_batch: int, min_liquidity: int,
+                         max_liquidity: Optional[int], last_id: str) -> Tuple[QueryTemplate, Dict]:
+        variables = {
+            'first': max_objects_in_batch,
+            'block': block,
+            'minLiquidity': str(min_liquidity),
+            'lastId': last_id,
+        }
+        if max_liquidity is None:
+            return POOL_PAGE_QUERY, variables
+        return LIQUIDITY_BAND_PAGE_QUERY, {**variables, 'maxLiquidity': str(max_liquidity)}
+
     def _get_relevant_yield_token_prices(self) -> Dict[StakingService, Decimal]:
         prices = {}
-        for staking_service, yield_pool in yield_pools.items():
-            subgraph = SubgraphReader(yield_pool.subgraph_name)
-            highest_indexed_block = self.get_highest_indexed_block(subgraph)
-            query = ''.join(yield_reserves_query_generator([highest_indexed_block], yield_pool.pool_id))
-            data = SubgraphReader(yield_pool.subgraph_name).query(query)
-            val = list(data['data'].values())[0]
-            prices[staking_service] = Decimal(val['reserveUSD']) / (2 * Decimal(val['reserve0']))
+        for staking_service, yield_pool in self.yield_pools.items():
+            highest_indexed_block = self.get_highest_indexed_block(SubgraphReader(yield_pool.subgraph_name))
+            prices[staking_service] = self._get_yield_token_prices(yield_pool, [highest_indexed_block])[
+                highest_indexed_block]
         return prices
 
-    def _parse_pool(self, raw_pool: Dict, block: int, eth_price: Decimal,
-                    relevant_yield_token_prices: Dict[StakingService, Decimal]) -> Pool:
+    def _pool_token_addresses(self, raw_pools: Iterable[Dict]) -> Iterable[str]:
+        return [pool[f'token{i}']['id'] for pool in raw_pools for i in range(2)]
+
+    def _lookup_tokens(self, addresses: List[str]) -> Dict[str, Tuple[str, str]]:
+        found = {}
+        for i in range(0, len(addresses), 1000):
+            for token in self.dex_graph.query(TOKENS_QUERY, {'ids': addresses[i:i + 1000]})['data']['tokens']:
+                found[token['id']] = (token['symbol'], token['name'])
+        return found
+
+    def _parse_pool(self, raw_pool: Dict, context: PoolContext) -> Pool:
         reserves_usd = Decimal(raw_pool['reserveUSD'])
         tokens: List[PoolToken] = []
         for i in range(2):
             tok, res = raw_pool[f'token{i}'], Decimal(raw_pool[f'reserve{i}'])
             price_usd = reserves_usd / (2 * res) if res else 0
-            tokens.append(PoolToken(CurrencyField(symbol=tok['symbol'],
-                                                  name=tok['name'],
-                                                  contract_address=tok['id'],
-                                                  platform='ethereum'),
+            tokens.append(PoolToken(self.token_registry.get(tok['id']),
                                     Decimal('0.5'),
                                     res,
                                     price_usd
@@ -303,8 +444,8 @@ class Uniswap(Dex):
             self.exchange,
             Decimal(raw_pool['totalSupply']),
             tokens,
-            block,
-            eth_price,
+            context.block,
+            context.eth_price,
             Decimal(raw_pool['volumeUSD']),
-            relevant_yield_token_prices
+            context.relevant_yield_token_prices
         )
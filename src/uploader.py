@@ -0,0 +1,132 @@
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from typing import Dict, Callable, Deque, List, Optional
+
+from src.profiling import inherit_profiler
+from src.shared.rate_limiter import RateLimiter
+
+
+class ShardedUploader:
+    """
+    Writes multi-path updates concurrently. Paths under users/ are sharded by a prefix of the user
+    address into one shard per worker and every shard is written as a separate multi-path update
+    by the thread of the shard (other paths have a shard of their own), so the writes of a path land
+    in the order of the updates.
+
+    Checkpoints are written by a single committer thread only after all the writes submitted
+    before them succeeded, so a checkpoint never gets ahead of the data it covers.
+
+    With max_pending_writes a write waits until fewer updates than that are being written,
+    so that the serialized pages don't pile up in memory when the database is slower than the fetching.
+    """
+
+    def __init__(self, writer: Callable[[Dict], None], max_workers=8, max_requests_per_second: Optional[float] = None,
+                 max_pending_writes: Optional[int] = None):
+        self.writer = writer
+        self.max_pending_writes = max_pending_writes
+        # Shard futures of the updates being written, oldest first
+        self._pending_writes: Deque[List[Future]] = deque()
+        self.shard_count = max_workers
+        self.limiter = RateLimiter(max_requests_per_second) if max_requests_per_second else None
+        # One thread per shard, the last one writes the paths outside of users/
+        initializer = inherit_profiler()
+        self._executors = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'uploader-{shard}',
+                                              initializer=initializer)
+                           for shard in range(max_workers + 1)]
+        self._committer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='uploader-committer',
+                                             initializer=initializer)
+        self._pending: List[Future] = []
+        self._commits: List[Future] = []
+        self._error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+
+    def write(self, updates: Dict) -> List[Future]:
+        """
+        Submits the shards of the update and returns their futures without waiting.
+        """
+        self._raise_error()
+        if self.max_pending_writes:
+            while self._pending_writes and (len(self._pending_writes) >= self.max_pending_writes or
+                                            all(future.done() for future in self._pending_writes[0])):
+                wait(self._pending_writes.popleft())
+        futures = [self._executors[shard].submit(self._write_shard, shard_updates)
+                   for shard, shard_updates in self._shard(updates).items()]
+        with self._lock:
+            self._pending = [future for future in self._pending if not future.done()] + futures
+        if self.max_pending_writes:
+            self._pending_writes.append(futures)
+        return futures
+
+    def write_sync(self, updates: Dict):
+        """
+        Writes the shards concurrently and waits for them. Errors are raised to the caller only
+        (the caller is responsible for retries, e.g. the spool).
+        """
+        futures = [self._executors[shard].submit(self._write, shard_updates)
+                   for shard, shard_updates in self._shard(updates).items()]
+        for future in futures:
+            future.result()
+
+    def write_checkpoint(self, updates: Dict):
+        """
+        Writes the update once all the previously submitted writes completed successfully.
+        """
+        self._raise_error()
+        with self._lock:
+            dependencies = list(self._pending)
+            self._commits = [commit for commit in self._commits if not commit.done()]
+            self._commits.append(self._committer.submit(self._commit, dependencies, updates))
+
+    def flush(self):
+        """
+        Waits for all the writes and checkpoints, raises the first error.
+        """
+        with self._lock:
+            futures = self._pending + self._commits
+        wait(futures)
+        self._raise_error()
+
+    def close(self):
+        """
+        Stops the threads once the submitted writes and checkpoints are done, called once the run is over.
+        """
+        for executor in self._executors:
+            executor.shutdown()
+        self._committer.shutdown()
+
+    def _commit(self, dependencies: List[Future], updates: Dict):
+        wait(dependencies)
+        if self._error:
+            # Data of the checkpoint might be missing
+            return
+        self._write_shard(updates)
+
+    def _write_shard(self, updates: Dict):
+        if self._error:
+            return
+        try:
+            self._write(updates)
+        except BaseException as e:
+            self._error = self._error or e
+            raise
+
+    def _write(self, updates: Dict):
+        if self.limiter:
+            self.limiter.wait()
+        self.writer(updates)
+
+    def _shard(self, updates: Dict) -> Dict[int, Dict]:
+        shards = defaultdict(dict)
+        for path, value in updates.items():
+            parts = path.split('/', 2)
+            if parts[0] == 'users' and len(parts) > 1:
+                # Addresses start with 0x, the following hex digits are uniformly distributed
+                shards[int(parts[1][2:6] or '0', 16) % self.shard_count][path] = value
+            else:
+                shards[self.shard_count][path] = value
+        return shards
+
+    def _raise_error(self):
+        if self._error:
+            raise self._error
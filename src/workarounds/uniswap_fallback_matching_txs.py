@@ -32,13 +32,9 @@ class UniNullUserFallbackMatchingTxs(UniMatchingTxs):
                     id
                     token0 {
                         id
-                        symbol
-                        name
                     }
                     token1 {
                         id
-                        symbol
-                        name
                     }
                 }
                 reserve0
@@ -54,6 +50,7 @@ class UniNullUserFallbackMatchingTxs(UniMatchingTxs):
         for snap_id in raw_snap_ids:
             try:
                 raw_snap = self.dex_graph.query(query, {"$ID": snap_id['id']})['data']['liquidityPositionSnapshot']
+                self._resolve_tokens(self._pool_token_addresses([raw_snap['pair']]))
                 snaps.append(self._process_snap(raw_snap, txs))
             except NonExistentUserException:
                 logging.error(f'NonExistentUserException - skipping snap with id: {snap_id}')
@@ -3,7 +3,7 @@ from collections import defaultdict
 from decimal import Decimal
 from typing import List, Iterable, Dict, Tuple
 
-from src.shared.type_definitions import ShareSnap, PoolToken, CurrencyField, Exchange
+from src.shared.type_definitions import ShareSnap, PoolToken, Exchange
 from src.subgraph import SubgraphReader
 from src.uniswap_v2.uniswap import Uniswap
 
@@ -27,13 +27,9 @@ class UniMatchingTxs(Uniswap):
                     id
                     token0 {
                         id
-                        symbol
-                        name
                     }
                     token1 {
                         id
-                        symbol
-                        name
                     }
                 }
                 reserve0
@@ -56,6 +52,7 @@ class UniMatchingTxs(Uniswap):
             }
             txs, tx_amount = self._get_txs(params)
             raw_snaps = self.dex_graph.query(query, params)['data']['snaps']
+            self._resolve_tokens(self._pool_token_addresses([snap['pair'] for snap in raw_snaps]))
             snaps = [self._process_snap(snap, txs) for snap in raw_snaps]
 
             if snaps:
@@ -102,12 +99,9 @@ class UniMatchingTxs(Uniswap):
                 price = reserves_usd / (2 * res)
             else:
                 price = 0
-                logging.warning(f'0 reserves for token {tok["symbol"]} in snap {snap["id"]}. '
+                logging.warning(f'0 reserves for token {tok["id"]} in snap {snap["id"]}. '
                                 'Setting token price to 0.')
-            tokens.append(PoolToken(CurrencyField(symbol=tok['symbol'],
-                                                  name=tok['name'],
-                                                  contract_address=tok['id'],
-                                                  platform='ethereum'),
+            tokens.append(PoolToken(self.token_registry.get(tok['id']),
                                     Decimal('0.5'),
                                     res,
                                     price
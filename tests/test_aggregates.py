@@ -0,0 +1,100 @@
+from decimal import Decimal
+
+from src.shared.aggregates import PositionAggregate, YieldAggregate, user_aggregates
+from src.shared.type_definitions import CurrencyField, Exchange, PoolToken, ShareSnap, StakingService, YieldReward
+
+TOKEN = CurrencyField('TKN', 'Token', '0xtoken', 'ethereum')
+
+
+def make_snap(snap_id, block, balance, total_supply=100, reserve=50, price_usd=2, eth_price=1000, tx_cost_eth=0,
+              staking_service=None):
+    return ShareSnap(snap_id, Exchange.UNI_V2, '0xuser', '0xpool', balance, total_supply,
+                     [PoolToken(TOKEN, '1', reserve, price_usd)], block, block * 10, f'0xtx{snap_id}', tx_cost_eth,
+                     Decimal(eth_price), staking_service)
+
+
+def make_yield(yield_id, block, amount):
+    return YieldReward(yield_id, Exchange.UNI_V2, '0xuser', '0xpool', Decimal(amount), block, block * 10,
+                       f'0xtx{yield_id}', StakingService.UNI_V2)
+
+
+def test_deposits_and_withdrawals_follow_the_balance():
+    aggregate = PositionAggregate()
+    # Pool worth 100 USD, 100 liquidity tokens
+    assert aggregate.apply(make_snap('a', 1, 10, tx_cost_eth='0.001'))
+    assert aggregate.apply(make_snap('b', 2, 4))
+    assert aggregate.deposits_usd == 10
+    assert aggregate.withdrawals_usd == 6
+    assert aggregate.deposits_eth == Decimal('0.01')
+    assert aggregate.liquidity_token_balance == 4
+    assert aggregate.tx_cost_usd == 1
+    assert aggregate.latest_snap['txHash'] == '0xtxb'
+
+
+def test_applied_snaps_are_skipped():
+    aggregate = PositionAggregate()
+    assert aggregate.apply(make_snap('a', 5, 10))
+    assert aggregate.apply(make_snap('b', 5, 20))
+    # Resumed fetch returns the snaps of the checkpointed block again
+    assert not aggregate.apply(make_snap('a', 5, 10))
+    assert not aggregate.apply(make_snap('b', 5, 20))
+    # Snaps of older blocks are out of order
+    assert not aggregate.apply(make_snap('c', 4, 0))
+    assert aggregate.deposits_usd == 20
+    assert aggregate.last_block_snap_ids == ['a', 'b']
+    assert aggregate.apply(make_snap('d', 6, 0))
+    assert aggregate.last_block == 6
+    assert aggregate.last_block_snap_ids == ['d']
+
+
+def test_serialized_aggregate_continues_dedup():
+    aggregate = PositionAggregate()
+    aggregate.apply(make_snap('a', 5, 10))
+    restored = PositionAggregate.from_serializable(aggregate.to_serializable())
+    assert restored == aggregate
+    assert not restored.apply(make_snap('a', 5, 10))
+    assert restored.apply(make_snap('b', 6, 15))
+    assert restored.deposits_usd == 15
+
+
+def test_history_is_replayed_in_block_order():
+    snaps = [make_snap('c', 3, 0), make_snap('a', 1, 10), make_snap('b', 2, 30)]
+    expected = PositionAggregate()
+    for snap in sorted(snaps, key=lambda snap: snap.block):
+        expected.apply(snap)
+    replayed = PositionAggregate.from_history({snap.id: snap.to_serializable() for snap in snaps})
+    assert replayed.deposits_usd == expected.deposits_usd == 30
+    assert replayed.withdrawals_usd == expected.withdrawals_usd == 30
+    assert replayed.last_block == 3
+    # Compact records have the same values
+    compact = PositionAggregate.from_history({snap.id: snap.to_compact_serializable() for snap in snaps})
+    assert compact.deposits_usd == 30
+
+
+def test_existing_position_is_not_a_deposit_after_the_backfill():
+    stored = {'a': make_snap('a', 1, 10).to_serializable()}
+    aggregate = PositionAggregate.from_history(stored)
+    assert aggregate.apply(make_snap('b', 2, 12))
+    assert aggregate.deposits_usd == 12
+
+
+def test_yield_aggregate_skips_applied_yields():
+    aggregate = YieldAggregate()
+    assert aggregate.apply(make_yield('a', 1, '1.5'))
+    assert not aggregate.apply(make_yield('a', 1, '1.5'))
+    assert aggregate.apply(make_yield('b', 2, '0.5'))
+    assert (aggregate.amount, aggregate.count) == (2, 2)
+    replayed = YieldAggregate.from_history({yield_.id: yield_.to_serializable()
+                                            for yield_ in (make_yield('b', 2, '0.5'), make_yield('a', 1, '1.5'))})
+    assert replayed == aggregate
+
+
+def test_backfill_splits_staked_positions():
+    snaps = {snap.id: snap.to_serializable() for snap in
+             (make_snap('a', 1, 10), make_snap('s', 2, 5, staking_service=StakingService.UNI_V2))}
+    yields = {'y': make_yield('y', 3, '1').to_serializable()}
+    aggregates = user_aggregates({'0xpool': snaps}, yields)
+    assert set(aggregates) == {'aggregates/0xpool', 'stakedAggregates/UNI_V2/0xpool', 'yieldAggregates/0xpool'}
+    assert Decimal(aggregates['aggregates/0xpool']['depositsUsd']) == 10
+    assert Decimal(aggregates['stakedAggregates/UNI_V2/0xpool']['depositsUsd']) == 5
+    assert aggregates['yieldAggregates/0xpool']['count'] == 1
@@ -0,0 +1,31 @@
+from decimal import Decimal
+
+import pytest
+
+# The migration imports the Firebase client
+pytest.importorskip('firebase_admin')
+
+from src.migrations.compact_snaps import compact_snap_record  # noqa: E402
+from src.shared.type_definitions import CurrencyField, Exchange, PoolToken, ShareSnap, pool_metadata_key  # noqa: E402
+
+
+def make_snap(symbols):
+    tokens = [PoolToken(CurrencyField(symbol, symbol, f'0x{symbol}', 'ethereum'), '0.5', 5, 2) for symbol in symbols]
+    return ShareSnap('snap', Exchange.BALANCER, '0xuser', '0xpool', 1, 10, tokens, 100, 1000, '0xtx', 0,
+                     Decimal(1000))
+
+
+def test_migrated_record_is_the_compact_record():
+    snap = make_snap(['a', 'b'])
+    record, metadata = compact_snap_record(snap.to_serializable())
+    assert record == snap.to_compact_serializable()
+    assert metadata == snap.pool_metadata()
+
+
+def test_changed_token_list_is_new_metadata():
+    ids = {make_snap(symbols).to_compact_serializable()['metadataId'] for symbols in (['a', 'b'], ['a', 'b', 'c'],
+                                                                                       ['b', 'a'])}
+    assert len(ids) == 3
+    assert make_snap(['a', 'b']).pool_metadata_id() == make_snap(['a', 'b']).pool_metadata_id()
+    # Records of the unversioned layout reference the metadata of the pool id
+    assert pool_metadata_key('0xpool', None) == '0xpool'
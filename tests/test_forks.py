@@ -0,0 +1,31 @@
+import json
+
+import pytest
+
+# The forks create Uniswap instances (and their HTTP clients)
+pytest.importorskip('requests')
+
+from src.forks import load_forks  # noqa: E402
+from src.shared.type_definitions import FORKS_PATH, Exchange, StakingService, _fork_exchanges  # noqa: E402
+
+
+def test_staked_streams_follow_the_yield_pools_of_the_fork(tmp_path):
+    path = tmp_path / 'forks.json'
+    path.write_text(json.dumps({
+        'UNI_V2': {'subgraph': 'benesjan/uniswap-v2', 'jobs': ['staked_snaps']},
+        'SUSHI': {'subgraph': 'benesjan/sushi-swap', 'jobs': ['staked_snaps'], 'yieldPools': ['SUSHI']},
+    }))
+    forks = load_forks(str(path))
+    assert forks['SUSHI'].create_dex().staking_services() == [StakingService.SUSHI]
+    # Every yield pool by default, Balancer staking is not a Uniswap fork service
+    assert StakingService.BALANCER not in forks['UNI_V2'].create_dex().staking_services()
+
+
+def test_forks_of_the_registry_are_exchanges(tmp_path):
+    assert set(_fork_exchanges(FORKS_PATH)) <= set(Exchange.__members__)
+    path = tmp_path / 'forks.json'
+    path.write_text(json.dumps({'NEW_FORK': {'subgraph': 'new/fork', 'jobs': ['snaps']}}))
+    assert _fork_exchanges(str(path)) == ['NEW_FORK']
+    # Members are loaded from the registry of the process
+    with pytest.raises(ValueError):
+        load_forks(str(path))
@@ -0,0 +1,61 @@
+from decimal import Decimal
+
+import pytest
+
+from src.shared.pool_days import PoolDayChunks, decode_pool_day, encode_pool_day_chunks
+from src.shared.type_definitions import CurrencyField, Exchange, Pool, PoolToken, pool_metadata_key
+
+
+def make_pool(pool_id, block=100, supply=10):
+    tokens = [PoolToken(CurrencyField(symbol, symbol, f'0x{symbol}', 'ethereum'), '0.5', 5, 2)
+              for symbol in ('a', 'b')]
+    return Pool(pool_id, Exchange.UNI_V2, Decimal(supply), tokens, block, Decimal(1000), Decimal(7))
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_pages_of_a_day_are_one_chunk(compress):
+    chunks = PoolDayChunks()
+    chunks.add([make_pool('0x3'), make_pool('0x1')])
+    chunks.add([make_pool('0x2')])
+    assert chunks.pool_count == 3
+    encoded = chunks.encode(compress)
+    assert list(encoded) == ['100_0x1']
+    # Same as the chunk of all the pools encoded at once
+    assert encoded == encode_pool_day_chunks([make_pool(pool_id) for pool_id in ('0x1', '0x2', '0x3')], compress)
+
+    pools = decode_pool_day({'chunks': encoded}, 'UNI_V2')
+    assert list(pools) == ['0x1', '0x2', '0x3']
+    assert pools['0x2']['block'] == 100
+    assert pools['0x2']['volumeUsd'] == '7'
+
+
+def test_pools_of_different_blocks_are_separate_chunks():
+    chunks = PoolDayChunks()
+    chunks.add([make_pool('0x1', block=100, supply=10), make_pool('0x2', block=100)])
+    # The pool fetched again by a later page at a higher block wins
+    chunks.add([make_pool('0x1', block=200, supply=20)])
+    encoded = chunks.encode()
+    assert len(encoded) == 2
+    pools = decode_pool_day({'chunks': encoded}, 'UNI_V2')
+    assert pools['0x1']['block'] == 200
+    assert pools['0x1']['liquidityTokenTotalSupply'] == '20'
+    assert pools['0x2']['block'] == 100
+
+
+def test_tokens_are_decoded_with_the_metadata_version_of_the_pool():
+    before = make_pool('0x1')
+    after = make_pool('0x1', block=200)
+    extra = PoolToken(CurrencyField('c', 'c', '0xc', 'ethereum'), '0.2', 1, 2)
+    after.tokens.append(extra)
+    assert before.pool_metadata_id() != after.pool_metadata_id()
+    metadata = {pool_metadata_key('0x1', pool.pool_metadata_id()): pool.pool_metadata() for pool in (before, after)}
+    for pool in (before, after):
+        decoded = decode_pool_day({'chunks': encode_pool_day_chunks([pool])}, 'UNI_V2', metadata)['0x1']
+        assert [token['token']['symbol'] for token in decoded['tokens']] == \
+               [token.token.symbol for token in pool.tokens]
+    # Chunks written before the versioning use the metadata of the pool id
+    legacy = encode_pool_day_chunks([before])
+    for chunk in legacy.values():
+        del chunk['columns']['metadataId']
+    decoded = decode_pool_day({'chunks': legacy}, 'UNI_V2', {'0x1': before.pool_metadata()})['0x1']
+    assert decoded['tokens'][0]['token']['symbol'] == 'a'
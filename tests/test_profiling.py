@@ -0,0 +1,51 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.profiling import SamplingProfiler, inherit_profiler
+
+
+def busy_worker_of_the_job(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+def busy_thread_of_another_job(stop: threading.Event):
+    while not stop.is_set():
+        pass
+
+
+def test_only_threads_of_the_job_are_sampled():
+    stop = threading.Event()
+    other_job = threading.Thread(target=busy_thread_of_another_job, args=(stop,))
+    other_job.start()
+    try:
+        with SamplingProfiler('test', interval=0.001) as profiler:
+            with ThreadPoolExecutor(max_workers=1, initializer=inherit_profiler()) as executor:
+                executor.submit(busy_worker_of_the_job, 0.2).result()
+    finally:
+        stop.set()
+        other_job.join()
+    stacks = ' '.join(profiler.stacks)
+    assert 'busy_worker_of_the_job' in stacks
+    assert 'busy_thread_of_another_job' not in stacks
+    # Threads started outside of a profiled job are not registered
+    inherit_profiler()()
+    assert profiler.rounds > 0
+
+
+def test_busy_workers_are_sampled_whatever_their_name():
+    def _worker(seconds):
+        # Named like the loop of the pool workers, busy in its own frame
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            pass
+
+    with SamplingProfiler('test', interval=0.001) as profiler:
+        thread = threading.Thread(target=lambda initializer: (initializer(), _worker(0.1)),
+                                  args=(inherit_profiler(),))
+        thread.start()
+        thread.join()
+    assert any(stack.endswith('test_profiling.py:_worker') for stack in profiler.stacks)
+    assert profiler.worker_stages['other'] > 0
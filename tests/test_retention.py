@@ -0,0 +1,65 @@
+import logging
+import time
+
+import pytest
+
+# src.storage imports the Firebase client
+pytest.importorskip('firebase_admin')
+
+from src.retention import PoolSnapRetention  # noqa: E402
+from src.storage import SQLiteStorage  # noqa: E402
+
+TODAY = int(time.time() / 86400)
+
+
+class RangeCountingStorage(SQLiteStorage):
+    def __init__(self, path):
+        super().__init__(path)
+        self.read_days = 0
+
+    def get_range(self, path, end_at, limit_to_last=None):
+        children = super().get_range(path, end_at, limit_to_last)
+        self.read_days += len(children)
+        return children
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = RangeCountingStorage(str(tmp_path / 'storage.sqlite3'))
+    updates = {f'poolSnaps/0x{pool}/{day_id}': {'block': day_id} for pool in range(5)
+               for day_id in range(TODAY - 60, TODAY + 1)}
+    updates.update({f'poolDays/UNI_V2/{day_id}': {'chunks': {}} for day_id in range(TODAY - 40, TODAY + 1)})
+    storage.update(updates)
+    return storage
+
+
+def make_retention(storage):
+    return PoolSnapRetention(storage, logging.getLogger('retention'), batch_size=10, max_requests_per_second=1000,
+                             days_per_read=7)
+
+
+def test_only_expired_days_are_read_and_deleted(storage):
+    assert make_retention(storage).sweep()
+    for pool in range(5):
+        assert min(map(int, storage.keys(f'poolSnaps/0x{pool}'))) == TODAY - 30
+    assert min(map(int, storage.keys('poolDays/UNI_V2'))) == TODAY - 30
+    assert storage.read_days == 5 * 30 + 10
+    assert storage.get('lastUpdate/retention/poolSnaps') is None
+
+
+def test_interrupted_sweep_resumes_after_the_cursor(storage):
+    # poolDays are swept before the first pool
+    assert not make_retention(storage).sweep(time_budget=0)
+    assert min(map(int, storage.keys('poolDays/UNI_V2'))) == TODAY - 30
+    assert min(map(int, storage.keys('poolSnaps/0x0'))) == TODAY - 60
+    storage.update({'lastUpdate/retention/poolSnaps': '0x2'})
+    assert make_retention(storage).sweep()
+    # Pools up to the cursor were swept by the interrupted run
+    assert min(map(int, storage.keys('poolSnaps/0x2'))) == TODAY - 60
+    assert min(map(int, storage.keys('poolSnaps/0x3'))) == TODAY - 30
+
+
+def test_range_reads_follow_the_integer_key_order(storage):
+    storage.update({'node/9': 1, 'node/10': 2, 'node/a': 3})
+    assert list(storage.get_range('node', '10')) == ['9', '10']
+    assert list(storage.get_range('node', 'a', limit_to_last=2)) == ['10', 'a']
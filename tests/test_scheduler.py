@@ -0,0 +1,117 @@
+import logging
+import time
+
+import pytest
+
+# The scheduler imports the exchanges (and their HTTP client) through the fork registry
+# and the Storage interface (and the Firebase client) from src.storage
+pytest.importorskip('requests')
+pytest.importorskip('firebase_admin')
+
+from src.scheduler import LagScheduler  # noqa: E402
+
+HIGHEST_BLOCK = 1000
+
+
+class MemoryStorage:
+    """
+    lastUpdate tree of the scheduler, paths of the updates are at most two levels below lastUpdate.
+    """
+
+    def __init__(self, last_update):
+        self.last_update = last_update
+
+    def get(self, path):
+        assert path == 'lastUpdate'
+        return self.last_update
+
+    def update(self, updates):
+        for path, value in updates.items():
+            _, *parents, leaf = path.split('/')
+            node = self.last_update
+            for parent in parents:
+                node = node.setdefault(parent, {})
+            node[leaf] = value
+
+
+class FixedHighestBlockScheduler(LagScheduler):
+    def _highest_block(self, exchange, entity_type):
+        return HIGHEST_BLOCK
+
+
+def make_scheduler(last_update, run_job, jobs):
+    return FixedHighestBlockScheduler(MemoryStorage(last_update), logging.getLogger('scheduler'), lambda _: None,
+                                      run_job, jobs=jobs, max_workers=1, time_slice=1)
+
+
+def test_jobs_run_by_lag_and_unfinished_jobs_are_requeued():
+    last_update = {
+        'UNI_V2': {'snaps': 900, 'yields': 100},
+        'SUSHI': {'snaps': 500},
+        'BALANCER': {'snaps': HIGHEST_BLOCK},
+        # Jobs which never ran would be starving
+        'scheduler': {key: time.time() for key in ('UNI_V2_snaps', 'UNI_V2_yields', 'SUSHI_snaps')},
+    }
+    runs = []
+
+    def run_job(exchange, entity_type, time_budget):
+        runs.append((exchange, entity_type))
+        checkpoints = last_update[exchange]
+        # Every slice catches up 500 blocks
+        checkpoints[entity_type] = min(checkpoints[entity_type] + 500, HIGHEST_BLOCK)
+        return checkpoints[entity_type] == HIGHEST_BLOCK
+
+    jobs = [('UNI_V2', 'snaps'), ('UNI_V2', 'yields'), ('SUSHI', 'snaps'), ('BALANCER', 'snaps')]
+    report = {f'{job["exchange"]}_{job["entityType"]}': job
+              for job in make_scheduler(last_update, run_job, jobs).run(time_budget=60)}
+    # The yields are requeued with the lag of 400 blocks, behind the snaps of Sushi
+    assert runs == [('UNI_V2', 'yields'), ('SUSHI', 'snaps'), ('UNI_V2', 'yields'), ('UNI_V2', 'snaps')]
+    assert report['UNI_V2_yields']['slices'] == 2
+    assert report['BALANCER_snaps'] == {'exchange': 'BALANCER', 'entityType': 'snaps', 'lag': 0, 'starving': False,
+                                        'slices': 0, 'finished': True}
+    assert all(job['finished'] for job in report.values())
+    assert set(last_update['scheduler']) == {'UNI_V2_snaps', 'UNI_V2_yields', 'SUSHI_snaps'}
+
+
+def test_starving_job_runs_first():
+    last_update = {
+        'UNI_V2': {'snaps': 0},
+        'SUSHI': {'snaps': 990},
+        'scheduler': {'UNI_V2_snaps': time.time(), 'SUSHI_snaps': time.time() - 7200},
+    }
+    runs = []
+
+    def run_job(exchange, entity_type, time_budget):
+        runs.append(exchange)
+        return True
+
+    report = make_scheduler(last_update, run_job, [('UNI_V2', 'snaps'), ('SUSHI', 'snaps')]).run(time_budget=60)
+    assert runs == ['SUSHI', 'UNI_V2']
+    assert [job['starving'] for job in report] == [False, True]
+
+
+def test_failed_job_is_reported_and_not_requeued():
+    last_update = {'UNI_V2': {'snaps': 0}}
+
+    def run_job(exchange, entity_type, time_budget):
+        raise ConnectionError('subgraph is down')
+
+    report, = make_scheduler(last_update, run_job, [('UNI_V2', 'snaps')]).run(time_budget=60)
+    assert report['slices'] == 1
+    assert report['error'] == 'subgraph is down'
+    assert not report['finished']
+
+
+def test_jobs_are_not_started_without_time_for_a_slice():
+    runs = []
+    scheduler = make_scheduler({'UNI_V2': {'snaps': 0}}, lambda *args: runs.append(args), [('UNI_V2', 'snaps')])
+    report, = scheduler.run(time_budget=0.5)
+    assert runs == []
+    assert report['lag'] == HIGHEST_BLOCK
+
+
+def test_default_jobs_leave_out_the_slow_forks():
+    from src.scheduler import default_jobs
+    jobs = default_jobs()
+    assert ('UNI_V2', 'staked_snaps') in jobs
+    assert not [job for job in jobs if job[0] == 'MATERIA']
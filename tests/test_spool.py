@@ -0,0 +1,67 @@
+import threading
+
+import pytest
+
+from src.error_definitions import SpoolLockedException
+from src.spool import UploadSpool
+
+
+@pytest.fixture
+def spool_path(tmp_path):
+    return str(tmp_path / 'spool.sqlite3')
+
+
+def test_entries_are_written_in_order(spool_path):
+    written = []
+    spool = UploadSpool(spool_path, written.append)
+    for i in range(20):
+        spool.append({f'path/{i}': i})
+    spool.flush()
+    spool.close()
+    assert written == [{f'path/{i}': i} for i in range(20)]
+
+
+def test_failed_entries_are_replayed_by_the_next_spool(spool_path):
+    def failing_writer(updates):
+        raise ConnectionError('offline')
+
+    spool = UploadSpool(spool_path, failing_writer, max_retries=1)
+    spool.append({'a': 1})
+    spool.append({'b': 2})
+    with pytest.raises(ConnectionError):
+        spool.flush()
+    spool.close()
+
+    written = []
+    spool = UploadSpool(spool_path, written.append)
+    spool.flush()
+    assert spool.pending() == 0
+    spool.close()
+    assert written == [{'a': 1}, {'b': 2}]
+
+
+def test_empty_updates_are_not_spooled(spool_path):
+    spool = UploadSpool(spool_path, lambda updates: None)
+    spool.append({})
+    assert spool.pending() == 0
+    spool.close()
+
+
+def test_spool_file_is_used_by_one_spool_at_a_time(spool_path):
+    spool = UploadSpool(spool_path, lambda updates: None)
+    with pytest.raises(SpoolLockedException):
+        UploadSpool(spool_path, lambda updates: None)
+    spool.close()
+    # Released by close
+    UploadSpool(spool_path, lambda updates: None).close()
+
+
+def test_close_drains_and_stops_the_drainer(spool_path):
+    written = []
+    threads = threading.active_count()
+    spool = UploadSpool(spool_path, written.append)
+    spool.append({'a': 1})
+    spool.close()
+    spool.close()
+    assert written == [{'a': 1}]
+    assert threading.active_count() == threads
@@ -0,0 +1,22 @@
+from src.shared.token_registry import TokenRegistry
+
+
+def test_missing_tokens_are_looked_up_again(tmp_path):
+    path = str(tmp_path / 'tokens.sqlite3')
+    lookups = []
+
+    def lookup(addresses):
+        lookups.append(addresses)
+        return {'0xa': ('A', 'Token A'), '0xempty': ('', '')}
+
+    registry = TokenRegistry(path)
+    registry.resolve(['0xa', '0xb', '0xempty'], lookup)
+    assert registry.is_resolved('0xa')
+    assert not registry.is_resolved('0xb')
+    assert not registry.is_resolved('0xempty')
+    assert registry.get('0xb').symbol == ''
+
+    registry.resolve(['0xa', '0xb', '0xempty'], lookup)
+    assert lookups == [['0xa', '0xb', '0xempty'], ['0xb', '0xempty']]
+    # Only the found token was persisted
+    assert [address for address in ('0xa', '0xb', '0xempty') if TokenRegistry(path).is_resolved(address)] == ['0xa']
@@ -0,0 +1,81 @@
+import random
+import threading
+import time
+
+import pytest
+
+from src.uploader import ShardedUploader
+
+
+class RecordingWriter:
+    """
+    Keeps the last written value of every path, slow at random so that concurrent writes interleave.
+    """
+
+    def __init__(self, fail_path=None):
+        self.values = {}
+        self.fail_path = fail_path
+        self.lock = threading.Lock()
+
+    def __call__(self, updates):
+        time.sleep(random.random() / 1000)
+        if self.fail_path in updates:
+            raise ConnectionError('offline')
+        with self.lock:
+            self.values.update(updates)
+
+
+def test_writes_of_a_path_land_in_order():
+    writer = RecordingWriter()
+    uploader = ShardedUploader(writer, max_workers=4)
+    for page in range(50):
+        # Aggregates of the same users are rewritten by every page
+        uploader.write({f'users/0x{user:04x}/UNI_V2/aggregates/pool': page for user in range(0, 0x1000, 0x100)})
+        uploader.write({'poolMetadata/UNI_V2/pool': page})
+    uploader.flush()
+    uploader.close()
+    assert set(writer.values.values()) == {49}
+
+
+def test_checkpoint_waits_for_the_data():
+    writer = RecordingWriter()
+    uploader = ShardedUploader(writer, max_workers=4)
+    uploader.write({f'users/0x{user:04x}/UNI_V2/snaps/pool/id': user for user in range(0, 0x1000, 0x10)})
+    uploader.write_checkpoint({'lastUpdate/UNI_V2/snaps': 1})
+    uploader.flush()
+    uploader.close()
+    assert len(writer.values) == 0x101
+
+
+def test_failed_write_blocks_the_checkpoint():
+    writer = RecordingWriter(fail_path='users/0x0000/UNI_V2/snaps/pool/id')
+    uploader = ShardedUploader(writer, max_workers=4)
+    uploader.write({'users/0x0000/UNI_V2/snaps/pool/id': 1})
+    uploader.write_checkpoint({'lastUpdate/UNI_V2/snaps': 1})
+    with pytest.raises(ConnectionError):
+        uploader.flush()
+    uploader.close()
+    assert 'lastUpdate/UNI_V2/snaps' not in writer.values
+
+
+def test_pending_writes_are_bounded():
+    release = threading.Event()
+    written = []
+
+    def writer(updates):
+        release.wait()
+        written.append(updates)
+
+    uploader = ShardedUploader(writer, max_workers=2, max_pending_writes=2)
+    uploader.write({'a': 1})
+    uploader.write({'b': 2})
+    third = threading.Thread(target=uploader.write, args=({'c': 3},))
+    third.start()
+    third.join(0.1)
+    assert third.is_alive()
+    release.set()
+    third.join(1)
+    assert not third.is_alive()
+    uploader.flush()
+    uploader.close()
+    assert written == [{'a': 1}, {'b': 2}, {'c': 3}]